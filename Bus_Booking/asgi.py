@@ -2,6 +2,8 @@
 ASGI config for Bus_Booking project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with an ASGI server (e.g. gunicorn with uvicorn workers) so live seat
+event streams wait on the event loop instead of holding a worker thread each.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -63,6 +63,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'accounts.ratelimit.RateLimitMiddleware',
     
     # Django AllAuth middleware
     'allauth.account.middleware.AccountMiddleware',
@@ -191,6 +192,88 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'DVM Bus Manager <noreply@busbliss.com>')
 
+# Email outbox worker (send_queued_emails): attempts before an email is given up on,
+# and the first and largest retry delays in seconds (doubling in between).
+# EMAIL_OUTBOX_BACKEND sends every queued email through that backend instead, e.g.
+# 'accounts.mail_backends.FakeEmailBackend' to run offline.
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_RETRY_DELAY', 30))
+EMAIL_OUTBOX_MAX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_MAX_RETRY_DELAY', 3600))
+EMAIL_OUTBOX_BACKEND = os.environ.get('EMAIL_OUTBOX_BACKEND', '')
+
+# SendGrid API: base URL (point at `manage.py run_sendgrid_stub` to test offline) and request timeout in seconds
+SENDGRID_API_URL = os.environ.get('SENDGRID_API_URL', 'https://api.sendgrid.com')
+SENDGRID_TIMEOUT = float(os.environ.get('SENDGRID_TIMEOUT', 10))
+
+# Cache settings (local memory by default; point at Redis/Memcached in production)
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'bus-booking'),
+    }
+}
+
+# Bus search result cache: which CACHES alias to use and how long entries live (seconds)
+BOOKING_SEARCH_CACHE = os.environ.get('BOOKING_SEARCH_CACHE', 'default')
+BOOKING_SEARCH_CACHE_TIMEOUT = int(os.environ.get('BOOKING_SEARCH_CACHE_TIMEOUT', 300))
+
+# Bus search results per page (direct and multi-stop results ranked together), and the
+# lower bounds (in rupees) of the price bands results can be filtered by, after "under" the first
+BOOKING_SEARCH_PAGE_SIZE = int(os.environ.get('BOOKING_SEARCH_PAGE_SIZE', 20))
+BOOKING_SEARCH_PRICE_BANDS = (500, 1000, 2000)
+
+# Live seat map events: pub/sub backend (booking.events.RedisBackend fans out across
+# workers), its Redis URL, and seconds between keepalives on idle streams
+BOOKING_EVENTS_BACKEND = os.environ.get('BOOKING_EVENTS_BACKEND', 'booking.events.InProcessBackend')
+BOOKING_EVENTS_REDIS_URL = os.environ.get('BOOKING_EVENTS_REDIS_URL', 'redis://localhost:6379/0')
+BOOKING_EVENTS_HEARTBEAT = int(os.environ.get('BOOKING_EVENTS_HEARTBEAT', 20))
+
+# Seconds a customer's selected seats stay held for them after starting checkout
+BOOKING_SEAT_HOLD_TTL = int(os.environ.get('BOOKING_SEAT_HOLD_TTL', 300))
+
+# Connecting journeys (booking.planner): minimum minutes between arriving on one bus
+# and departing on the next at the same city
+BOOKING_MIN_TRANSFER_MINUTES = int(os.environ.get('BOOKING_MIN_TRANSFER_MINUTES', 30))
+
+# Dynamic pricing (booking.pricing). Each rule table maps lower bounds to fare multipliers:
+# a bus gets the multiplier of the band it falls in from every table, multiplied together and
+# clamped to BOOKING_PRICING_LIMITS. Each bus stores its multiplier, which both search ranking and
+# bookings use; it is recomputed after each booking or cancellation and kept current between bookings
+# by the refresh_prices command.
+BOOKING_DYNAMIC_PRICING = os.environ.get('BOOKING_DYNAMIC_PRICING', 'True').lower() == 'true'
+BOOKING_PRICING_RULES = {
+    # Share of the bus's seats sold
+    'load_factor': [(0, 1.0), (0.5, 1.1), (0.75, 1.2), (0.9, 1.35)],
+    # Days left before departure
+    'days_to_departure': [(0, 1.25), (1, 1.1), (3, 1.0), (21, 0.95)],
+    # Seats sold in the last BOOKING_PRICING_DEMAND_HOURS, as a share of all seats
+    'demand': [(0, 1.0), (0.1, 1.05), (0.25, 1.15)],
+}
+BOOKING_PRICING_LIMITS = (0.8, 2.0)
+BOOKING_PRICING_DEMAND_HOURS = int(os.environ.get('BOOKING_PRICING_DEMAND_HOURS', 24))
+
+# Admin booking exports: selections with more tickets than this are queued for the
+# run_booking_exports worker, written into BOOKING_EXPORT_DIR and downloaded from the admin
+BOOKING_EXPORT_BACKGROUND_TICKETS = int(os.environ.get('BOOKING_EXPORT_BACKGROUND_TICKETS', 20000))
+BOOKING_EXPORT_DIR = os.environ.get('BOOKING_EXPORT_DIR', str(BASE_DIR / 'exports'))
+
+# Where OTP codes are kept: 'accounts.otp_store.DatabaseOTPStore' (OTP table) or
+# 'accounts.otp_store.CacheOTPStore' (no database writes; needs a shared cache), and its CACHES alias
+OTP_STORE = os.environ.get('OTP_STORE', 'accounts.otp_store.DatabaseOTPStore')
+OTP_CACHE = os.environ.get('OTP_CACHE', 'default')
+
+# Rate limits per URL name (see accounts.ratelimit): token buckets kept in the RATELIMIT_CACHE
+# alias, which should be shared by all workers in production. RATELIMIT_IP_HEADER names the
+# request.META key holding the client IP behind a proxy (e.g. 'HTTP_X_REAL_IP' with Nginx).
+RATELIMIT_ENABLE = os.environ.get('RATELIMIT_ENABLE', 'True').lower() == 'true'
+RATELIMIT_CACHE = os.environ.get('RATELIMIT_CACHE', 'default')
+RATELIMIT_IP_HEADER = os.environ.get('RATELIMIT_IP_HEADER') or None
+RATELIMITS = {
+    'booking:book_ticket': {'rate': '10/m', 'methods': ['POST']},
+    'booking:resend_booking_otp': {'rate': '3/m', 'methods': ['POST']},
+    'resend_registration_otp': {'rate': '3/m', 'methods': ['POST'], 'key': 'ip'},
+}
+
 # Django AllAuth Settings
 AUTHENTICATION_BACKENDS = [
     # Django default authentication backend
@@ -1,8 +1,9 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from .models import User, OTP
+from .models import User, OTP, EmailOutbox
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -35,8 +36,31 @@ class OTPAdmin(admin.ModelAdmin):
     """
     Admin interface for OTP model.
     """
-    list_display = ('email', 'action', 'code', 'created_at', 'expires_at', 'is_used')
+    list_display = ('email', 'action', 'created_at', 'expires_at', 'is_used')
     list_filter = ('action', 'is_used', 'created_at')
-    search_fields = ('email', 'code')
-    readonly_fields = ('created_at', 'expires_at')
+    search_fields = ('email',)
+    readonly_fields = ('code_hash', 'created_at', 'expires_at')
     ordering = ('-created_at',)
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    """
+    Admin interface for queued emails. Failed emails can be queued again.
+    """
+    list_display = ('subject', 'recipients', 'transport', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'transport', 'created_at')
+    search_fields = ('subject', 'recipients')
+    readonly_fields = ('transport', 'from_email', 'recipients', 'subject', 'body', 'html_body', 'status',
+                       'attempts', 'next_attempt_at', 'last_error', 'created_at', 'sent_at')
+    ordering = ('-created_at',)
+    actions = ['retry_now']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description=_('Retry selected emails now'))
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status='SENT').update(
+            status='PENDING', attempts=0, next_attempt_at=timezone.now(), last_error='')
+        self.message_user(request, _('%(count)d emails queued for delivery.') % {'count': updated})
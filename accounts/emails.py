@@ -0,0 +1,93 @@
+"""
+Email rendering.
+
+Each email has an HTML template and a plain-text twin (emails/<name>.html and
+emails/<name>.txt), so the text part is rendered from its own template rather
+than by stripping tags from the HTML. Compiled templates are kept per process
+(outside DEBUG), skipping the template loader on every send.
+
+EmailCampaign renders one email for many recipients who differ only in a few
+values: the templates are rendered once with a placeholder in place of each
+per-recipient value, and every recipient's copy is a string substitution.
+"""
+import functools
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils.html import escape, strip_tags
+
+
+class EmailTemplate:
+    """
+    The compiled HTML and text templates of one email.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.html = get_template(f'emails/{name}.html')
+        try:
+            self.text = get_template(f'emails/{name}.txt')
+        except TemplateDoesNotExist:
+            # Emails without a text template yet fall back to the stripped HTML
+            self.text = None
+
+    def render(self, context):
+        """Render the email; returns (plain text, HTML)."""
+        html = self.html.render(context)
+        if self.text is None:
+            return strip_tags(html), html
+        return self.text.render(context).strip(), html
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_template(name):
+    return EmailTemplate(name)
+
+
+def get_email_template(name):
+    """The EmailTemplate for `name`, compiled once per process (every time in DEBUG, so edits show up)."""
+    if settings.DEBUG:
+        return EmailTemplate(name)
+    return _cached_template(name)
+
+
+def render_email(name, context):
+    """Render the email template `name`; returns (plain text, HTML)."""
+    return get_email_template(name).render(context)
+
+
+def placeholder(field):
+    """The text standing in for a per-recipient value (autoescaping leaves it alone)."""
+    return f'%%{field}%%'
+
+
+class EmailCampaign:
+    """
+    One email rendered for many recipients. `personal_fields` name the context
+    values that differ per recipient; dotted names (e.g. 'user.full_name')
+    replace the whole object in the shared render, so templates may only use
+    the listed attributes of it. Personal values must be printed as they are:
+    template filters would act on the placeholder, not the value.
+    """
+
+    def __init__(self, template_name, context, personal_fields):
+        self.fields = tuple(personal_fields)
+        shared = dict(context)
+        for field in self.fields:
+            *parents, leaf = field.split('.')
+            node = shared
+            for part in parents:
+                node[part] = dict(node[part]) if isinstance(node.get(part), dict) else {}
+                node = node[part]
+            node[leaf] = placeholder(field)
+        self.text, self.html = render_email(template_name, shared)
+
+    def render_for(self, values):
+        """One recipient's (plain text, HTML), given {personal field: value}."""
+        text, html = self.text, self.html
+        for field in self.fields:
+            value = str(values.get(field, ''))
+            text = text.replace(placeholder(field), value)
+            html = html.replace(placeholder(field), escape(value))
+        return text, html
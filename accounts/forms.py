@@ -3,6 +3,7 @@ from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, Pass
 from django.utils.translation import gettext_lazy as _
 
 from .models import User, OTP
+from .otp_store import verify_otp
 
 class CustomUserCreationForm(UserCreationForm):
     """
@@ -107,8 +108,7 @@ class OTPVerificationForm(forms.Form):
         
         # Verify OTP if email and action are provided
         if self.email and self.action:
-            valid, otp = OTP.verify_otp(self.email, self.action, code)
-            if not valid:
+            if not verify_otp(self.email, self.action, code):
                 raise forms.ValidationError(_("Invalid or expired OTP code. Please request a new one."))
         
         return code
@@ -0,0 +1,29 @@
+from smtplib import SMTPRecipientsRefused
+
+from django.conf import settings
+from django.core.mail.backends.console import EmailBackend as ConsoleEmailBackend
+
+
+class FakeEmailBackend(ConsoleEmailBackend):
+    """
+    Offline email backend for testing the outbox worker. Messages are written
+    to the console and recorded in FakeEmailBackend.sent instead of being
+    sent; messages to an address in settings.EMAIL_FAKE_FAIL_RECIPIENTS are
+    refused, so retries and backoff can be exercised without a mail server.
+    """
+    sent = []
+
+    def send_messages(self, email_messages):
+        failing = set(getattr(settings, 'EMAIL_FAKE_FAIL_RECIPIENTS', ()))
+        delivered = []
+        for message in email_messages:
+            refused = failing.intersection(message.recipients())
+            if refused:
+                if not self.fail_silently:
+                    raise SMTPRecipientsRefused({address: (550, b'Mailbox unavailable') for address in refused})
+                continue
+            delivered.append(message)
+        if delivered:
+            super().send_messages(delivered)
+            self.sent.extend(delivered)
+        return len(delivered)
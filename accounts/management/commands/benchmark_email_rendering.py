@@ -0,0 +1,91 @@
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from accounts.emails import EmailCampaign, EmailTemplate
+
+
+class Command(BaseCommand):
+    help = 'Benchmark email rendering: render_to_string + strip_tags vs cached templates vs campaign rendering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=500, help='Emails rendered per run')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per method (best time is reported)')
+
+    def handle(self, *args, **options):
+        count = options['recipients']
+        self.stdout.write(self.style.WARNING(f'Benchmarking email rendering for {count} recipients...'))
+        self.stdout.write(f"{'template':>22} {'method':>28} {'µs/email':>10} {'speedup':>8}")
+
+        for name, context, field, values in self.cases(count):
+            template = EmailTemplate(name)
+
+            def legacy():
+                for value in values:
+                    html = render_to_string(f'emails/{name}.html', self.personalize(context, field, value))
+                    strip_tags(html)
+
+            def cached():
+                for value in values:
+                    template.render(self.personalize(context, field, value))
+
+            def campaign():
+                rendered = EmailCampaign(name, context, [field])
+                for value in values:
+                    rendered.render_for({field: value})
+
+            baseline = None
+            for label, run in (('render_to_string+strip_tags', legacy), ('cached html+txt templates', cached),
+                               ('campaign (render once)', campaign)):
+                best = self.measure(run, options['repeat']) / count * 1e6
+                baseline = baseline or best
+                self.stdout.write(f"{name:>22} {label:>28} {best:>10.1f} {baseline / best:>7.1f}x")
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete.'))
+
+    def cases(self, count):
+        """(template, shared context, personal field, per-recipient values) for each benchmarked email."""
+        otp_context = {'code': '000000', 'action': 'Booking', 'expiry_minutes': 5}
+        otp_codes = [f'{i:06d}' for i in range(count)]
+
+        departure = timezone.now() + timedelta(days=3)
+        route = SimpleNamespace(origin='Pilani', destination='Jaipur')
+        bus = SimpleNamespace(bus_number='RJ-18-1234', route=route, departure_time=departure)
+        booking = SimpleNamespace(id=1042, bus=bus, seat_numbers='12,13', total_fare=Decimal('850.00'))
+        booking_context = {
+            'user': {'full_name': 'Passenger'}, 'booking': booking,
+            'site_name': 'DVM Bus Manager', 'booking_url': '/booking/1042/',
+        }
+        names = [f'Passenger {i}' for i in range(count)]
+
+        return [
+            ('otp_email', otp_context, 'code', otp_codes),
+            ('booking_confirmation', booking_context, 'user.full_name', names),
+        ]
+
+    def personalize(self, context, field, value):
+        """The full per-recipient context, as the non-campaign paths render it."""
+        *parents, leaf = field.split('.')
+        context = dict(context)
+        node = context
+        for part in parents:
+            node[part] = dict(node[part])
+            node = node[part]
+        node[leaf] = value
+        return context
+
+    def measure(self, run, repeat):
+        """Best wall time of `repeat` runs, in seconds."""
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
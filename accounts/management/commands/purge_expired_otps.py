@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.models import OTP
+
+
+class Command(BaseCommand):
+    help = 'Delete expired OTP codes in batches (run hourly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement')
+        parser.add_argument('--keep-hours', type=float, default=0,
+                            help='Keep codes for this many hours after they expire (e.g. for auditing)')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(hours=options['keep_hours'])
+        deleted = OTP.purge_expired(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"✅ Deleted {deleted} expired OTP codes."))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from accounts.sendgrid_stub import SendGridStub
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the SendGrid mail API (set SENDGRID_API_URL to the printed URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8025, help='Port to listen on')
+        parser.add_argument('--latency', type=float, default=0, help='Seconds to wait before each response')
+        parser.add_argument('--fail-rate', type=float, default=0,
+                            help='Fraction of requests (0-1) answered with a 503')
+
+    def handle(self, *args, **options):
+        stub = SendGridStub(('127.0.0.1', options['port']), options['latency'], options['fail_rate'], verbose=True)
+        self.stdout.write(self.style.SUCCESS(f"SendGrid stub listening on {stub.url} (Ctrl+C to stop)"))
+        try:
+            stub.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server_close()
+            self.stdout.write(f"Accepted {len(stub.requests)} requests over {stub.connections} connections.")
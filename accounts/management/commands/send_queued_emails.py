@@ -0,0 +1,46 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.outbox import OUTBOX_BATCH_SIZE, process_outbox
+from accounts.sendgrid_utils import latency_stats
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued emails from the outbox, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE,
+                            help='Emails claimed and delivered per backend connection')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, polling for new emails')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, retrying, failed = process_outbox(options['batch_size'])
+            if sent or retrying or failed or not options['loop']:
+                self.report(sent, retrying, failed)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        if failed:
+            sys.exit(1)
+
+    def report(self, sent, retrying, failed):
+        self.stdout.write(self.style.SUCCESS(f"✅ Sent {sent} emails."))
+        if retrying:
+            self.stdout.write(self.style.WARNING(f"{retrying} emails failed and will be retried."))
+        if failed:
+            self.stdout.write(self.style.ERROR(f"❌ {failed} emails failed too many times and were given up on."))
+
+        stats = latency_stats()
+        if stats:
+            self.stdout.write(
+                f"SendGrid: {stats['requests']} requests for {stats['recipients']} recipients "
+                f"({stats['errors']} errors), latency mean {stats['mean_ms']:.0f} ms, "
+                f"p95 {stats['p95_ms']:.0f} ms, max {stats['max_ms']:.0f} ms"
+            )
@@ -0,0 +1,49 @@
+from django.db import migrations, models
+from django.utils.crypto import salted_hmac
+
+
+def hash_existing_codes(apps, schema_editor):
+    """Replace the plain codes of existing OTPs with their hashes (see accounts.models.hash_otp_code)."""
+    OTP = apps.get_model('accounts', 'OTP')
+    for otp in OTP.objects.all().only('email', 'action', 'code').iterator():
+        otp.code_hash = salted_hmac(
+            'accounts.OTP', f"{otp.action}:{otp.email.lower()}:{otp.code}", algorithm='sha256',
+        ).hexdigest()
+        otp.save(update_fields=['code_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_email_outbox'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='otp',
+            name='accounts_ot_email_ed06f4_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='otp',
+            name='accounts_ot_code_e43106_idx',
+        ),
+        migrations.AddField(
+            model_name='otp',
+            name='code_hash',
+            field=models.CharField(default='', max_length=64, verbose_name='OTP code hash'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_existing_codes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='otp',
+            name='code',
+        ),
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(condition=models.Q(('is_used', False)), fields=['email', 'action', 'code_hash', 'expires_at'], name='otp_unused_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['expires_at'], name='otp_expires_at_idx'),
+        ),
+    ]
@@ -2,7 +2,7 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
-import random
+from django.utils.crypto import get_random_string, salted_hmac
 import string
 from datetime import timedelta
 
@@ -59,9 +59,19 @@ class User(AbstractUser):
         return self.email
 
 
+def hash_otp_code(email, action, code):
+    """
+    Keyed hash of an OTP code. Codes are stored hashed, bound to the email and
+    action they were issued for, so a leaked table reveals no usable codes.
+    """
+    return salted_hmac('accounts.OTP', f"{action}:{email.lower()}:{code}", algorithm='sha256').hexdigest()
+
+
 class OTP(models.Model):
     """
-    Model to store One-Time Passwords for various actions
+    Model to store One-Time Passwords for various actions.
+    Only a hash of each code is stored; expired and used rows are deleted
+    by the purge_expired_otps command.
     """
     ACTION_CHOICES = (
         ('REGISTRATION', _('Registration')),
@@ -73,7 +83,7 @@ class OTP(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True,
                              related_name='otps', help_text=_('User associated with this OTP (can be null for registration)'))
     email = models.EmailField(_('email address'))
-    code = models.CharField(_('OTP code'), max_length=6)
+    code_hash = models.CharField(_('OTP code hash'), max_length=64)
     action = models.CharField(_('action'), max_length=20, choices=ACTION_CHOICES)
     created_at = models.DateTimeField(_('created at'), default=timezone.now)
     expires_at = models.DateTimeField(_('expires at'))
@@ -83,8 +93,12 @@ class OTP(models.Model):
         verbose_name = _('OTP')
         verbose_name_plural = _('OTPs')
         indexes = [
-            models.Index(fields=['email', 'action']),
-            models.Index(fields=['code']),
+            # Matches verify_otp's lookup, and generate_otp's invalidation by its prefix;
+            # used codes drop out of the index
+            models.Index(fields=['email', 'action', 'code_hash', 'expires_at'],
+                         condition=models.Q(is_used=False), name='otp_unused_lookup_idx'),
+            # The purge command's range scan
+            models.Index(fields=['expires_at'], name='otp_expires_at_idx'),
         ]
     
     def __str__(self):
@@ -93,51 +107,106 @@ class OTP(models.Model):
     @classmethod
     def generate_otp(cls, email, action, user=None, expiry_minutes=10):
         """
-        Generate a new OTP for the specified email and action
+        Generate a new OTP for the specified email and action.
+        The plain code is only available on the returned instance, as `code`.
         """
-        # Invalidate any existing OTPs for this email and action
-        cls.objects.filter(email=email, action=action, is_used=False).update(is_used=True)
+        now = timezone.now()
         
-        # Generate a random 6-digit code
-        code = ''.join(random.choices(string.digits, k=6))
+        # Invalidate any live OTPs for this email and action
+        cls.objects.filter(email=email, action=action, is_used=False, expires_at__gt=now).update(is_used=True)
         
-        # Calculate expiry time
-        expires_at = timezone.now() + timedelta(minutes=expiry_minutes)
+        # Generate a random 6-digit code
+        code = get_random_string(6, string.digits)
         
         # Create and return the new OTP
-        return cls.objects.create(
+        otp = cls.objects.create(
             user=user, 
             email=email, 
-            code=code, 
+            code_hash=hash_otp_code(email, action, code),
             action=action, 
-            expires_at=expires_at
+            created_at=now,
+            expires_at=now + timedelta(minutes=expiry_minutes)
         )
+        otp.code = code
+        return otp
     
     @classmethod
     def verify_otp(cls, email, action, code):
         """
-        Verify if the provided OTP is valid for the email and action
+        Verify if the provided OTP is valid for the email and action,
+        marking it used. Returns (valid, otp).
         """
-        # BYPASS OTP: Always return True for bypassing OTP verification
-        # Change to False to re-enable OTP verification 
-        BYPASS_OTP_VERIFICATION = True
+        now = timezone.now()
+        otp = cls.objects.filter(
+            email=email,
+            action=action,
+            code_hash=hash_otp_code(email, action, code),
+            is_used=False,
+            expires_at__gt=now
+        ).first()
+        if otp is None:
+            return False, None
         
-        if BYPASS_OTP_VERIFICATION:
-            # Return a successful verification without checking
-            return True, None
-            
-        # Normal OTP verification (not used when bypassing is enabled)
-        try:
-            otp = cls.objects.get(
-                email=email,
-                action=action,
-                code=code,
-                is_used=False,
-                expires_at__gt=timezone.now()
-            )
-            # Mark as used
-            otp.is_used = True
-            otp.save()
-            return True, otp
-        except cls.DoesNotExist:
+        # Conditional update, so a code can only be used once even by concurrent requests
+        if not cls.objects.filter(pk=otp.pk, is_used=False).update(is_used=True):
             return False, None
+        otp.is_used = True
+        return True, otp
+    
+    @classmethod
+    def purge_expired(cls, before=None, batch_size=1000):
+        """
+        Delete OTPs that expired before `before` (default: now), in batches of
+        `batch_size` rows so no single statement holds long locks. Used codes
+        are deleted once they would have expired. Returns the number deleted.
+        """
+        before = before or timezone.now()
+        deleted = 0
+        while True:
+            batch = list(cls.objects.filter(expires_at__lt=before).values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            count, _per_model = cls.objects.filter(pk__in=batch).delete()
+            deleted += count
+
+
+class EmailOutbox(models.Model):
+    """
+    An email waiting to be delivered by the send_queued_emails worker.
+    Requests only insert rows here, so no SMTP or HTTP call runs in the request thread.
+    """
+    TRANSPORT_CHOICES = (
+        ('DJANGO', _('Django email backend')),
+        ('SENDGRID', _('SendGrid API')),
+    )
+    STATUS_CHOICES = (
+        ('PENDING', _('Pending')),
+        ('SENT', _('Sent')),
+        ('FAILED', _('Failed')),
+    )
+
+    transport = models.CharField(_('transport'), max_length=10, choices=TRANSPORT_CHOICES, default='DJANGO')
+    from_email = models.CharField(_('from email'), max_length=254)
+    recipients = models.JSONField(_('recipients'), default=list)
+    subject = models.CharField(_('subject'), max_length=255)
+    body = models.TextField(_('plain text body'))
+    html_body = models.TextField(_('HTML body'), blank=True)
+    status = models.CharField(_('status'), max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    # Due time of the next delivery attempt; pushed ahead while a worker holds the row
+    next_attempt_at = models.DateTimeField(_('next attempt at'), default=timezone.now)
+    last_error = models.TextField(_('last error'), blank=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    sent_at = models.DateTimeField(_('sent at'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('queued email')
+        verbose_name_plural = _('email outbox')
+        ordering = ['next_attempt_at']
+        indexes = [
+            # The worker's "due emails" scan
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients)} ({self.status})"
@@ -0,0 +1,165 @@
+"""
+Queued email delivery.
+
+Request code never talks to an SMTP server or the SendGrid API: it renders
+the message and inserts an EmailOutbox row (in the request's transaction, so
+a rolled-back booking sends nothing). The send_queued_emails worker claims
+due rows in batches, delivers each batch over one backend connection, and
+reschedules failures with exponential backoff until they succeed or run out
+of attempts.
+
+Setting EMAIL_OUTBOX_BACKEND routes every queued email, SendGrid ones
+included, through that Django email backend instead; with
+accounts.mail_backends.FakeEmailBackend the whole pipeline runs offline.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 50
+
+# How long a claimed email stays invisible to other workers; a worker that
+# dies mid-batch leaves its emails to be picked up again after this
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def enqueue_email(subject, body, recipient_list, html_body='', from_email=None, transport='DJANGO'):
+    """
+    Queue an email for the worker and return its EmailOutbox row.
+    """
+    return EmailOutbox.objects.create(
+        transport=transport,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        recipients=list(recipient_list),
+        subject=subject,
+        body=body,
+        html_body=html_body,
+    )
+
+
+def retry_delay(attempts):
+    """Backoff before the next try of an email that has failed `attempts` times."""
+    delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_MAX_RETRY_DELAY))
+
+
+def claim_batch(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Claim up to `batch_size` due emails for this worker by pushing their next
+    attempt past CLAIM_TIMEOUT. Rows locked by another worker are skipped.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = EmailOutbox.objects.filter(status='PENDING', next_attempt_at__lte=now).order_by('next_attempt_at')
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        batch = list(due[:batch_size])
+        if batch:
+            EmailOutbox.objects.filter(pk__in=[email.pk for email in batch]).update(
+                next_attempt_at=now + CLAIM_TIMEOUT)
+    return batch
+
+
+def _build_message(email, connection=None):
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.recipients,
+        connection=connection,
+    )
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def _deliver_with_backend(emails, backend=None):
+    """
+    Send emails over one connection of a Django email backend.
+    Yields (email, error) pairs; error is None for a delivered email. If the
+    connection cannot be opened, every email fails with that error.
+    """
+    if not emails:
+        return
+    mail_connection = get_connection(backend)
+    try:
+        mail_connection.open()
+    except Exception as e:
+        yield from ((email, e) for email in emails)
+        return
+    try:
+        for email in emails:
+            try:
+                if not mail_connection.send_messages([_build_message(email, mail_connection)]):
+                    raise RuntimeError("The email backend did not send the message.")
+            except Exception as e:
+                yield email, e
+            else:
+                yield email, None
+    finally:
+        try:
+            mail_connection.close()
+        except Exception:
+            # Every outcome is already known; a failed QUIT changes none of them
+            logger.warning("Closing the email connection failed", exc_info=True)
+
+
+def deliver_batch(emails):
+    """
+    Deliver claimed emails and record the outcome of each.
+    Returns (sent, retrying, failed) counts.
+    """
+    # Imported here: sendgrid_utils queues its emails through this module
+    from .sendgrid_utils import deliver_with_sendgrid
+
+    if settings.EMAIL_OUTBOX_BACKEND:
+        results = list(_deliver_with_backend(emails, settings.EMAIL_OUTBOX_BACKEND))
+    else:
+        results = list(_deliver_with_backend([e for e in emails if e.transport == 'DJANGO']))
+        results += deliver_with_sendgrid([e for e in emails if e.transport == 'SENDGRID'])
+
+    now = timezone.now()
+    sent = [email.pk for email, error in results if error is None]
+    if sent:
+        EmailOutbox.objects.filter(pk__in=sent).update(status='SENT', sent_at=now, last_error='')
+
+    failures = []
+    for email, error in results:
+        if error is None:
+            continue
+        logger.warning("Email %s to %s failed (attempt %s): %s",
+                       email.pk, email.recipients, email.attempts + 1, error)
+        email.attempts += 1
+        email.last_error = str(error) or error.__class__.__name__
+        if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+            email.status = 'FAILED'
+        else:
+            email.next_attempt_at = now + retry_delay(email.attempts)
+        failures.append(email)
+    if failures:
+        EmailOutbox.objects.bulk_update(failures, ['attempts', 'last_error', 'status', 'next_attempt_at'])
+
+    failed = sum(1 for email in failures if email.status == 'FAILED')
+    return len(sent), len(failures) - failed, failed
+
+
+def process_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Deliver every email that is due, batch by batch.
+    Returns (sent, retrying, failed) counts.
+    """
+    totals = [0, 0, 0]
+    while True:
+        batch = claim_batch(batch_size)
+        if not batch:
+            return tuple(totals)
+        for i, count in enumerate(deliver_batch(batch)):
+            totals[i] += count
@@ -0,0 +1,181 @@
+"""
+Request rate limiting.
+
+settings.RATELIMITS maps URL names ('booking:book_ticket') to limits, given
+as a rate string like '5/m' or a dict:
+
+    {'rate': '5/m', 'burst': 5, 'methods': ['POST'], 'key': 'user_or_ip'}
+
+- rate: tokens added per second/minute/hour/day ('s', 'm', 'h', 'd')
+- burst: bucket size, i.e. requests allowed back to back (default: the rate's count)
+- methods: only these methods are limited (default: all)
+- key: whose bucket a request draws from: 'user_or_ip' (default), 'user' or 'ip'
+
+Views opt in with the @ratelimit decorator; RateLimitMiddleware applies the
+remaining configured views. A rejected request gets a 429 with Retry-After.
+
+Each bucket is tracked with atomic cache counters (add + incr) in the cache
+named by settings.RATELIMIT_CACHE, so checks are O(1), shared by all workers
+(with Redis or Memcached) and never touch the database. If that cache fails,
+checks fall back to a process-local memory cache.
+"""
+import logging
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse
+from django.utils.translation import gettext as _
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_fallback_cache = LocMemCache('ratelimit-fallback', {'OPTIONS': {'MAX_ENTRIES': 10000}})
+
+
+class RateLimit:
+    """
+    A token bucket of `burst` tokens refilled at `rate` tokens per second.
+
+    The bucket is approximated with one counter per window of `burst / rate`
+    seconds (the time to refill an empty bucket): tokens taken in the current
+    window, plus the previous window's count draining at `rate`. That
+    estimate never undercounts the real bucket, so it never lets through more
+    than the bucket would. Rejected requests take a token too, so hammering
+    an endpoint keeps it closed.
+    """
+
+    def __init__(self, scope, rate, burst=None, methods=None, key='user_or_ip'):
+        count, period = rate.split('/')
+        self.scope = scope
+        self.rate = int(count) / PERIODS[period[0]]
+        self.burst = burst or int(count)
+        self.window = self.burst / self.rate
+        self.methods = {method.upper() for method in methods} if methods else None
+        self.key = key
+
+    @classmethod
+    def for_view(cls, name):
+        """The configured limit of a URL name, or None."""
+        config = getattr(settings, 'RATELIMITS', {}).get(name)
+        if config is None:
+            return None
+        if isinstance(config, str):
+            config = {'rate': config}
+        return cls(name, **config)
+
+    def identity(self, request):
+        """Whose bucket the request draws from, or None if it is not limited by this key."""
+        user_id = None
+        if self.key != 'ip' and hasattr(request, 'session'):
+            # The session's user id: limiting never loads the user object
+            user_id = request.session.get(SESSION_KEY)
+        if user_id is not None:
+            return f'u{user_id}'
+        if self.key == 'user':
+            return None
+        header = getattr(settings, 'RATELIMIT_IP_HEADER', None)
+        ip = request.META.get(header) if header else None
+        return f"ip{(ip or request.META.get('REMOTE_ADDR', '')).split(',')[0].strip()}"
+
+    def hit(self, identity, now=None):
+        """
+        Take a token for `identity`. Returns 0 if the request is allowed,
+        otherwise the seconds until it would be.
+        """
+        now = time.time() if now is None else now
+        window = int(now // self.window)
+        current = f'rl:{self.scope}:{identity}:{window}'
+        previous = f'rl:{self.scope}:{identity}:{window - 1}'
+        try:
+            taken, drained = self._count(caches[settings.RATELIMIT_CACHE], current, previous)
+        except Exception:
+            logger.exception("Rate limit cache unavailable; using process-local counters")
+            taken, drained = self._count(_fallback_cache, current, previous)
+
+        # Tokens of the previous window that have not been refilled yet
+        elapsed = now - window * self.window
+        level = taken + max(0.0, drained - self.rate * elapsed)
+        if level <= self.burst:
+            return 0
+        return max(1, math.ceil((level - self.burst) / self.rate))
+
+    def _count(self, cache, current, previous):
+        """Increment the current window's counter; returns (its new value, the previous window's count)."""
+        timeout = math.ceil(self.window * 2) + 1
+        cache.add(current, 0, timeout)
+        try:
+            taken = cache.incr(current)
+        except ValueError:
+            # Expired between add and incr
+            cache.add(current, 1, timeout)
+            taken = 1
+        return taken, cache.get(previous, 0)
+
+    def check(self, request):
+        """Seconds the request must wait, or 0 if it may proceed."""
+        if self.methods and request.method not in self.methods:
+            return 0
+        identity = self.identity(request)
+        if identity is None:
+            return 0
+        return self.hit(identity)
+
+
+def rate_limited_response(retry_after):
+    response = HttpResponse(
+        _("Too many requests. Please wait %(seconds)d seconds and try again.") % {'seconds': retry_after},
+        status=429,
+        content_type='text/plain; charset=utf-8',
+    )
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def ratelimit(name):
+    """
+    Limit a view by the settings.RATELIMITS entry `name` (normally its URL
+    name). Views without an entry are not limited.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            limit = RateLimit.for_view(name)
+            if limit is not None and getattr(settings, 'RATELIMIT_ENABLE', True):
+                retry_after = limit.check(request)
+                if retry_after:
+                    return rate_limited_response(retry_after)
+            return view_func(request, *args, **kwargs)
+
+        # The middleware leaves decorated views alone
+        wrapped.ratelimited = True
+        return wrapped
+    return decorator
+
+
+class RateLimitMiddleware:
+    """
+    Applies settings.RATELIMITS to views that are not decorated with @ratelimit.
+    Must come after SessionMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'ratelimited', False) or not getattr(settings, 'RATELIMIT_ENABLE', True):
+            return None
+        match = request.resolver_match
+        limit = RateLimit.for_view(match.view_name) if match else None
+        if limit is None:
+            return None
+        retry_after = limit.check(request)
+        return rate_limited_response(retry_after) if retry_after else None
@@ -0,0 +1,81 @@
+"""
+A local stand-in for the SendGrid v3 mail API, for testing without network
+access or an API key. Point settings.SENDGRID_API_URL at it (see the
+run_sendgrid_stub command). It speaks HTTP/1.1 keep-alive like the real API,
+accepts POST /v3/mail/send with 202, and records each request.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SendGridStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        if self.path != '/v3/mail/send':
+            status, body = 404, {'errors': [{'message': 'Not found'}]}
+        elif not self.headers.get('Authorization', '').startswith('Bearer '):
+            status, body = 401, {'errors': [{'message': 'Missing API key'}]}
+        elif server.reject_addresses.intersection(
+                to['email'] for p in payload.get('personalizations', ()) for to in p.get('to', ())):
+            status, body = 400, {'errors': [{'message': 'Invalid email address', 'field': 'personalizations.to'}]}
+        elif server.fail_rate and random.random() < server.fail_rate:
+            status, body = 503, {'errors': [{'message': 'Simulated failure'}]}
+        else:
+            status, body = 202, None
+            with server.lock:
+                server.requests.append(payload)
+
+        data = json.dumps(body).encode() if body else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class SendGridStub(ThreadingHTTPServer):
+    """
+    The stub server. `requests` holds the accepted payloads and `connections`
+    counts TCP connections, so callers can check that sends reuse connections.
+    `latency` (seconds) and `fail_rate` (0-1) simulate a slow or flaky API;
+    requests to any address in `reject_addresses` are rejected with a 400.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, fail_rate=0, verbose=False):
+        super().__init__(address, SendGridStubHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.reject_addresses = set()
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve on a background thread; returns the server."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
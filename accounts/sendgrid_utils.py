@@ -1,62 +1,244 @@
+import logging
 import os
-import sendgrid
+import threading
+import time
+from collections import deque, namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
 from sendgrid.helpers.mail import Mail, Email, To, Content, HtmlContent
 from django.conf import settings
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from .emails import render_email
+from .outbox import enqueue_email
+
+logger = logging.getLogger(__name__)
+
+# SendGrid accepts at most 1000 personalizations (recipients here) per request
+SENDGRID_BATCH_SIZE = 1000
+
+# Keep-alive connections kept open to the API per process
+SENDGRID_POOL_SIZE = 4
+
+# 4xx statuses no smaller request can fix (bad API key, no permission, rate limited)
+SENDGRID_WHOLE_REQUEST_ERRORS = {401, 403, 429}
+
+# Recent requests kept for latency metrics
+SENDGRID_METRICS_SIZE = 500
+
+# One API request: how many recipients it carried, how long it took, and its status (None on a network error)
+BatchStats = namedtuple('BatchStats', ['recipients', 'seconds', 'status_code'])
+
+
+class SendGridError(Exception):
+    """SendGrid did not accept a request."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SendGridClient:
+    """
+    SendGrid v3 mail API client. All requests share one pooled HTTP session,
+    so consecutive sends reuse a keep-alive TLS connection instead of opening
+    a new one each time. Every request's latency is recorded in `batches`.
+    """
+
+    def __init__(self, api_key, api_url, timeout):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.send_url = api_url.rstrip('/') + '/v3/mail/send'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SENDGRID_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Authorization': f'Bearer {api_key}'})
+        self.batches = deque(maxlen=SENDGRID_METRICS_SIZE)
+
+    def send(self, mail):
+        """
+        Send a Mail. Raises SendGridError unless SendGrid accepts it (2xx).
+        """
+        payload = mail.get()
+        recipients = sum(len(p.get('to', ())) for p in payload['personalizations'])
+        status_code = None
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.send_url, json=payload, timeout=self.timeout)
+            status_code = response.status_code
+        except requests.RequestException as e:
+            raise SendGridError(f"SendGrid request failed: {e}")
+        finally:
+            self.batches.append(BatchStats(recipients, time.perf_counter() - started, status_code))
+
+        if not 200 <= status_code < 300:
+            raise SendGridError(f"SendGrid responded with status code {status_code}: {response.text[:200]}",
+                                status_code)
+        return response
+
+    def latency_stats(self):
+        """
+        Summary of the recorded requests: count, recipients, and mean, p95 and
+        max latency in milliseconds. None if nothing has been sent.
+        """
+        batches = list(self.batches)
+        if not batches:
+            return None
+        latencies = sorted(batch.seconds * 1000 for batch in batches)
+        return {
+            'requests': len(batches),
+            'recipients': sum(batch.recipients for batch in batches),
+            'errors': sum(1 for batch in batches if batch.status_code is None or batch.status_code >= 300),
+            'mean_ms': sum(latencies) / len(latencies),
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'max_ms': latencies[-1],
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The process-wide SendGrid client, created on first use (and again if the
+    API key or URL settings change, e.g. when pointed at a local stub).
+    """
+    global _client
+    api_key = os.environ.get('SENDGRID_API_KEY') or settings.EMAIL_HOST_PASSWORD
+    api_url = settings.SENDGRID_API_URL
+    with _client_lock:
+        if _client is None or (_client.api_key, _client.api_url) != (api_key, api_url):
+            if _client is not None:
+                _client.close()
+            _client = SendGridClient(api_key, api_url, settings.SENDGRID_TIMEOUT)
+        return _client
+
+
+def latency_stats():
+    """Latency summary of this process's SendGrid requests (see SendGridClient.latency_stats)."""
+    return _client.latency_stats() if _client is not None else None
+
+
+def send_batch(subject, plain_content, html_content, recipients, from_email=None):
+    """
+    Send one message to many recipients, packing up to SENDGRID_BATCH_SIZE of
+    them into each request as separate personalizations (each recipient only
+    sees their own address).
+    
+    Args:
+        subject (str): Email subject
+        plain_content (str): Plain text body
+        html_content (str): HTML body, or empty for a plain text email
+        recipients (list): Email addresses, or (address, substitutions) pairs where
+            substitutions maps placeholder strings in the content to this recipient's values
+        from_email (str, optional): Sender. Defaults to settings.DEFAULT_FROM_EMAIL.
+    
+    Returns:
+        list: BatchStats of the requests made
+    """
+    client = get_client()
+    recipients = [(r, None) if isinstance(r, str) else r for r in recipients]
+    stats = []
+    for i in range(0, len(recipients), SENDGRID_BATCH_SIZE):
+        chunk = recipients[i:i + SENDGRID_BATCH_SIZE]
+        message = Mail(
+            from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+            to_emails=[To(address, substitutions=substitutions) for address, substitutions in chunk],
+            subject=subject,
+            plain_text_content=plain_content,
+            html_content=html_content or None,
+            is_multiple=True,
+        )
+        client.send(message)
+        stats.append(client.batches[-1])
+    return stats
 
 def send_email_with_sendgrid(to_email, subject, template_name, context=None):
     """
-    Send an email using SendGrid's API directly (not SMTP)
+    Queue an email for delivery through SendGrid's API directly (not SMTP).
+    The send_queued_emails worker makes the API call.
     
     Args:
         to_email (str): Recipient's email address
         subject (str): Email subject
-        template_name (str): Name of the template file in templates/emails/
+        template_name (str): Name of the template pair (.html and .txt) in templates/emails/
         context (dict): Context data for the template
     
     Returns:
-        bool: True if successful, False if failed
+        bool: True if queued, False if failed
     """
     if context is None:
         context = {}
-        
-    # Get API key from settings or environment
-    api_key = os.environ.get('SENDGRID_API_KEY') or settings.EMAIL_HOST_PASSWORD
-    
-    # Get from email from settings
-    from_email = settings.DEFAULT_FROM_EMAIL
     
     try:
         # Render email content from template
-        html_content = render_to_string(f'emails/{template_name}.html', context)
-        plain_content = strip_tags(html_content)
-        
-        # Create SendGrid client
-        sg = sendgrid.SendGridAPIClient(api_key=api_key)
+        plain_content, html_content = render_email(template_name, context)
         
-        # Create mail object
-        message = Mail(
-            from_email=from_email,
-            to_emails=to_email,
+        # Queue email for the worker
+        enqueue_email(
             subject=subject,
-            plain_text_content=plain_content,
-            html_content=html_content
+            body=plain_content,
+            recipient_list=[to_email],
+            html_body=html_content,
+            transport='SENDGRID',
         )
+        return True
         
-        # Send email
-        response = sg.send(message)
-        
-        # Log response
-        print(f"SendGrid response status code: {response.status_code}")
-        
-        # Return True if successful (2xx status code)
-        return 200 <= response.status_code < 300
-        
-    except Exception as e:
-        print(f"Error sending email via SendGrid API: {str(e)}")
+    except Exception:
+        logger.exception("Error queueing email for SendGrid")
         return False
 
+def deliver_with_sendgrid(emails):
+    """
+    Send queued EmailOutbox rows through SendGrid's API. Rows with the same
+    content go out together in one request per SENDGRID_BATCH_SIZE recipients.
+    Yields (email, error) pairs; error is None for a delivered row. Any error
+    in a request fails just that request's rows, which deliver_batch retries;
+    a request rejected with a 4xx is split in halves first, so one invalid
+    address fails only its own row.
+    """
+    groups = {}
+    for email in emails:
+        groups.setdefault((email.from_email, email.subject, email.body, email.html_body), []).append(email)
+
+    for (from_email, subject, body, html_body), rows in groups.items():
+        # Never split a row's recipients across requests, so each row succeeds or fails as a whole
+        batches, size = [[]], 0
+        for row in rows:
+            if batches[-1] and size + len(row.recipients) > SENDGRID_BATCH_SIZE:
+                batches.append([])
+                size = 0
+            batches[-1].append(row)
+            size += len(row.recipients)
+
+        for batch in batches:
+            yield from _send_rows(batch, subject, body, html_body, from_email)
+
+def _send_rows(rows, subject, body, html_body, from_email):
+    """Send rows with the same content in one request; see deliver_with_sendgrid."""
+    try:
+        send_batch(subject, body, html_body, [address for row in rows for address in row.recipients], from_email)
+    except SendGridError as e:
+        if len(rows) > 1 and e.status_code is not None and 400 <= e.status_code < 500 \
+                and e.status_code not in SENDGRID_WHOLE_REQUEST_ERRORS:
+            # Bisect until the rejected recipient's row is on its own
+            middle = len(rows) // 2
+            yield from _send_rows(rows[:middle], subject, body, html_body, from_email)
+            yield from _send_rows(rows[middle:], subject, body, html_body, from_email)
+            return
+        logger.exception("SendGrid request for emails %s failed", [row.pk for row in rows])
+        yield from ((row, e) for row in rows)
+    except Exception as e:
+        logger.exception("SendGrid request for emails %s failed", [row.pk for row in rows])
+        yield from ((row, e) for row in rows)
+    else:
+        yield from ((row, None) for row in rows)
+
 def send_test_email(to_email):
     """Send a test email using the SendGrid API"""
     from datetime import datetime
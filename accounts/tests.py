@@ -1,3 +1,145 @@
-from django.test import TestCase
+import contextlib
+import io
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import sendgrid_utils
+from .mail_backends import FakeEmailBackend
+from .models import EmailOutbox
+from .outbox import enqueue_email, process_outbox
+from .sendgrid_stub import SendGridStub
+from .utils import send_otp_email, send_templated_email
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+    """A backend whose mail server cannot be reached."""
+
+    def open(self):
+        raise ConnectionRefusedError('Connection refused')
+
+    def send_messages(self, email_messages):
+        raise AssertionError('Nothing can be sent without a connection')
+
+
+@override_settings(EMAIL_OUTBOX_BACKEND='accounts.mail_backends.FakeEmailBackend',
+                   EMAIL_FAKE_FAIL_RECIPIENTS=['refused@example.com'], EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+class EmailOutboxTests(TestCase):
+
+    def setUp(self):
+        FakeEmailBackend.sent.clear()
+
+    def deliver(self):
+        # The fake backend echoes messages to the console
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process_outbox()
+
+    def test_emails_are_queued_not_sent(self):
+        send_otp_email('rider@example.com', 'REGISTRATION')
+
+        self.assertEqual(EmailOutbox.objects.filter(status='PENDING').count(), 1)
+        self.assertEqual(FakeEmailBackend.sent, [])
+
+    def test_templated_email_without_template_is_not_queued(self):
+        self.assertTrue(send_templated_email('Test', 'test', {}, ['rider@example.com']))
+        with self.assertLogs('accounts', 'ERROR'):
+            self.assertFalse(send_templated_email('Missing', 'no_such_template', {}, ['rider@example.com']))
+        self.assertEqual(list(EmailOutbox.objects.values_list('subject', flat=True)), ['Test'])
+
+    def test_worker_delivers_and_retries_with_backoff(self):
+        enqueue_email('Welcome', 'Hello', ['rider@example.com'])
+        refused = enqueue_email('Welcome', 'Hello', ['refused@example.com'])
+
+        self.assertEqual(self.deliver(), (1, 1, 0))
+        self.assertEqual([message.to for message in FakeEmailBackend.sent], [['rider@example.com']])
+        refused.refresh_from_db()
+        self.assertEqual((refused.status, refused.attempts), ('PENDING', 1))
+        self.assertGreater(refused.next_attempt_at, timezone.now())
+
+        # Not due again until the backoff has passed
+        self.assertEqual(self.deliver(), (0, 0, 0))
+
+        EmailOutbox.objects.filter(pk=refused.pk).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.deliver(), (0, 0, 1))
+        refused.refresh_from_db()
+        self.assertEqual(refused.status, 'FAILED')
+        self.assertIn('refused@example.com', refused.last_error)
+
+    @override_settings(EMAIL_OUTBOX_BACKEND='accounts.tests.UnreachableEmailBackend')
+    def test_unreachable_server_backs_off(self):
+        emails = [enqueue_email('Welcome', 'Hello', [f'rider{i}@example.com']) for i in range(2)]
+
+        with self.assertLogs('accounts', 'WARNING'):
+            self.assertEqual(process_outbox(), (0, 2, 0))
+        for email in emails:
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), ('PENDING', 1, 'Connection refused'))
+            self.assertGreater(email.next_attempt_at, timezone.now())
+
+
+class SendGridDeliveryTests(TestCase):
+    """Outbox delivery through the SendGrid API, against the local stub."""
+
+    def setUp(self):
+        self.stub = SendGridStub().start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+        settings = override_settings(SENDGRID_API_URL=self.stub.url, EMAIL_HOST_PASSWORD='test-key',
+                                     EMAIL_OUTBOX_BACKEND='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_same_content_goes_out_in_one_pooled_request(self):
+        for i in range(5):
+            enqueue_email('Bus cancelled', 'Sorry', [f'rider{i}@example.com'], '<p>Sorry</p>', transport='SENDGRID')
+        enqueue_email('Welcome', 'Hello', ['a@example.com', 'b@example.com'], transport='SENDGRID')
+
+        self.assertEqual(process_outbox(), (6, 0, 0))
+        self.assertEqual(len(self.stub.requests), 2)
+        cancelled = next(request for request in self.stub.requests if request['subject'] == 'Bus cancelled')
+        self.assertEqual(len(cancelled['personalizations']), 5)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_rejected_request_is_retried(self):
+        self.stub.fail_rate = 1
+        email = enqueue_email('Welcome', 'Hello', ['rider@example.com'], transport='SENDGRID')
+
+        with self.assertLogs('accounts', 'ERROR'):
+            self.assertEqual(process_outbox(), (0, 1, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('PENDING', 1))
+        self.assertIn('503', email.last_error)
+
+    def test_invalid_address_fails_only_its_row(self):
+        self.stub.reject_addresses = {'invalid@example.com'}
+        addresses = ['rider0@example.com', 'rider1@example.com', 'invalid@example.com', 'rider3@example.com',
+                     'rider4@example.com']
+        emails = [enqueue_email('Bus cancelled', 'Sorry', [address], transport='SENDGRID') for address in addresses]
+
+        with self.assertLogs('accounts', 'ERROR'):
+            self.assertEqual(process_outbox(), (4, 1, 0))
+        statuses = dict(EmailOutbox.objects.filter(pk__in=[email.pk for email in emails])
+                        .values_list('recipients__0', 'status'))
+        self.assertEqual(statuses, {address: 'PENDING' if address == 'invalid@example.com' else 'SENT'
+                                    for address in addresses})
+        self.assertIn('400', EmailOutbox.objects.get(status='PENDING').last_error)
+
+    def test_unexpected_error_fails_only_its_batch(self):
+        email = enqueue_email('Welcome', 'Hello', ['rider@example.com'], transport='SENDGRID')
+        other = enqueue_email('Receipt', 'Paid', ['rider@example.com'], transport='SENDGRID')
+        real_send_batch = sendgrid_utils.send_batch
+
+        def send_batch(subject, *args, **kwargs):
+            if subject == 'Welcome':
+                raise ValueError('malformed payload')
+            return real_send_batch(subject, *args, **kwargs)
+
+        with mock.patch.object(sendgrid_utils, 'send_batch', send_batch), self.assertLogs('accounts', 'ERROR'):
+            self.assertEqual(process_outbox(), (1, 1, 0))
+        email.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), ('PENDING', 1, 'malformed payload'))
+        self.assertEqual(other.status, 'SENT')
@@ -1,15 +1,19 @@
-from django.core.mail import send_mail, EmailMultiAlternatives
+import logging
+
 from django.conf import settings
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from .models import OTP
+from .emails import EmailCampaign, render_email
+from .models import EmailOutbox, OTP
+from .otp_store import issue_otp
+from .outbox import enqueue_email
+
+logger = logging.getLogger(__name__)
 
 def send_otp_email(email, action, user=None, expiry_minutes=10):
     """
-    Generate and send an OTP code via email
+    Generate an OTP code and queue it for email delivery
     """
     # Generate OTP
-    otp = OTP.generate_otp(email, action, user, expiry_minutes)
+    code = issue_otp(email, action, user, expiry_minutes)
     
     # Prepare email content
     action_readable = dict(OTP.ACTION_CHOICES).get(action, action)
@@ -17,67 +21,89 @@ def send_otp_email(email, action, user=None, expiry_minutes=10):
     
     # Create context for email template
     context = {
-        'otp': otp.code,
+        'otp': code,
+        'code': code,
         'action': action_readable,
         'expiry_minutes': expiry_minutes,
         'user': user,
     }
     
     # Render email templates
-    html_message = render_to_string('emails/otp_email.html', context)
-    plain_message = strip_tags(html_message)
+    plain_message, html_message = render_email('otp_email', context)
     
-    # Send email
-    return send_mail(
+    # Queue email (delivered by the send_queued_emails worker)
+    return enqueue_email(
         subject=subject,
-        message=plain_message,
-        from_email=settings.DEFAULT_FROM_EMAIL or 'noreply@busbliss.com',
+        body=plain_message,
         recipient_list=[email],
-        html_message=html_message,
-        fail_silently=False,
+        html_body=html_message,
+        from_email=settings.DEFAULT_FROM_EMAIL or 'noreply@busbliss.com',
     )
 
 def send_templated_email(subject, template_name, context, recipient_list, from_email=None):
     """
-    Send an email using an HTML template with SendGrid.
+    Queue an email rendered from an HTML template. The send_queued_emails
+    worker delivers it through the configured email backend.
     
     Args:
         subject (str): Email subject
-        template_name (str): Path to the email template (without .html extension)
+        template_name (str): Name of the template pair in templates/emails/ (without .html/.txt extension)
         context (dict): Context data for the template
         recipient_list (list): List of email addresses to send to
         from_email (str, optional): Sender email address. Defaults to settings.DEFAULT_FROM_EMAIL.
     
     Returns:
-        bool: True if email was sent successfully, False otherwise
+        bool: True if the email was queued, False otherwise
     """
     if from_email is None:
         from_email = settings.DEFAULT_FROM_EMAIL
     
-    # Render HTML content
-    html_content = render_to_string(f'emails/{template_name}.html', context)
-    
-    # Create plain text version
-    text_content = strip_tags(html_content)
-    
-    # Create email message
-    email = EmailMultiAlternatives(
-        subject=subject,
-        body=text_content,
-        from_email=from_email,
-        to=recipient_list
-    )
-    
-    # Attach HTML content
-    email.attach_alternative(html_content, "text/html")
-    
     try:
-        # Send email
-        return email.send() > 0
-    except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        # Render HTML content and its plain text version
+        text_content, html_content = render_email(template_name, context)
+        
+        # Queue email
+        enqueue_email(
+            subject=subject,
+            body=text_content,
+            recipient_list=recipient_list,
+            html_body=html_content,
+            from_email=from_email,
+        )
+        return True
+    except Exception:
+        logger.exception("Error queueing email %r to %s", subject, recipient_list)
         return False
 
+def send_bulk_templated_email(subject, template_name, context, recipients, personal_fields, from_email=None):
+    """
+    Queue one email to many recipients whose copies differ only in a few values.
+    The templates are rendered once for the whole batch (see EmailCampaign).
+    
+    Args:
+        subject (str): Email subject
+        template_name (str): Name of the template pair in templates/emails/
+        context (dict): Context shared by every recipient
+        recipients (list): (email address, {personal field: value}) pairs
+        personal_fields (list): Context names that differ per recipient
+        from_email (str, optional): Sender email address. Defaults to settings.DEFAULT_FROM_EMAIL.
+    
+    Returns:
+        int: Number of emails queued
+    """
+    campaign = EmailCampaign(template_name, context, personal_fields)
+    emails = []
+    for address, values in recipients:
+        text_content, html_content = campaign.render_for(values)
+        emails.append(EmailOutbox(
+            from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+            recipients=[address],
+            subject=subject,
+            body=text_content,
+            html_body=html_content,
+        ))
+    return len(EmailOutbox.objects.bulk_create(emails))
+
 def send_welcome_email(user):
     """Send a welcome email to a new user"""
     context = {
@@ -21,6 +21,7 @@ from .forms import (
 )
 from .models import User, OTP
 from .utils import send_otp_email
+from .ratelimit import ratelimit
 
 class RegisterView(CreateView):
     """
@@ -125,6 +126,7 @@ class VerifyRegistrationOTPView(FormView):
         return redirect('dashboard')
 
 
+@ratelimit('resend_registration_otp')
 @require_http_methods(["GET", "POST"])
 def resend_registration_otp(request):
     """
@@ -1,11 +1,64 @@
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
-from django.http import HttpResponse
-import xlsxwriter
-import io
-from datetime import datetime
+from django.http import FileResponse, Http404
+from django.urls import path, reverse
+from django.utils.html import format_html
+import os
 
-from .models import Route, RouteStop, RouteSegment, Bus, Passenger, Ticket, Wallet, Transaction, MultiStopBus, MultiStopTicket, MultiStopRoute
+from .models import City, CityAlias, Route, RouteStop, RouteSegment, Bus, Passenger, Ticket, Wallet, Transaction, MultiStopBus, MultiStopTicket, MultiStopRoute, WalletSnapshot, SeatHold, CancellationJob, BookingExport
+from .cancellations import start_bus_cancellation
+from .exports import (
+    csv_response, export_file_name, export_path, needs_background_export, start_export,
+    xlsx_response,
+)
+from .services import sync_passenger_counts
+
+
+def cancel_and_refund_buses(modeladmin, request, queryset):
+    """
+    Deactivate the selected buses and queue cancellation jobs refunding their
+    bookings, which the run_cancellation_jobs worker runs.
+    """
+    jobs = [start_bus_cancellation(bus, requested_by=request.user) for bus in queryset.filter(is_active=True)]
+    modeladmin.message_user(request, _("Queued %(count)s cancellation jobs; see Cancellation jobs for progress.")
+                            % {'count': len(jobs)})
+cancel_and_refund_buses.short_description = _("Cancel selected buses and refund bookings")
+
+
+def _export_bookings(modeladmin, request, queryset, export_format):
+    """
+    Stream an export of the selected buses' bookings, or queue a background
+    export for run_booking_exports when the selection is too large to build
+    during the request.
+    """
+    if needs_background_export(queryset):
+        start_export(queryset, export_format, requested_by=request.user)
+        modeladmin.message_user(request, _("This export is large and has been queued; "
+                                           "download it from Booking exports when it is ready."))
+        return None
+
+    is_multi_stop = queryset.model is MultiStopBus
+    buses = queryset.order_by('departure_time', 'pk')
+    file_name = export_file_name('multistop_bus_bookings' if is_multi_stop else 'bus_bookings', export_format)
+    if export_format == 'CSV':
+        return csv_response(buses, is_multi_stop, file_name)
+    return xlsx_response(buses, is_multi_stop, file_name)
+
+
+def export_bookings_to_excel(modeladmin, request, queryset):
+    """
+    Export all bookings for selected buses to Excel.
+    """
+    return _export_bookings(modeladmin, request, queryset, 'XLSX')
+export_bookings_to_excel.short_description = _("Export bookings to Excel")
+
+
+def export_bookings_to_csv(modeladmin, request, queryset):
+    """
+    Export all bookings for selected buses to CSV.
+    """
+    return _export_bookings(modeladmin, request, queryset, 'CSV')
+export_bookings_to_csv.short_description = _("Export bookings to CSV")
 
 
 class RouteStopInline(admin.TabularInline):
@@ -26,6 +79,25 @@ class RouteSegmentInline(admin.TabularInline):
     fields = ('start_stop', 'end_stop', 'distance', 'duration', 'base_fare_multiplier')
 
 
+class CityAliasInline(admin.TabularInline):
+    """
+    Inline admin for CityAlias model within City admin.
+    """
+    model = CityAlias
+    extra = 1
+    fields = ('alias',)
+
+
+@admin.register(City)
+class CityAdmin(admin.ModelAdmin):
+    """
+    Admin interface for City model.
+    """
+    list_display = ('name', 'normalized_name')
+    search_fields = ('name', 'aliases__alias')
+    inlines = [CityAliasInline]
+
+
 @admin.register(Route)
 class RouteAdmin(admin.ModelAdmin):
     """
@@ -97,82 +169,7 @@ class BusAdmin(admin.ModelAdmin):
         }),
     )
 
-    actions = ['export_bookings_to_excel']
-
-    def export_bookings_to_excel(self, request, queryset):
-        """
-        Export all bookings for selected buses to Excel.
-        """
-        # Create a file-like buffer to receive Excel data
-        output = io.BytesIO()
-        
-        # Create workbook and add a worksheet
-        workbook = xlsxwriter.Workbook(output)
-        
-        # Add a bold format for headers
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
-        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
-        
-        for bus in queryset:
-            # Create worksheet for each bus
-            worksheet = workbook.add_worksheet(f"Bus {bus.bus_number[:15]}")
-            
-            # Write header row
-            headers = [
-                'Ticket ID', 
-                'Booking Time', 
-                'User Email', 
-                'Passenger Name', 
-                'Passenger Age', 
-                'Passenger Gender',
-                'Passenger ID', 
-                'Passenger Phone', 
-                'Seat Numbers', 
-                'Seat Class', 
-                'Total Fare', 
-                'Status'
-            ]
-            
-            for col_num, header in enumerate(headers):
-                worksheet.write(0, col_num, header, header_format)
-            
-            # Get all tickets for this bus
-            tickets = Ticket.objects.filter(bus=bus)
-            
-            # Data rows
-            row_num = 1
-            for ticket in tickets:
-                for passenger in ticket.passengers.all():
-                    worksheet.write(row_num, 0, f"#{ticket.id}")
-                    worksheet.write_datetime(row_num, 1, ticket.booking_time, date_format)
-                    worksheet.write(row_num, 2, ticket.user.email)
-                    worksheet.write(row_num, 3, passenger.name)
-                    worksheet.write(row_num, 4, passenger.age)
-                    worksheet.write(row_num, 5, passenger.get_gender_display())
-                    worksheet.write(row_num, 6, passenger.id_number or 'N/A')
-                    worksheet.write(row_num, 7, passenger.phone or 'N/A')
-                    worksheet.write(row_num, 8, ticket.seat_numbers)
-                    worksheet.write(row_num, 9, ticket.get_seat_class_display())
-                    worksheet.write(row_num, 10, float(ticket.total_fare))
-                    worksheet.write(row_num, 11, ticket.get_status_display())
-                    row_num += 1
-            
-            # Auto-adjust columns' width
-            for col_num, _ in enumerate(headers):
-                worksheet.set_column(col_num, col_num, 15)
-        
-        workbook.close()
-        
-        # Set up response
-        response = HttpResponse(
-            output.getvalue(),
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        response['Content-Disposition'] = f'attachment; filename="bus_bookings_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx"'
-        
-        return response
-    
-    export_bookings_to_excel.short_description = _("Export bookings to Excel")
+    actions = [export_bookings_to_excel, export_bookings_to_csv, cancel_and_refund_buses]
 
 
 class PassengerInline(admin.TabularInline):
@@ -199,7 +196,7 @@ class TransactionInline(admin.TabularInline):
     """
     model = Transaction
     extra = 0
-    readonly_fields = ('transaction_type', 'amount', 'description', 'timestamp', 'related_ticket')
+    readonly_fields = ('transaction_type', 'amount', 'balance_after', 'description', 'timestamp', 'related_ticket')
     can_delete = False
     
     def has_add_permission(self, request, obj=None):
@@ -213,7 +210,8 @@ class WalletAdmin(admin.ModelAdmin):
     """
     list_display = ('user', 'balance', 'created_at', 'updated_at')
     search_fields = ('user__email', 'user__full_name')
-    readonly_fields = ('created_at', 'updated_at')
+    # Balance only changes through ledger entries (deposit / withdraw)
+    readonly_fields = ('balance', 'created_at', 'updated_at')
     inlines = [TransactionInline]
     
     fieldsets = (
@@ -245,7 +243,8 @@ class TransactionAdmin(admin.ModelAdmin):
     list_filter = ('transaction_type', 'timestamp')
     search_fields = ('wallet__user__email', 'description')
     date_hierarchy = 'timestamp'
-    readonly_fields = ('wallet', 'transaction_type', 'amount', 'description', 'timestamp', 'related_ticket')
+    readonly_fields = ('wallet', 'transaction_type', 'amount', 'balance_after', 'description', 'timestamp',
+                       'related_ticket')
     
     def has_add_permission(self, request):
         return False
@@ -255,7 +254,7 @@ class TransactionAdmin(admin.ModelAdmin):
     
     fieldsets = (
         (None, {
-            'fields': ('wallet', 'transaction_type', 'amount')
+            'fields': ('wallet', 'transaction_type', 'amount', 'balance_after')
         }),
         (_('Details'), {
             'fields': ('description', 'timestamp', 'related_ticket')
@@ -263,6 +262,101 @@ class TransactionAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(WalletSnapshot)
+class WalletSnapshotAdmin(admin.ModelAdmin):
+    """
+    Read-only admin for wallet balance snapshots.
+    """
+    list_display = ('wallet', 'balance', 'last_transaction', 'taken_at')
+    search_fields = ('wallet__user__email',)
+    date_hierarchy = 'taken_at'
+    readonly_fields = ('wallet', 'balance', 'last_transaction', 'taken_at')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SeatHold)
+class SeatHoldAdmin(admin.ModelAdmin):
+    """
+    Read-only admin for checkout seat holds.
+    """
+    list_display = ('user', 'bus', 'multistop_bus', 'seat_no', 'start_seq', 'end_seq', 'expires_at')
+    list_filter = ('expires_at',)
+    search_fields = ('user__email', 'bus__bus_number', 'multistop_bus__bus_number')
+    readonly_fields = ('user', 'bus', 'multistop_bus', 'seat_no', 'start_seq', 'end_seq', 'expires_at', 'created_at')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(CancellationJob)
+class CancellationJobAdmin(admin.ModelAdmin):
+    """
+    Read-only admin showing the progress of bulk bus cancellations.
+    """
+    list_display = ('id', 'target_bus', 'status', 'progress_display', 'processed_tickets', 'total_tickets',
+                    'refunded_amount', 'requested_by', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('bus__bus_number', 'multistop_bus__bus_number')
+    readonly_fields = ('bus', 'multistop_bus', 'requested_by', 'status', 'refund_percent', 'total_tickets',
+                       'processed_tickets', 'refunded_amount', 'last_ticket_id', 'error', 'created_at',
+                       'started_at', 'finished_at')
+    
+    def progress_display(self, obj):
+        return f"{obj.progress}%"
+    progress_display.short_description = _('Progress')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BookingExport)
+class BookingExportAdmin(admin.ModelAdmin):
+    """
+    Read-only admin listing background booking exports, with download links.
+    """
+    list_display = ('id', 'format', 'is_multi_stop', 'status', 'rows', 'requested_by', 'created_at',
+                    'finished_at', 'download_link')
+    list_filter = ('status', 'format', 'created_at')
+    readonly_fields = ('format', 'is_multi_stop', 'bus_ids', 'requested_by', 'status', 'rows', 'file_name',
+                       'error', 'created_at', 'finished_at')
+    
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/', self.admin_site.admin_view(self.download),
+                 name='booking_bookingexport_download'),
+        ] + super().get_urls()
+    
+    def download(self, request, pk):
+        export = BookingExport.objects.filter(pk=pk, status='COMPLETED').first()
+        if not self.has_view_permission(request, export) or export is None or not os.path.exists(export_path(export)):
+            raise Http404(_("Export not found."))
+        return FileResponse(open(export_path(export), 'rb'), as_attachment=True, filename=export.file_name)
+    
+    def download_link(self, obj):
+        if obj.status != 'COMPLETED':
+            return '-'
+        return format_html('<a href="{}">{}</a>', reverse('admin:booking_bookingexport_download', args=[obj.pk]),
+                           _('Download'))
+    download_link.short_description = _('File')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Ticket)
 class TicketAdmin(admin.ModelAdmin):
     """
@@ -290,9 +384,10 @@ class TicketAdmin(admin.ModelAdmin):
         self.message_user(request, _("%s tickets have been marked as completed.") % updated)
     mark_as_completed.short_description = _("Mark selected tickets as completed")
     
-    def passenger_count(self, obj):
-        return obj.passengers.count()
-    passenger_count.short_description = _("Number of passengers")
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # The passenger inline writes through rows directly, which sends no m2m_changed
+        sync_passenger_counts(type(form.instance), [form.instance.pk])
 
 
 @admin.register(MultiStopBus)
@@ -307,86 +402,7 @@ class MultiStopBusAdmin(admin.ModelAdmin):
     date_hierarchy = 'departure_time'
     list_editable = ('fare', 'is_active')
     
-    actions = ['export_bookings_to_excel']
-    
-    def export_bookings_to_excel(self, request, queryset):
-        """
-        Export all bookings for selected multi-stop buses to Excel.
-        """
-        # Create a file-like buffer to receive Excel data
-        output = io.BytesIO()
-        
-        # Create workbook and add a worksheet
-        workbook = xlsxwriter.Workbook(output)
-        
-        # Add a bold format for headers
-        header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
-        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
-        
-        for bus in queryset:
-            # Create worksheet for each bus
-            worksheet = workbook.add_worksheet(f"Bus {bus.bus_number[:15]}")
-            
-            # Write header row
-            headers = [
-                'Ticket ID', 
-                'Booking Time', 
-                'User Email', 
-                'From', 
-                'To', 
-                'Passenger Name', 
-                'Passenger Age', 
-                'Passenger Gender',
-                'Passenger ID', 
-                'Passenger Phone', 
-                'Seat Numbers', 
-                'Seat Class', 
-                'Total Fare', 
-                'Status'
-            ]
-            
-            for col_num, header in enumerate(headers):
-                worksheet.write(0, col_num, header, header_format)
-            
-            # Get all tickets for this bus
-            tickets = MultiStopTicket.objects.filter(bus=bus)
-            
-            # Data rows
-            row_num = 1
-            for ticket in tickets:
-                for passenger in ticket.passengers.all():
-                    worksheet.write(row_num, 0, f"#{ticket.id}")
-                    worksheet.write_datetime(row_num, 1, ticket.booking_time, date_format)
-                    worksheet.write(row_num, 2, ticket.user.email)
-                    worksheet.write(row_num, 3, ticket.start_stop.city)
-                    worksheet.write(row_num, 4, ticket.end_stop.city)
-                    worksheet.write(row_num, 5, passenger.name)
-                    worksheet.write(row_num, 6, passenger.age)
-                    worksheet.write(row_num, 7, passenger.get_gender_display())
-                    worksheet.write(row_num, 8, passenger.id_number or 'N/A')
-                    worksheet.write(row_num, 9, passenger.phone or 'N/A')
-                    worksheet.write(row_num, 10, ticket.seat_numbers)
-                    worksheet.write(row_num, 11, ticket.get_seat_class_display())
-                    worksheet.write(row_num, 12, float(ticket.total_fare))
-                    worksheet.write(row_num, 13, ticket.get_status_display())
-                    row_num += 1
-            
-            # Auto-adjust columns' width
-            for col_num, _ in enumerate(headers):
-                worksheet.set_column(col_num, col_num, 15)
-        
-        workbook.close()
-        
-        # Set up response
-        response = HttpResponse(
-            output.getvalue(),
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        response['Content-Disposition'] = f'attachment; filename="multistop_bus_bookings_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx"'
-        
-        return response
-    
-    export_bookings_to_excel.short_description = _("Export bookings to Excel")
+    actions = [export_bookings_to_excel, export_bookings_to_csv, cancel_and_refund_buses]
 
 
 @admin.register(MultiStopRoute)
@@ -450,6 +466,7 @@ class MultiStopTicketAdmin(admin.ModelAdmin):
         self.message_user(request, _("%s tickets have been marked as completed.") % updated)
     mark_as_completed.short_description = _("Mark selected tickets as completed")
     
-    def passenger_count(self, obj):
-        return obj.passengers.count()
-    passenger_count.short_description = _("Number of passengers")
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # The passenger inline writes through rows directly, which sends no m2m_changed
+        sync_passenger_counts(type(form.instance), [form.instance.pk])
@@ -0,0 +1,220 @@
+"""
+Bulk bus cancellation with refunds.
+
+Cancelling a bus creates a CancellationJob that works through the bus's
+booked tickets in id-ordered batches. Each batch is one transaction with a
+fixed number of queries, whatever its size:
+
+- one UPDATE marks the batch's tickets cancelled,
+- one DELETE frees their seat allocations, followed by one bitmap rebuild,
+- one UPDATE returns the seats to the bus counter,
+- one UPDATE credits every affected wallet (a CASE over wallet ids),
+- one bulk INSERT writes the REFUND ledger rows, and
+- one SELECT of the passengers and one bulk INSERT queue a notice to each,
+  rendered once for the whole batch (accounts.utils.send_bulk_templated_email).
+
+The job's progress and resume point are saved in the same transaction, so a
+job stopped part-way (worker restart, error) resumes with the next batch.
+Requests only queue jobs; the run_cancellation_jobs worker runs them, outside
+the web process.
+"""
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+
+from accounts.utils import send_bulk_templated_email
+
+from .models import CancellationJob, MultiStopTicket, SeatAllocation, Ticket, Transaction, Wallet
+from .occupancy import build_bitmap, get_stop_sequences, is_multi_stop_bus, load_occupancy, store_bitmap
+from .services import return_seat_count
+
+logger = logging.getLogger(__name__)
+
+CANCELLATION_BATCH_SIZE = 500
+
+# Jobs that still have work to do
+UNFINISHED_STATUSES = ('PENDING', 'RUNNING', 'FAILED')
+
+
+def _ticket_model(bus):
+    return MultiStopTicket if is_multi_stop_bus(bus) else Ticket
+
+
+def _job_lookup(bus):
+    if is_multi_stop_bus(bus):
+        return {'multistop_bus': bus}
+    return {'bus': bus}
+
+
+def start_bus_cancellation(bus, requested_by=None, refund_percent=Decimal('100.00')):
+    """
+    Deactivate a bus and queue a job refunding all its booked tickets. Returns
+    the job; an unfinished job already queued for the bus is returned instead
+    of a new one.
+    """
+    with transaction.atomic():
+        job = CancellationJob.objects.filter(**_job_lookup(bus), status__in=UNFINISHED_STATUSES).first()
+        if job:
+            return job
+
+        # Stop new bookings before counting the tickets to refund
+        bus.is_active = False
+        bus.save(update_fields=['is_active'])
+
+        return CancellationJob.objects.create(
+            **_job_lookup(bus),
+            requested_by=requested_by,
+            refund_percent=refund_percent,
+            total_tickets=_ticket_model(bus).objects.filter(bus=bus, status='BOOKED').count(),
+        )
+
+
+def _refund_amount(ticket_fare, refund_percent):
+    return (ticket_fare * refund_percent / Decimal('100')).quantize(Decimal('0.01'))
+
+
+def _credit_wallets(tickets, refunds, ticket_field, description):
+    """
+    Credit each ticket's refund to its owner's wallet with one UPDATE and write
+    the REFUND ledger rows with one INSERT. `tickets` are (id, user_id) pairs;
+    `ticket_field` is the ledger column linking the ticket and `description`
+    a format string taking the ticket id.
+    """
+    user_ids = {user_id for _pk, user_id in tickets}
+    wallets = dict(Wallet.objects.filter(user_id__in=user_ids).values_list('user_id', 'id'))
+    missing = user_ids - set(wallets)
+    if missing:
+        # Users without a wallet get one, as Ticket.cancel does
+        Wallet.objects.bulk_create([Wallet(user_id=user_id) for user_id in missing])
+        wallets.update(Wallet.objects.filter(user_id__in=missing).values_list('user_id', 'id'))
+
+    totals = defaultdict(Decimal)
+    for pk, user_id in tickets:
+        totals[wallets[user_id]] += refunds[pk]
+    totals = {wallet_id: total for wallet_id, total in totals.items() if total > 0}
+    if not totals:
+        return
+
+    # Aggregated F() update: each wallet gains the sum of its refunds in this batch
+    Wallet.objects.filter(pk__in=totals).update(
+        balance=F('balance') + Case(
+            *[When(pk=wallet_id, then=Value(total)) for wallet_id, total in totals.items()],
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        ),
+        updated_at=timezone.now(),
+    )
+
+    # Work back from the new balances to each ledger row's balance_after
+    running = {
+        wallet_id: balance - totals[wallet_id]
+        for wallet_id, balance in Wallet.objects.filter(pk__in=totals).values_list('id', 'balance')
+    }
+    entries = []
+    for pk, user_id in tickets:
+        amount = refunds[pk]
+        if amount <= 0:
+            continue
+        wallet_id = wallets[user_id]
+        running[wallet_id] += amount
+        entries.append(Transaction(
+            wallet_id=wallet_id,
+            amount=amount,
+            transaction_type='REFUND',
+            description=description.format(ticket_id=pk),
+            balance_after=running[wallet_id],
+            **{ticket_field: pk},
+        ))
+    Transaction.objects.bulk_create(entries)
+
+
+def _notify_passengers(bus, tickets, refunds, refund_percent):
+    """Queue a cancellation notice for each of `tickets` ((ticket id, user id) pairs)."""
+    users = get_user_model().objects.in_bulk({user_id for _pk, user_id in tickets})
+    send_bulk_templated_email(
+        subject=f'DVM Bus Manager - Bus {bus.bus_number} Cancelled',
+        template_name='bus_cancellation',
+        context={'bus': bus, 'route': str(bus.route), 'refund_percent': refund_percent,
+                 'site_name': 'DVM Bus Manager'},
+        recipients=[
+            (users[user_id].email, {'full_name': users[user_id].full_name, 'ticket_id': pk,
+                                    'refund_amount': refunds[pk]})
+            for pk, user_id in tickets
+        ],
+        personal_fields=['full_name', 'ticket_id', 'refund_amount'],
+    )
+
+
+def process_batch(job, batch_size=CANCELLATION_BATCH_SIZE):
+    """
+    Cancel and refund the next batch of the job's tickets. Returns the number
+    of tickets in the batch (0 when the job has nothing left to do).
+    """
+    with transaction.atomic():
+        # Lock the job row: concurrent runners of one job take turns, batch by batch
+        job = CancellationJob.objects.select_for_update().get(pk=job.pk)
+        bus = job.target_bus
+        model = _ticket_model(bus)
+        multi_stop = model is MultiStopTicket
+
+        batch = list(model.objects.select_for_update().filter(
+            bus=bus, status='BOOKED', pk__gt=job.last_ticket_id,
+        ).order_by('pk').values_list('pk', 'user_id', 'total_fare', 'passenger_count')[:batch_size])
+        if not batch:
+            return 0
+
+        pks = [pk for pk, _user_id, _fare, _count in batch]
+        refunds = {pk: _refund_amount(fare, job.refund_percent) for pk, _user_id, fare, _count in batch}
+
+        model.objects.filter(pk__in=pks).update(status='CANCELLED')
+
+        # Free the seats: drop the allocations, then rebuild the bitmap once
+        ticket_lookup = 'multistop_ticket_id__in' if multi_stop else 'ticket_id__in'
+        SeatAllocation.objects.filter(**{ticket_lookup: pks}).delete()
+        sequences = get_stop_sequences(bus)
+        occupancy, _bitmap = load_occupancy(bus, sequences, for_update=True)
+        store_bitmap(occupancy, build_bitmap(bus, sequences))
+        return_seat_count(bus, sum(count for _pk, _user_id, _fare, count in batch))
+
+        _credit_wallets(
+            [(pk, user_id) for pk, user_id, _fare, _count in batch],
+            refunds,
+            'related_multistop_ticket_id' if multi_stop else 'related_ticket_id',
+            f"Refund for cancelled ticket #{{ticket_id}} - {bus.bus_number} (bus cancelled)",
+        )
+        # Queued in the batch's transaction, so notices go out exactly for committed refunds
+        _notify_passengers(bus, [(pk, user_id) for pk, user_id, _fare, _count in batch], refunds,
+                           job.refund_percent)
+
+        CancellationJob.objects.filter(pk=job.pk).update(
+            processed_tickets=F('processed_tickets') + len(batch),
+            refunded_amount=F('refunded_amount') + sum(refunds.values()),
+            last_ticket_id=pks[-1],
+        )
+    return len(batch)
+
+
+def run_job(job, batch_size=CANCELLATION_BATCH_SIZE):
+    """
+    Process a job's remaining batches, recording progress after each one.
+    A failure marks the job FAILED (keeping the batches already committed);
+    running it again resumes after the last committed batch.
+    """
+    CancellationJob.objects.filter(pk=job.pk).update(
+        status='RUNNING', error='', started_at=job.started_at or timezone.now())
+    try:
+        while process_batch(job, batch_size):
+            pass
+    except Exception as e:
+        logger.exception("Cancellation job %s failed", job.pk)
+        CancellationJob.objects.filter(pk=job.pk).update(status='FAILED', error=str(e))
+        job.refresh_from_db()
+        return job
+
+    CancellationJob.objects.filter(pk=job.pk).update(status='COMPLETED', finished_at=timezone.now())
+    job.refresh_from_db()
+    return job
@@ -0,0 +1,87 @@
+"""
+Canonical city lookup.
+
+Routes and route stops reference City rows, so searches resolve the typed
+text to city ids once and then filter on indexed foreign keys instead of
+running icontains over every route.
+
+- Autocomplete is a prefix match served by the normalized name index
+  (LIKE 'x%' with varchar_pattern_ops on PostgreSQL, a range scan on SQLite).
+- Search resolution is a substring match, like the old icontains filters.
+  On PostgreSQL it is served by pg_trgm GIN indexes (created by the
+  city_trigram_indexes migration) and falls back to trigram similarity;
+  on SQLite it scans the small City table.
+"""
+from django.db import connection
+from django.db.models import Q
+
+from .models import City, CityAlias, normalize_city_name
+
+AUTOCOMPLETE_LIMIT = 10
+
+# Minimum pg_trgm similarity for a misspelled city to match
+TRIGRAM_THRESHOLD = 0.4
+
+# Sorts (bytewise) after every character that can appear in a normalized name
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+def resolve_city(name):
+    """
+    Get the City for a free-text name (matching names and aliases), creating it if new.
+    Returns None for an empty name.
+    """
+    normalized = normalize_city_name(name)
+    if not normalized:
+        return None
+    alias = CityAlias.objects.select_related('city').filter(normalized_alias=normalized).first()
+    if alias:
+        return alias.city
+    city, _created = City.objects.get_or_create(
+        normalized_name=normalized, defaults={'name': ' '.join(name.split())})
+    return city
+
+
+def _prefix_range(field, prefix):
+    """Lookup kwargs for an index-friendly prefix match on `field`."""
+    if connection.vendor == 'postgresql':
+        # LIKE 'prefix%' is served by the varchar_pattern_ops index
+        return {f'{field}__startswith': prefix}
+    # SQLite compares text bytewise, so a range scan on the btree index is a prefix match
+    return {f'{field}__gte': prefix, f'{field}__lt': prefix + PREFIX_UPPER_BOUND}
+
+
+def autocomplete_cities(prefix, limit=AUTOCOMPLETE_LIMIT):
+    """
+    Cities whose name or alias starts with `prefix`, as (id, name) pairs ordered by name.
+    """
+    prefix = normalize_city_name(prefix)
+    if not prefix:
+        return []
+    alias_matches = CityAlias.objects.filter(**_prefix_range('normalized_alias', prefix)).values('city_id')
+    cities = City.objects.filter(
+        Q(**_prefix_range('normalized_name', prefix)) | Q(id__in=alias_matches)
+    ).order_by('normalized_name')
+    return list(cities.values_list('id', 'name')[:limit])
+
+
+def matching_city_ids(query):
+    """
+    Ids of the cities whose name or alias contains `query`, in one query.
+    On PostgreSQL a query with no substring match falls back to trigram
+    similarity, so small misspellings still resolve.
+    """
+    needle = normalize_city_name(query)
+    if not needle:
+        return set()
+    alias_matches = CityAlias.objects.filter(normalized_alias__contains=needle).values('city_id')
+    ids = set(City.objects.filter(
+        Q(normalized_name__contains=needle) | Q(id__in=alias_matches)
+    ).values_list('id', flat=True))
+
+    if not ids and connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramSimilarity
+        ids = set(City.objects.annotate(
+            similarity=TrigramSimilarity('normalized_name', needle),
+        ).filter(similarity__gte=TRIGRAM_THRESHOLD).values_list('id', flat=True))
+    return ids
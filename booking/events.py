@@ -0,0 +1,238 @@
+"""
+Live seat map events.
+
+Seat changes are published once the booking or cancellation that made them
+commits, and streamed to browsers as server-sent events by the seat_events
+view. Delivery goes through the pub/sub backend named by
+settings.BOOKING_EVENTS_BACKEND:
+
+- InProcessBackend fans messages out to the subscribers of this process only.
+- RedisBackend publishes through Redis pub/sub, so subscribers on every worker
+  see changes made by any worker (needs the optional `redis` package).
+
+Subscribers are asyncio queues, so an idle stream under ASGI is a parked
+coroutine rather than a thread.
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Messages a slow subscriber may fall behind by before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Tells subscribers that messages may have been lost and the seat map must be reloaded
+RESYNC = {'type': 'resync'}
+
+# Browser reconnect delay after a dropped stream (milliseconds)
+RECONNECT_DELAY = 5000
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def seat_channel(is_multi_stop, bus_id):
+    """Channel of a bus's seat changes; direct and multi-stop buses share ids, so the kind is part of it."""
+    return f"seats.{'m' if is_multi_stop else 'd'}{bus_id}"
+
+
+class Subscription:
+    """
+    A subscriber's message queue, bound to the event loop that reads it.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def deliver(self, message):
+        """Queue a message; runs on the subscriber's loop."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too far behind to catch up from deltas: drop them and ask for a reload
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def get(self, timeout):
+        """Next message, or None after `timeout` seconds without one."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InProcessBackend:
+    """
+    Fans messages out to the subscribers of the current process. Publishing is
+    thread-safe, so sync views and signal handlers can publish to async streams.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        self.dispatch(channel, message)
+
+    def dispatch(self, channel, message):
+        """Hand a message to this process's subscribers of `channel`."""
+        with self._lock:
+            subscriptions = list(self._subscribers.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # The subscriber's loop has shut down; it unsubscribes on its way out
+                pass
+
+    def dispatch_all(self, message):
+        """Hand a message to every subscriber of this process."""
+        with self._lock:
+            channels = list(self._subscribers)
+        for channel in channels:
+            self.dispatch(channel, message)
+
+    def subscribe(self, channel):
+        """Subscribe the running event loop to `channel`; returns a Subscription."""
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(channel)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[channel]
+
+
+class RedisBackend(InProcessBackend):
+    """
+    Publishes through Redis pub/sub (settings.BOOKING_EVENTS_REDIS_URL). Each
+    process keeps one pattern subscription and fans its messages out locally.
+    """
+    prefix = 'booking.'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured("RedisBackend requires the 'redis' package.")
+        self.url = settings.BOOKING_EVENTS_REDIS_URL
+        self.client = redis.Redis.from_url(self.url)
+        self._listener = None
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        subscription = super().subscribe(channel)
+        if self._listener is None or self._listener.done():
+            self._listener = subscription.loop.create_task(self._listen())
+        return subscription
+
+    async def _listen(self):
+        """Relay Redis messages to local subscribers, reconnecting after errors."""
+        import redis.asyncio as aioredis
+
+        while True:
+            client = aioredis.Redis.from_url(self.url)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(self.prefix + '*')
+                async for item in pubsub.listen():
+                    if item['type'] == 'pmessage':
+                        channel = item['channel'].decode()[len(self.prefix):]
+                        self.dispatch(channel, json.loads(item['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Seat event listener lost its Redis connection")
+                # Anything published meanwhile is lost
+                self.dispatch_all(RESYNC)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+
+def get_backend():
+    """The process-wide pub/sub backend, created on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(settings.BOOKING_EVENTS_BACKEND)()
+    return _backend
+
+
+def publish_seat_changes(is_multi_stop, bus_id, version, seat_states):
+    """
+    Publish the new state of changed seats for the seat map at `version`, as
+    {seat: (bitmask of booked legs, {holder user id: bitmask of held legs})}.
+    Failures are logged, never raised: bookings do not depend on anyone listening.
+    """
+    message = {
+        'type': 'seats',
+        'version': version,
+        'seats': {
+            str(seat): [legs, {str(holder): held for holder, held in holds.items()}]
+            for seat, (legs, holds) in seat_states.items()
+        },
+    }
+    try:
+        get_backend().publish(seat_channel(is_multi_stop, bus_id), message)
+    except Exception:
+        logger.exception("Could not publish seat changes for bus %s", bus_id)
+
+
+def format_event(event, data):
+    """One server-sent event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _is_taken(state, segment_mask, user_id):
+    """Whether a published seat state is booked, or held by someone else, on the segment."""
+    legs, holds = state
+    return bool(legs & segment_mask) or any(
+        held & segment_mask for holder, held in holds.items() if holder != str(user_id))
+
+
+async def seat_event_stream(channel, segment_mask, version, user_id=None, heartbeat=None):
+    """
+    Server-sent events for one user's seat map: the current `version` first,
+    then `seats` deltas ({seat: taken on the segment}) as changes are
+    published, with comment heartbeats to keep idle connections open.
+    """
+    if heartbeat is None:
+        heartbeat = settings.BOOKING_EVENTS_HEARTBEAT
+    backend = get_backend()
+    subscription = backend.subscribe(channel)
+    try:
+        yield f"retry: {RECONNECT_DELAY}\n\n"
+        yield format_event('version', {'version': version})
+        while True:
+            message = await subscription.get(heartbeat)
+            if message is None:
+                yield ": keepalive\n\n"
+            elif message['type'] == 'seats':
+                yield format_event('seats', {
+                    'version': message['version'],
+                    'seats': {seat: _is_taken(state, segment_mask, user_id)
+                              for seat, state in message['seats'].items()},
+                })
+            else:
+                yield format_event('resync', {})
+    finally:
+        backend.unsubscribe(channel, subscription)
@@ -0,0 +1,214 @@
+"""
+Booking exports for the bus admins.
+
+Tickets are read with their user (and stops) joined and their passengers
+prefetched, EXPORT_CHUNK_SIZE tickets at a time, so an export runs a fixed
+number of queries per chunk and never holds a whole bus's tickets in memory.
+
+- Excel: xlsxwriter in constant_memory mode flushes each row as it is
+  written, into a temporary file that is streamed back to the browser.
+- CSV: rows are generated one by one into a StreamingHttpResponse.
+
+Selections with more than settings.BOOKING_EXPORT_BACKGROUND_TICKETS tickets
+are queued as a BookingExport job instead. The run_booking_exports worker
+claims each job and writes it into settings.BOOKING_EXPORT_DIR, outside the
+web process; it is downloaded from the admin when done.
+"""
+import csv
+import logging
+import os
+import tempfile
+
+import xlsxwriter
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .models import BookingExport, MultiStopBus, MultiStopTicket, Ticket
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 2000
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+HEADERS = [
+    'Ticket ID', 
+    'Booking Time', 
+    'User Email', 
+    'Passenger Name', 
+    'Passenger Age', 
+    'Passenger Gender',
+    'Passenger ID', 
+    'Passenger Phone', 
+    'Seat Numbers', 
+    'Seat Class', 
+    'Total Fare', 
+    'Status'
+]
+
+# Multi-stop exports add the ticket's segment after the user's email
+MULTI_STOP_HEADERS = HEADERS[:3] + ['From', 'To'] + HEADERS[3:]
+
+
+def headers_for(is_multi_stop):
+    return MULTI_STOP_HEADERS if is_multi_stop else HEADERS
+
+
+def ticket_rows(bus, is_multi_stop):
+    """
+    One row per passenger of the bus's tickets, in ticket order. The booking
+    time is a naive local datetime.
+    """
+    if is_multi_stop:
+        tickets = MultiStopTicket.objects.select_related('user', 'start_stop', 'end_stop')
+    else:
+        tickets = Ticket.objects.select_related('user')
+    tickets = tickets.filter(bus=bus).prefetch_related('passengers').order_by('pk')
+
+    for ticket in tickets.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        segment = []
+        if is_multi_stop:
+            segment = [ticket.start_stop.city if ticket.start_stop else '',
+                       ticket.end_stop.city if ticket.end_stop else '']
+        booking_time = timezone.make_naive(ticket.booking_time) if settings.USE_TZ else ticket.booking_time
+        for passenger in ticket.passengers.all():
+            yield [
+                f"#{ticket.id}",
+                booking_time,
+                ticket.user.email,
+                *segment,
+                passenger.name,
+                passenger.age,
+                passenger.get_gender_display(),
+                passenger.id_number or 'N/A',
+                passenger.phone or 'N/A',
+                ticket.seat_numbers,
+                ticket.get_seat_class_display(),
+                float(ticket.total_fare),
+                ticket.get_status_display(),
+            ]
+
+
+def write_workbook(output, buses, is_multi_stop):
+    """
+    Write an Excel workbook with one worksheet per bus to `output` (a path or
+    binary file). Returns the number of data rows written.
+    """
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    headers = headers_for(is_multi_stop)
+
+    total = 0
+    for bus in buses:
+        worksheet = workbook.add_worksheet(f"Bus {bus.bus_number[:15]}")
+        worksheet.set_column(0, len(headers) - 1, 15)
+        worksheet.write_row(0, 0, headers, header_format)
+
+        # constant_memory mode: every row is written completely, in order
+        for row_num, row in enumerate(ticket_rows(bus, is_multi_stop), start=1):
+            worksheet.write(row_num, 0, row[0])
+            worksheet.write_datetime(row_num, 1, row[1], date_format)
+            worksheet.write_row(row_num, 2, row[2:])
+            total += 1
+
+    workbook.close()
+    return total
+
+
+class _Echo:
+    """A file-like object whose write() hands back the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(buses, is_multi_stop):
+    """CSV lines for the buses' bookings, headed by a Bus Number column."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['Bus Number'] + headers_for(is_multi_stop))
+    for bus in buses:
+        for row in ticket_rows(bus, is_multi_stop):
+            row[1] = row[1].strftime('%Y-%m-%d %H:%M:%S')
+            yield writer.writerow([bus.bus_number] + row)
+
+
+def export_file_name(prefix, export_format):
+    return f"{prefix}_{timezone.localtime().strftime('%Y%m%d_%H%M%S')}.{export_format.lower()}"
+
+
+def xlsx_response(buses, is_multi_stop, file_name):
+    """Build the workbook in a temporary file and stream it back."""
+    output = tempfile.TemporaryFile()
+    write_workbook(output, buses, is_multi_stop)
+    output.seek(0)
+    # FileResponse closes (and so deletes) the temporary file when done
+    return FileResponse(output, as_attachment=True, filename=file_name, content_type=XLSX_CONTENT_TYPE)
+
+
+def csv_response(buses, is_multi_stop, file_name):
+    response = StreamingHttpResponse(csv_lines(buses, is_multi_stop), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
+def needs_background_export(buses):
+    """Whether the selected buses have too many tickets to export during the request."""
+    model = MultiStopTicket if buses.model is MultiStopBus else Ticket
+    return model.objects.filter(bus__in=buses).count() > settings.BOOKING_EXPORT_BACKGROUND_TICKETS
+
+
+def start_export(buses, export_format, requested_by=None):
+    """Queue a background export of the buses' bookings; returns the BookingExport."""
+    return BookingExport.objects.create(
+        format=export_format,
+        is_multi_stop=buses.model is MultiStopBus,
+        bus_ids=list(buses.values_list('pk', flat=True)),
+        requested_by=requested_by,
+    )
+
+
+def export_path(export):
+    return os.path.join(settings.BOOKING_EXPORT_DIR, export.file_name)
+
+
+def claim_export(export, statuses=('PENDING',)):
+    """
+    Mark an export RUNNING with a conditional UPDATE if its status is one of
+    `statuses`. Returns True if this caller claimed it; only the claimant
+    may run it, so two workers never write the same export.
+    """
+    return BookingExport.objects.filter(pk=export.pk, status__in=statuses).update(status='RUNNING', error='') == 1
+
+
+def run_export(export):
+    """
+    Write a claimed export's file (see claim_export), recording the outcome
+    on the BookingExport. The file is written under a temporary name and
+    renamed when complete.
+    """
+    prefix = 'multistop_bus_bookings' if export.is_multi_stop else 'bus_bookings'
+    file_name = f"{export.pk}_{export_file_name(prefix, export.format)}"
+    path = os.path.join(settings.BOOKING_EXPORT_DIR, file_name)
+    try:
+        os.makedirs(settings.BOOKING_EXPORT_DIR, exist_ok=True)
+        with open(path + '.part', 'w+b') as output:
+            if export.format == 'CSV':
+                rows = -1
+                for line in csv_lines(export.buses, export.is_multi_stop):
+                    output.write(line.encode())
+                    rows += 1
+            else:
+                rows = write_workbook(output, export.buses, export.is_multi_stop)
+        os.replace(path + '.part', path)
+    except Exception as e:
+        logger.exception("Booking export %s failed", export.pk)
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        BookingExport.objects.filter(pk=export.pk).update(status='FAILED', error=str(e))
+    else:
+        BookingExport.objects.filter(pk=export.pk).update(
+            status='COMPLETED', rows=rows, file_name=file_name, finished_at=timezone.now())
+    export.refresh_from_db()
+    return export
@@ -0,0 +1,203 @@
+"""
+Stop-to-stop fare matrix of multi-stop routes.
+
+Admins enter RouteSegments for some stop pairs only. The matrix gives every
+forward pair of stops a distance, duration and fare multiplier: an entered
+segment is used as is, and any other pair is chained from entered segments
+(the cheapest chain, summing distances, durations and multipliers). It is
+stored per route as RouteStopFare rows under a RouteFareMatrix, rebuilt
+after a stop or segment of the route changes (and built for existing routes
+by a migration), read with one query by the booking form and fare display,
+and joined in SQL by search ranking. Reads never write: a route whose matrix
+is missing is computed in memory for that read. A
+seat's fare is then the bus's class fare times the multiplier, as in
+MultiStopBus.calculate_segment_fare.
+"""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+
+from .models import MultiStopRoute, RouteFareMatrix, RouteSegment, RouteStop, RouteStopFare
+
+
+def pair_key(start_stop_id, end_stop_id):
+    return f"{start_stop_id}-{end_stop_id}"
+
+
+class SegmentFare:
+    """
+    One cell of the matrix: a boarding and alighting stop with the distance,
+    duration and fare multiplier between them. Quacks like a RouteSegment
+    for calculate_segment_fare and the templates.
+    """
+
+    def __init__(self, start_stop, end_stop, distance, duration, base_fare_multiplier, segment_id=None):
+        self.start_stop = start_stop
+        self.end_stop = end_stop
+        self.distance = distance
+        self.duration = duration
+        self.base_fare_multiplier = base_fare_multiplier
+        # The RouteSegment entered for this pair, if any
+        self.segment_id = segment_id
+
+    def __str__(self):
+        return f"{self.start_stop.city} to {self.end_stop.city}"
+
+    def fare(self, bus, seat_class='GENERAL'):
+        return bus.calculate_segment_fare(self, seat_class)
+
+
+def compute_cells(stops, segments):
+    """
+    Matrix cells for a route's `stops` (in sequence order) and `segments`, as
+    {(start stop id, end stop id): (distance, duration, multiplier, segment id)}.
+    Pairs no chain of segments connects are left out.
+    """
+    position = {stop.id: i for i, stop in enumerate(stops)}
+    entered = {}
+    for segment in segments:
+        start, end = position.get(segment.start_stop_id), position.get(segment.end_stop_id)
+        if start is not None and end is not None and start < end:
+            entered[start, end] = segment
+
+    # Shortest spans first, so every chain's parts are already known
+    best = {}
+    for span in range(1, len(stops)):
+        for start in range(len(stops) - span):
+            end = start + span
+            segment = entered.get((start, end))
+            if segment is not None:
+                best[start, end] = (segment.distance, segment.duration, segment.base_fare_multiplier, segment.id)
+                continue
+            chains = [
+                (best[start, via], best[via, end]) for via in range(start + 1, end)
+                if (start, via) in best and (via, end) in best
+            ]
+            if not chains:
+                continue
+            first, second = min(chains, key=lambda chain: chain[0][2] + chain[1][2])
+            best[start, end] = (
+                first[0] + second[0] if first[0] is not None and second[0] is not None else None,
+                first[1] + second[1] if first[1] is not None and second[1] is not None else None,
+                first[2] + second[2],
+                None,
+            )
+
+    cells = {}
+    for (start, end), (distance, duration, multiplier, segment_id) in best.items():
+        if duration is None and stops[end].arrival_offset is not None:
+            # No segment durations: fall back to the stop timetable
+            duration = stops[end].arrival_offset - (stops[start].departure_offset or timedelta())
+        cells[stops[start].id, stops[end].id] = (distance, duration, multiplier, segment_id)
+    return cells
+
+
+def route_cells(route_id):
+    """Compute a route's matrix cells from its stops and segments, without storing them."""
+    stops = list(RouteStop.objects.filter(route_id=route_id).order_by('sequence'))
+    return compute_cells(stops, RouteSegment.objects.filter(route_id=route_id))
+
+
+def build_fare_matrix(route_id):
+    """
+    Compute and store the matrix of a route. Returns its cells, or None if
+    the route has been deleted.
+    """
+    cells = route_cells(route_id)
+    try:
+        with transaction.atomic():
+            matrix, _created = RouteFareMatrix.objects.update_or_create(route_id=route_id)
+            matrix.fares.all().delete()
+            RouteStopFare.objects.bulk_create([
+                RouteStopFare(matrix=matrix, start_stop_id=start_id, end_stop_id=end_id, distance=distance,
+                              duration=duration, fare_multiplier=multiplier, segment_id=segment_id)
+                for (start_id, end_id), (distance, duration, multiplier, segment_id) in cells.items()
+            ])
+    except IntegrityError:
+        # The route is gone, or a concurrent build stored it first
+        if not MultiStopRoute.objects.filter(pk=route_id).exists():
+            return None
+    return cells
+
+
+def invalidate_fare_matrix(route_id):
+    """
+    Drop a route's matrix and rebuild it once the transaction commits. Until
+    then readers compute it in memory, as they do if the rebuild is lost
+    (the rebuild_fare_matrices command stores it again).
+    """
+    RouteFareMatrix.objects.filter(route_id=route_id).delete()
+
+    def rebuild():
+        # Several changes in one transaction rebuild once
+        if not RouteFareMatrix.objects.filter(route_id=route_id).exists() \
+                and MultiStopRoute.objects.filter(pk=route_id).exists():
+            build_fare_matrix(route_id)
+
+    transaction.on_commit(rebuild)
+
+
+def get_fare_cells(route_ids):
+    """
+    Matrix cells of each route, as {route id: {(start stop id, end stop id):
+    (distance, duration, multiplier, segment id)}}; one query, plus two per
+    route whose matrix is missing, which is computed without being stored.
+    """
+    route_ids = set(route_ids)
+    cells = {}
+    rows = RouteFareMatrix.objects.filter(route_id__in=route_ids).values_list(
+        'route_id', 'fares__start_stop_id', 'fares__end_stop_id', 'fares__distance', 'fares__duration',
+        'fares__fare_multiplier', 'fares__segment_id')
+    for route_id, start_id, end_id, *cell in rows:
+        stored = cells.setdefault(route_id, {})
+        # A built matrix without pairs comes back as one row of NULLs
+        if start_id is not None:
+            stored[start_id, end_id] = tuple(cell)
+    for route_id in route_ids - set(cells):
+        cells[route_id] = route_cells(route_id)
+    return cells
+
+
+def _segment_fare(cell, start_stop, end_stop):
+    return SegmentFare(start_stop, end_stop, *cell)
+
+
+def get_segment_fare(route_id, start_stop, end_stop):
+    """The SegmentFare between two stops of a route, or None if no segments connect them."""
+    cell = get_fare_cells([route_id])[route_id].get((start_stop.id, end_stop.id))
+    return _segment_fare(cell, start_stop, end_stop) if cell else None
+
+
+def route_segment_fares(route, boarding_only=True):
+    """
+    Every SegmentFare of a route in stop order, for choosing a journey. With
+    `boarding_only`, pairs must start at a boarding point and end at a
+    dropping point.
+    """
+    stops = list(route.stops.order_by('sequence'))
+    cells = get_fare_cells([route.pk])[route.pk]
+    fares = []
+    for i, start_stop in enumerate(stops):
+        if boarding_only and not start_stop.is_boarding_point:
+            continue
+        for end_stop in stops[i + 1:]:
+            if boarding_only and not end_stop.is_dropping_point:
+                continue
+            cell = cells.get((start_stop.id, end_stop.id))
+            if cell:
+                fares.append(_segment_fare(cell, start_stop, end_stop))
+    return fares
+
+
+def attach_segment_fares(items):
+    """
+    Add 'segment_fare' (a SegmentFare) and 'fare' (its General fare) to
+    multi-stop search results ({'bus', 'start_stop', 'end_stop'} dicts), both
+    None for pairs without a fare. Every route's matrix is read in one query.
+    """
+    cells = get_fare_cells({item['bus'].route_id for item in items}) if items else {}
+    for item in items:
+        cell = cells[item['bus'].route_id].get((item['start_stop'].id, item['end_stop'].id))
+        item['segment_fare'] = _segment_fare(cell, item['start_stop'], item['end_stop']) if cell else None
+        item['fare'] = item['segment_fare'].fare(item['bus']) if cell else None
+    return items
@@ -2,7 +2,10 @@ from django import forms
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 
-from .models import Passenger, Ticket, Bus, Wallet, Transaction, RouteSegment
+from .models import Passenger, Ticket, Bus, Wallet, Transaction, MultiStopBus
+from .fares import pair_key, route_segment_fares
+from .pricing import get_multipliers, live_class_fares, live_fare, price_key
+from .search import DEPARTURE_BANDS, price_bands
 
 class PassengerForm(forms.ModelForm):
     """
@@ -62,9 +65,12 @@ class TicketBookingForm(forms.Form):
     """
     Form for ticket booking.
     """
-    segment = forms.ModelChoiceField(
-        queryset=RouteSegment.objects.none(),
-        empty_label=None,
+    # "<start stop id>-<end stop id>" pairs of the route fare matrix
+    segment = forms.ChoiceField(
+        choices=(),
+        # Direct buses have no segments, and a segment chosen from the seat map
+        # arrives in the query string; book_ticket enforces it for multi-stop buses.
+        required=False,
         label=_("Journey Segment"),
         widget=forms.Select(attrs={
             'class': 'form-control segment-select',
@@ -110,42 +116,35 @@ class TicketBookingForm(forms.Form):
         
         return seat_numbers
     
+    def clean_segment(self):
+        """The chosen SegmentFare, or None."""
+        return self.segment_fares.get(self.cleaned_data.get('segment'))
+    
     def __init__(self, *args, bus=None, **kwargs):
         super().__init__(*args, **kwargs)
         
+        # Boarding/alighting pairs with their fares, from the route fare matrix
+        self.segment_fares = {}
+        
         # If bus is provided, set available segments and seat classes
         if bus:
-            # Set available segments for this bus
-            if hasattr(bus, 'get_available_segments'):
-                segments = bus.get_available_segments()
-                self.fields['segment'].queryset = segments
-            else:
-                # For buses without segments, create a dummy segment
-                from booking.models import RouteSegment
-                # The segment field is not relevant for regular buses
-                # Hide it or make it optional
-                self.fields['segment'].required = False
-                # Set an empty queryset
-                self.fields['segment'].queryset = RouteSegment.objects.none()
-            
-            # Format segment choices to show cities and fare
-            segment_choices = []
-            for segment in segments:
-                segment_label = f"{segment.start_stop.city} to {segment.end_stop.city}"
-                segment_choices.append((segment.id, segment_label))
+            if isinstance(bus, MultiStopBus):
+                self.segment_fares = {
+                    pair_key(fare.start_stop.id, fare.end_stop.id): fare for fare in route_segment_fares(bus.route)
+                }
             
-            # If there are segment choices, update the field
-            if segment_choices:
-                self.fields['segment'].choices = segment_choices
+            # Format segment choices to show cities and live (General class) fare
+            multiplier = get_multipliers([bus])[price_key(bus)]
+            self.fields['segment'].choices = [
+                (key, f"{fare} - ₹{live_fare(bus, segment=fare, multiplier=multiplier)}")
+                for key, fare in self.segment_fares.items()
+            ]
             
-            # Set available seat classes based on bus configuration
-            available_classes = []
-            if bus.has_general_seats:
-                available_classes.append(('GENERAL', _('General - ₹{}').format(bus.fare)))
-            if bus.has_sleeper_seats:
-                available_classes.append(('SLEEPER', _('Sleeper - ₹{}').format(bus.sleeper_fare)))
-            if bus.has_luxury_seats:
-                available_classes.append(('LUXURY', _('Luxury - ₹{}').format(bus.luxury_fare)))
+            # Set available seat classes based on bus configuration, with live fares
+            labels = {'GENERAL': _('General - ₹{}'), 'SLEEPER': _('Sleeper - ₹{}'), 'LUXURY': _('Luxury - ₹{}')}
+            available_classes = [
+                (seat_class, labels[seat_class].format(fare)) for seat_class, fare in live_class_fares(bus).items()
+            ]
             
             if available_classes:
                 self.fields['seat_class'].choices = available_classes
@@ -190,6 +189,8 @@ class BusSearchForm(forms.Form):
         widget=forms.TextInput(attrs={
             'class': 'form-control',
             'placeholder': _('Departure City'),
+            'list': 'city-suggestions',
+            'autocomplete': 'off',
         }),
     )
     
@@ -200,6 +201,8 @@ class BusSearchForm(forms.Form):
         widget=forms.TextInput(attrs={
             'class': 'form-control',
             'placeholder': _('Arrival City'),
+            'list': 'city-suggestions',
+            'autocomplete': 'off',
         }),
     )
     
@@ -213,6 +216,32 @@ class BusSearchForm(forms.Form):
         }),
     )
     
+    # Facet filters, rendered with their counts by the results page
+    seat_class = forms.MultipleChoiceField(
+        label=_("Seat class"),
+        required=False,
+        choices=Bus.SEAT_CLASS_CHOICES,
+        widget=forms.CheckboxSelectMultiple,
+    )
+    
+    departure = forms.MultipleChoiceField(
+        label=_("Departure time"),
+        required=False,
+        choices=[(key, label) for key, (label, _first, _last) in DEPARTURE_BANDS.items()],
+        widget=forms.CheckboxSelectMultiple,
+    )
+    
+    price = forms.MultipleChoiceField(
+        label=_("Price"),
+        required=False,
+        choices=lambda: [(key, label) for key, (label, _low, _high) in price_bands().items()],
+        widget=forms.CheckboxSelectMultiple,
+    )
+    
+    def facet_filters(self):
+        """Selected facet values, as {facet: [keys]} for search_buses."""
+        return {facet: self.cleaned_data.get(facet) or [] for facet in ('seat_class', 'departure', 'price')}
+    
     def clean(self):
         cleaned_data = super().clean()
         source = cleaned_data.get('source')
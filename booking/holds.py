@@ -0,0 +1,87 @@
+"""
+Short-lived seat holds for checkout.
+
+Starting checkout holds the chosen seats on the legs of the chosen segment,
+so other customers see them as taken and cannot book them until the holder's
+booking consumes the hold or it expires (settings.BOOKING_SEAT_HOLD_TTL).
+Holds are written under the same occupancy row lock as bookings, so a seat
+can never be held and booked by different customers at once. Expired holds
+are already ignored everywhere; sweep_expired_holds deletes them and refreshes
+the seat maps that still show them.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Bus, MultiStopBus, SeatHold
+from .occupancy import (
+    SeatUnavailable, bump_version, bus_lookup, ensure_free, ensure_not_held, get_stop_sequences, held_mask,
+    leg_pairs, leg_span, load_occupancy, parse_seat_numbers, publish_on_commit,
+)
+
+
+def hold_ttl():
+    return timedelta(seconds=settings.BOOKING_SEAT_HOLD_TTL)
+
+
+def place_hold(user, bus, seats, start_stop=None, end_stop=None):
+    """
+    Hold seats on the segment for `user`, replacing their earlier holds on this bus.
+    Raises SeatUnavailable if a seat is booked or held by someone else.
+    Returns the time the hold expires.
+    """
+    seats = parse_seat_numbers(seats)
+    if not seats:
+        raise SeatUnavailable("Please select at least one seat.")
+    now = timezone.now()
+    expires_at = now + hold_ttl()
+
+    with transaction.atomic():
+        sequences = get_stop_sequences(bus)
+        occupancy, bitmap = load_occupancy(bus, sequences, for_update=True)
+        first_leg, last_leg = leg_span(sequences, start_stop, end_stop)
+        ensure_free(bitmap, seats, first_leg, last_leg)
+        ensure_not_held(seats, held_mask(bus, sequences, first_leg, last_leg, exclude_user=user))
+
+        # Replace the user's holds, and clear expired ones in the way of the unique constraint
+        stale = SeatHold.objects.filter(Q(user=user) | Q(seat_no__in=seats, expires_at__lte=now), **bus_lookup(bus))
+        changed = set(seats) | set(stale.values_list('seat_no', flat=True))
+        stale.delete()
+        SeatHold.objects.bulk_create([
+            SeatHold(user=user, seat_no=seat, start_seq=start_seq, end_seq=end_seq, expires_at=expires_at,
+                     **bus_lookup(bus))
+            for seat in seats
+            for start_seq, end_seq in leg_pairs(sequences, first_leg, last_leg)
+        ])
+
+        bump_version(occupancy)
+        publish_on_commit(bus, occupancy, bitmap, sequences, changed)
+    return expires_at
+
+
+def sweep_expired_holds():
+    """
+    Delete expired seat holds, bumping and publishing the seat map of each
+    affected bus. Returns the number of holds deleted.
+    """
+    expired = SeatHold.objects.filter(expires_at__lte=timezone.now())
+    swept = 0
+    for model, field in ((Bus, 'bus'), (MultiStopBus, 'multistop_bus')):
+        bus_ids = expired.filter(**{f'{field}__isnull': False}).values_list(f'{field}_id', flat=True).distinct()
+        for bus in model.objects.filter(pk__in=list(bus_ids)).select_related('route'):
+            with transaction.atomic():
+                sequences = get_stop_sequences(bus)
+                occupancy, bitmap = load_occupancy(bus, sequences, for_update=True)
+                # Re-read under the lock: a hold may have been renewed or consumed meanwhile
+                holds = expired.filter(**bus_lookup(bus))
+                seats = set(holds.values_list('seat_no', flat=True))
+                if not seats:
+                    continue
+                deleted, _per_model = holds.delete()
+                swept += deleted
+                bump_version(occupancy)
+                publish_on_commit(bus, occupancy, bitmap, sequences, seats)
+    return swept
@@ -0,0 +1,105 @@
+"""
+User journey listing: both ticket types in one ordered, keyset-paginated query.
+
+The effective departure (bus departure, plus the boarding stop's offset for
+multi-stop tickets) is computed in SQL, so upcoming/past is a WHERE clause and
+each page costs the same number of queries however many tickets a user has.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import DateTimeField, ExpressionWrapper, F, IntegerField, Prefetch, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Passenger, Ticket, MultiStopTicket
+
+JOURNEYS_PAGE_SIZE = 10
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Tie-breaker between the two ticket tables when departures are equal
+DIRECT_KIND = 0
+MULTI_STOP_KIND = 1
+
+
+def _journey_rows(model, user):
+    """(departure, kind, id) rows of one ticket table for `user`."""
+    if model is MultiStopTicket:
+        departure = ExpressionWrapper(
+            F('bus__departure_time') + Coalesce(F('start_stop__departure_offset'), Value(timedelta(0))),
+            output_field=DateTimeField(),
+        )
+        kind = MULTI_STOP_KIND
+    else:
+        departure = F('bus__departure_time')
+        kind = DIRECT_KIND
+    return model.objects.filter(user=user).annotate(
+        departure=departure,
+        kind=Value(kind, output_field=IntegerField()),
+    )
+
+
+def encode_cursor(row):
+    """Opaque, URL-safe 'after' token for the page following `row`."""
+    microseconds = (row['departure'] - EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}_{row['kind']}_{row['id']}"
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; returns None for a missing or malformed token."""
+    try:
+        microseconds, kind, pk = (int(part) for part in cursor.split('_'))
+        return EPOCH + timedelta(microseconds=microseconds), kind, pk
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _after(cursor, descending):
+    """WHERE clause for rows strictly after `cursor` in (departure, kind, id) order."""
+    departure, kind, pk = cursor
+    op = 'lt' if descending else 'gt'
+    return (Q(**{f'departure__{op}': departure})
+            | Q(departure=departure, **{f'kind__{op}': kind})
+            | Q(departure=departure, kind=kind, **{f'id__{op}': pk}))
+
+
+def journey_page(user, upcoming, cursor=None, page_size=JOURNEYS_PAGE_SIZE):
+    """
+    One page of the user's upcoming (soonest first) or past (latest first) journeys.
+
+    Returns (tickets, next_cursor). Tickets are Ticket/MultiStopTicket instances
+    with `is_multi_stop` and `journey_departure` set; next_cursor is None on the
+    last page.
+    """
+    now = timezone.now()
+    active = Q(status='BOOKED', departure__gt=now)
+    descending = not upcoming
+    position = decode_cursor(cursor) if cursor else None
+
+    parts = []
+    for model in (Ticket, MultiStopTicket):
+        rows = _journey_rows(model, user).filter(active if upcoming else ~active)
+        if position:
+            rows = rows.filter(_after(position, descending))
+        parts.append(rows.order_by().values('departure', 'kind', 'id'))
+
+    prefix = '-' if descending else ''
+    rows = list(parts[0].union(parts[1], all=True).order_by(
+        f'{prefix}departure', f'{prefix}kind', f'{prefix}id')[:page_size + 1])
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    rows = rows[:page_size]
+
+    # Hydrate each table with one query (plus one for its passengers)
+    passengers = Prefetch('passengers', queryset=Passenger.objects.order_by('id'))
+    direct = Ticket.objects.select_related('bus__route').prefetch_related(passengers).in_bulk(
+        [row['id'] for row in rows if row['kind'] == DIRECT_KIND])
+    multi_stop = MultiStopTicket.objects.select_related('bus__route', 'start_stop', 'end_stop').prefetch_related(
+        passengers).in_bulk([row['id'] for row in rows if row['kind'] == MULTI_STOP_KIND])
+
+    tickets = []
+    for row in rows:
+        ticket = (multi_stop if row['kind'] == MULTI_STOP_KIND else direct)[row['id']]
+        ticket.is_multi_stop = row['kind'] == MULTI_STOP_KIND  # Flag to identify ticket type in template
+        ticket.journey_departure = row['departure']
+        tickets.append(ticket)
+    return tickets, next_cursor
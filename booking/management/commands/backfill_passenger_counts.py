@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from booking.models import Ticket, MultiStopTicket
+from booking.services import passenger_count_subquery, sync_passenger_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored passenger_count of tickets from their passengers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report tickets whose stored count is wrong; exit 1 if any')
+
+    def handle(self, *args, **options):
+        drifted_total = 0
+        for model in (Ticket, MultiStopTicket):
+            drifted = list(model.objects.annotate(actual=passenger_count_subquery(model)).exclude(
+                passenger_count=F('actual')).values_list('pk', flat=True))
+            drifted_total += len(drifted)
+            label = model._meta.verbose_name_plural
+            if options['check']:
+                self.stdout.write(f"{label}: {len(drifted)} with a wrong passenger count")
+            elif drifted:
+                sync_passenger_counts(model, drifted)
+                self.stdout.write(f"{label}: fixed {len(drifted)} passenger counts")
+            else:
+                self.stdout.write(f"{label}: all passenger counts are correct")
+
+        if options['check'] and drifted_total:
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS('Passenger counts are in sync.'))
@@ -0,0 +1,95 @@
+import random
+import statistics
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from booking.planner import DIRECT, MULTI_STOP, Timetable
+
+
+class Command(BaseCommand):
+    help = 'Benchmark connecting-journey queries on a synthetic timetable (no database access)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int, default=200, help='Cities in the synthetic network')
+        parser.add_argument('--departures', type=int, default=50000, help='Bus departures over the horizon')
+        parser.add_argument('--days', type=int, default=7, help='Days the departures are spread over')
+        parser.add_argument('--stops', type=int, default=5, help='Most stops of a multi-stop bus')
+        parser.add_argument('--queries', type=int, default=200, help='Random journeys to plan')
+        parser.add_argument('--updates', type=int, default=50, help='Buses changed in the incremental update')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--budget-ms', type=float, default=50.0,
+                            help='Fail if the 95th percentile query time exceeds this')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        start = timezone.now().timestamp()
+        horizon = options['days'] * 86400
+
+        self.stdout.write(self.style.WARNING(
+            f"Benchmarking journey planning: {options['departures']} departures between "
+            f"{options['cities']} cities over {options['days']} days..."))
+
+        trips = {}
+        for i in range(options['departures']):
+            trip = self.make_trip(rng, i, start, horizon, options['cities'], options['stops'])
+            trips[trip[0][4]] = trip
+        connections = sum(len(legs) for legs in trips.values())
+
+        began = time.perf_counter()
+        timetable = Timetable(trips)
+        build_ms = (time.perf_counter() - began) * 1000
+        self.stdout.write(f"Built timetable of {connections} connections in {build_ms:.1f} ms")
+
+        changed = rng.sample(sorted(trips), min(options['updates'], len(trips)))
+        replacements = {trip: self.make_trip(rng, trip[1], start, horizon, options['cities'], options['stops'])
+                        for trip in changed}
+        replacements = {trip: [(*c[:4], trip, *c[5:]) for c in legs] for trip, legs in replacements.items()}
+        began = time.perf_counter()
+        timetable.replace_trips(changed, replacements)
+        update_ms = (time.perf_counter() - began) * 1000
+        self.stdout.write(f"Replaced {len(changed)} buses in {update_ms:.1f} ms")
+
+        transfer = settings.BOOKING_MIN_TRANSFER_MINUTES * 60
+        timings = []
+        found = legs_total = 0
+        for _ in range(options['queries']):
+            source, target = rng.sample(range(options['cities']), 2)
+            depart_after = start + rng.uniform(0, horizon / 2)
+            began = time.perf_counter()
+            legs = timetable.earliest_arrival({source}, {target}, depart_after, transfer)
+            timings.append((time.perf_counter() - began) * 1000)
+            if legs:
+                found += 1
+                legs_total += len(legs)
+
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) >= 20 else timings[-1]
+        self.stdout.write(
+            f"{len(timings)} queries, {found} journeys found "
+            f"({legs_total / found if found else 0:.1f} buses each on average)")
+        self.stdout.write(f"Query time: median {statistics.median(timings):.2f} ms, "
+                          f"p95 {p95:.2f} ms, max {timings[-1]:.2f} ms")
+
+        if p95 > options['budget_ms']:
+            self.stdout.write(self.style.ERROR(f"❌ p95 query time exceeds {options['budget_ms']} ms"))
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS(f"✅ p95 query time within {options['budget_ms']} ms"))
+
+    def make_trip(self, rng, number, start, horizon, city_count, max_stops):
+        """One synthetic bus: direct between two cities, or multi-stop through several."""
+        departure = start + rng.uniform(0, horizon)
+        stop_count = rng.randint(2, max(2, max_stops))
+        cities = rng.sample(range(city_count), stop_count)
+        trip = (DIRECT if stop_count == 2 else MULTI_STOP, number)
+        legs = []
+        for from_city, to_city in zip(cities, cities[1:]):
+            arrival = departure + rng.uniform(1, 6) * 3600
+            legs.append((departure, arrival, from_city, to_city, trip,
+                         None if trip[0] == DIRECT else 0, None if trip[0] == DIRECT else 0))
+            # Dwell at the stop before the next leg
+            departure = arrival + 600
+        return legs
@@ -0,0 +1,109 @@
+from datetime import timedelta
+from decimal import Decimal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from booking.models import MultiStopRoute, RouteStop, MultiStopBus
+from booking.cities import resolve_city
+from booking.search import invalidate_city_stop_index, ranked_results
+
+
+class Rollback(Exception):
+    """Raised to discard the synthetic benchmark data."""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark one uncached page of ranked bus search against the number of buses per day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                            help='Numbers of buses per day to benchmark')
+        parser.add_argument('--stops', type=int, default=6, help='Stops per synthetic route')
+        parser.add_argument('--repeat', type=int, default=5, help='Searches per size (best time is reported)')
+        parser.add_argument('--legacy', action='store_true',
+                            help='Also time the old per-bus scan for comparison')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('Benchmarking ranked bus search...'))
+        self.stdout.write(f"{'buses/day':>10} {'results':>8} {'queries':>8} {'best ms':>9}"
+                          + (f" {'legacy q':>9} {'legacy ms':>10}" if options['legacy'] else ''))
+
+        for size in options['sizes']:
+            try:
+                with transaction.atomic():
+                    date = self.create_network(size, options['stops'])
+                    row = self.measure(lambda: self.search_page('City 1', f"City {options['stops'] - 1}", date),
+                                       options['repeat'])
+                    line = f"{size:>10} {row[0]:>8} {row[1]:>8} {row[2]:>9.2f}"
+                    if options['legacy']:
+                        legacy = self.measure(lambda: self.legacy_scan('City 1', f"City {options['stops'] - 1}", date),
+                                              options['repeat'])
+                        line += f" {legacy[1]:>9} {legacy[2]:>10.2f}"
+                    self.stdout.write(line)
+                    raise Rollback
+            except Rollback:
+                pass
+            finally:
+                invalidate_city_stop_index()
+
+        self.stdout.write(self.style.SUCCESS('Benchmark complete. Synthetic data has been rolled back.'))
+
+    def create_network(self, size, stop_count):
+        """Create one route with `stop_count` stops and `size` buses departing on the same day."""
+        route = MultiStopRoute.objects.create(name='Benchmark route')
+        RouteStop.objects.bulk_create([
+            RouteStop(route=route, city=f"City {i}", canonical_city=resolve_city(f"City {i}"), sequence=i,
+                      departure_offset=timedelta(hours=i), arrival_offset=timedelta(hours=i))
+            for i in range(stop_count)
+        ])
+        invalidate_city_stop_index()
+
+        start = (timezone.now() + timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
+        MultiStopBus.objects.bulk_create([
+            MultiStopBus(
+                route=route,
+                bus_number=f"BENCH-{i}",
+                departure_time=start + timedelta(minutes=i % 1440),
+                arrival_time=start + timedelta(minutes=i % 1440, hours=stop_count),
+                total_seats=40,
+                available_seats=40,
+                fare=Decimal('500.00'),
+            )
+            for i in range(size)
+        ])
+        return start.date()
+
+    def measure(self, search, repeat):
+        """Run a search `repeat` times and return (results, queries, best milliseconds)."""
+        best = None
+        for _ in range(repeat):
+            invalidate_city_stop_index()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                results = search()
+                elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return len(results), len(queries), best
+
+    def search_page(self, source, destination, date):
+        """The first page of results, ranked in SQL as bus_search does on a cache miss."""
+        return list(ranked_results(source, destination, date, sort='fare_low')[:settings.BOOKING_SEARCH_PAGE_SIZE])
+
+    def legacy_scan(self, source, destination, date):
+        """The previous bus_search loop: one stops query per bus and an O(stops^2) scan."""
+        matches = []
+        for bus in MultiStopBus.objects.filter(is_active=True, departure_time__date=date):
+            stops = list(bus.route.stops.all().order_by('sequence'))
+            for i, start_stop in enumerate(stops):
+                end_stop = next((stop for stop in stops[i + 1:]
+                                 if source.lower() in start_stop.city.lower()
+                                 and destination.lower() in stop.city.lower()), None)
+                if end_stop:
+                    matches.append({'bus': bus, 'start_stop': start_stop, 'end_stop': end_stop})
+                    break
+        return matches
@@ -0,0 +1,95 @@
+from datetime import timedelta
+from decimal import Decimal
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from booking.models import Route, Bus, MultiStopRoute, RouteStop, MultiStopBus, Wallet
+from booking.services import create_booking
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    """Raised to discard the synthetic bookings."""
+
+
+class Command(BaseCommand):
+    help = 'Regression check: the booking write path runs a small, constant number of queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--party-sizes', type=int, nargs='+', default=[1, 2, 4, 6],
+                            help='Party sizes to book')
+        parser.add_argument('--max-queries', type=int, default=20,
+                            help='Query budget for one booking')
+        parser.add_argument('--verbose-sql', action='store_true', help='Print the queries of the largest booking')
+
+    def handle(self, *args, **options):
+        sizes = sorted(set(options['party_sizes']))
+        problems = []
+        try:
+            with transaction.atomic():
+                user, direct, multi, stops = self.create_fixtures(sum(sizes) + 1)
+                for label, bus, segment in (('direct', direct, {}),
+                                            ('multi-stop', multi, {'start_stop': stops[0], 'end_stop': stops[2]})):
+                    # The first booking of a bus creates its occupancy row; measure steady state
+                    self.book(user, bus, [1], segment)
+                    counts = {}
+                    next_seat = 2
+                    for size in sizes:
+                        seats = list(range(next_seat, next_seat + size))
+                        next_seat += size
+                        with CaptureQueriesContext(connection) as queries:
+                            self.book(user, bus, seats, segment)
+                        counts[size] = len(queries)
+                        if options['verbose_sql'] and size == sizes[-1]:
+                            for query in queries.captured_queries:
+                                self.stdout.write(f"    {query['sql'][:160]}")
+
+                    self.stdout.write(f"{label:>10}: " + ', '.join(
+                        f"{size} passenger(s) → {count} queries" for size, count in counts.items()))
+                    if len(set(counts.values())) > 1:
+                        problems.append(f"{label} booking query count grows with party size: {counts}")
+                    if max(counts.values()) > options['max_queries']:
+                        problems.append(f"{label} booking exceeds the budget of {options['max_queries']} queries")
+                raise Rollback
+        except Rollback:
+            pass
+
+        if problems:
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(f"❌ {problem}"))
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS('✅ Booking query count is constant and within budget.'))
+
+    def create_fixtures(self, seats):
+        """A user with funds, one direct bus and one three-stop bus with `seats` seats each."""
+        user = User.objects.create_user(email='query-check@example.com', full_name='Query Check', password=None)
+        Wallet.objects.filter(user=user).update(balance=Decimal('100000.00'))
+        user = User.objects.select_related('wallet').get(pk=user.pk)
+
+        departure = timezone.now() + timedelta(days=7)
+        bus_data = {
+            'departure_time': departure, 'arrival_time': departure + timedelta(hours=4),
+            'total_seats': seats, 'available_seats': seats, 'fare': Decimal('100.00'),
+        }
+        route = Route.objects.create(origin='Query Origin', destination='Query Destination')
+        direct = Bus.objects.create(route=route, bus_number='QUERY-DIRECT', **bus_data)
+
+        multi_route = MultiStopRoute.objects.create(name='Query check route')
+        stops = [
+            RouteStop.objects.create(route=multi_route, city=f"Query Stop {i}", sequence=i,
+                                     departure_offset=timedelta(hours=i), arrival_offset=timedelta(hours=i))
+            for i in range(3)
+        ]
+        multi = MultiStopBus.objects.create(route=multi_route, bus_number='QUERY-MULTI', **bus_data)
+        return user, direct, multi, stops
+
+    def book(self, user, bus, seats, segment):
+        passengers = [{'name': f"Passenger {seat}", 'age': 30, 'gender': 'O'} for seat in seats]
+        return create_booking(user, bus, ','.join(map(str, seats)), Decimal('10.00') * len(seats),
+                              passengers, **segment)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from booking.fares import build_fare_matrix
+from booking.models import MultiStopRoute
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stop-to-stop fare matrices of multi-stop routes from their segments'
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+        pairs = 0
+        for route_id in MultiStopRoute.objects.values_list('pk', flat=True).iterator():
+            cells = build_fare_matrix(route_id)
+            if cells is not None:
+                rebuilt += 1
+                pairs += len(cells)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt fare matrices for {rebuilt} routes ({pairs} stop pairs)."))
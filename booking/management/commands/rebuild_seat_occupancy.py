@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from booking.models import Bus, MultiStopBus
+from booking.occupancy import build_bitmap, get_stop_sequences, load_occupancy, store_bitmap
+
+
+class Command(BaseCommand):
+    help = 'Rebuild seat occupancy bitmaps from booked tickets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--upcoming', action='store_true', help='Only rebuild buses that have not departed yet')
+
+    def handle(self, *args, **options):
+        rebuilt = 0
+        for model in (Bus, MultiStopBus):
+            buses = model.objects.all()
+            if options['upcoming']:
+                buses = buses.filter(departure_time__gt=timezone.now())
+            for bus in buses.select_related('route').iterator():
+                with transaction.atomic():
+                    sequences = get_stop_sequences(bus)
+                    occupancy, _bitmap = load_occupancy(bus, sequences, for_update=True)
+                    store_bitmap(occupancy, build_bitmap(bus, sequences))
+                rebuilt += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt seat occupancy for {rebuilt} buses."))
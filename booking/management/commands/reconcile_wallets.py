@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from booking.models import Wallet
+
+
+class Command(BaseCommand):
+    help = 'Check every wallet balance against its ledger (latest snapshot plus later transactions)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', type=str, help='Only reconcile this user\'s wallet')
+
+    def handle(self, *args, **options):
+        wallets = Wallet.objects.select_related('user')
+        if options['email']:
+            wallets = wallets.filter(user__email=options['email'])
+
+        checked = 0
+        mismatches = 0
+        for wallet in wallets.iterator():
+            checked += 1
+            ledger = wallet.ledger_balance()
+            if ledger != wallet.balance:
+                mismatches += 1
+                self.stdout.write(self.style.ERROR(
+                    f"❌ {wallet.user.email}: balance ₹{wallet.balance} but ledger says ₹{ledger}"
+                ))
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f"{mismatches} of {checked} wallets do not reconcile."))
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS(f"✅ All {checked} wallets reconcile with their ledger."))
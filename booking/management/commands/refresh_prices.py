@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from booking.pricing import refresh_prices
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dynamic price multipliers of upcoming buses (run every 15 minutes)'
+
+    def handle(self, *args, **options):
+        changed = refresh_prices()
+        self.stdout.write(self.style.SUCCESS(f"Repriced {changed} buses."))
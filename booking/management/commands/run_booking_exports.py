@@ -0,0 +1,49 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.exports import claim_export, run_export
+from booking.models import BookingExport
+
+
+class Command(BaseCommand):
+    help = 'Write queued background booking exports (or retry ones that failed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--export', type=int,
+                            help='Only run the booking export with this id, even if it failed or was '
+                                 'interrupted while running')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, polling for newly queued exports (failed exports are left '
+                                 'for a run without --loop)')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            # Retrying a failed export every poll would repeat its error forever
+            statuses = ('PENDING',) if options['loop'] else ('PENDING', 'FAILED')
+            exports = BookingExport.objects.filter(status__in=statuses).order_by('created_at')
+            if options['export']:
+                statuses = ('PENDING', 'RUNNING', 'FAILED')
+                exports = BookingExport.objects.filter(pk=options['export'])
+
+            # Only exports this worker claims are run; another worker may take any of them first
+            failed = sum(not self.run(export) for export in exports if claim_export(export, statuses))
+            if not options['loop'] or options['export']:
+                break
+            time.sleep(options['interval'])
+
+        if failed:
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS('All booking exports finished.'))
+
+    def run(self, export):
+        """Run one claimed export and report it; returns True if it completed."""
+        export = run_export(export)
+        if export.status == 'COMPLETED':
+            self.stdout.write(self.style.SUCCESS(f"✅ Export #{export.id}: {export.rows} rows in {export.file_name}"))
+            return True
+        self.stdout.write(self.style.ERROR(f"❌ Export #{export.id} failed: {export.error}"))
+        return False
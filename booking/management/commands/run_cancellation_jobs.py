@@ -0,0 +1,51 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.cancellations import CANCELLATION_BATCH_SIZE, UNFINISHED_STATUSES, run_job
+from booking.models import CancellationJob
+
+
+class Command(BaseCommand):
+    help = 'Run (or resume) bulk bus cancellation jobs that have not finished'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, help='Only run the cancellation job with this id')
+        parser.add_argument('--batch-size', type=int, default=CANCELLATION_BATCH_SIZE,
+                            help='Tickets cancelled and refunded per transaction')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, polling for newly queued jobs (failed jobs are left '
+                                 'for a run without --loop)')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = CancellationJob.objects.filter(status__in=UNFINISHED_STATUSES).order_by('created_at')
+            if options['job']:
+                jobs = CancellationJob.objects.filter(pk=options['job'])
+            elif options['loop']:
+                # Retrying a failed job every poll would repeat its error forever
+                jobs = jobs.exclude(status='FAILED')
+
+            failed = sum(not self.run(job, options['batch_size']) for job in jobs)
+            if not options['loop'] or options['job']:
+                break
+            time.sleep(options['interval'])
+
+        if failed:
+            sys.exit(1)
+        self.stdout.write(self.style.SUCCESS('All cancellation jobs finished.'))
+
+    def run(self, job, batch_size):
+        """Run one job and report it; returns True if it completed."""
+        self.stdout.write(f"Job #{job.id}: {job.target_bus} ({job.processed_tickets}/{job.total_tickets} done)")
+        job = run_job(job, batch_size)
+        line = (f"{job.get_status_display()}: {job.processed_tickets}/{job.total_tickets} tickets, "
+                f"₹{job.refunded_amount} refunded")
+        if job.status == 'COMPLETED':
+            self.stdout.write(self.style.SUCCESS(f"  ✅ {line}"))
+            return True
+        self.stdout.write(self.style.ERROR(f"  ❌ {line}: {job.error}"))
+        return False
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from booking.search import invalidate_all_searches, reset_search_cache_stats, search_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show bus search cache hit/miss counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+        parser.add_argument('--clear', action='store_true', help='Drop every cached search result')
+
+    def handle(self, *args, **options):
+        stats = search_cache_stats()
+        self.stdout.write(f"Hits: {stats['hits']}")
+        self.stdout.write(f"Misses: {stats['misses']}")
+        self.stdout.write(f"Hit rate: {stats['hit_rate']:.1%}")
+
+        if options['reset']:
+            reset_search_cache_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
+        if options['clear']:
+            invalidate_all_searches()
+            self.stdout.write(self.style.SUCCESS('Search cache cleared.'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Q, Subquery
+
+from booking.models import Wallet, WalletSnapshot
+
+
+class Command(BaseCommand):
+    help = 'Checkpoint wallet balances so reconciliation only sums recent ledger entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-transactions', type=int, default=1,
+                            help='Only snapshot wallets with at least this many entries since their last snapshot')
+
+    def handle(self, *args, **options):
+        latest = WalletSnapshot.objects.filter(wallet=OuterRef('pk')).order_by('-id')
+        wallets = Wallet.objects.annotate(
+            snapshot_after=Subquery(latest.values('last_transaction_id')[:1]),
+        ).annotate(
+            pending=Count('transactions', filter=Q(snapshot_after__isnull=True) |
+                          Q(transactions__id__gt=F('snapshot_after'))),
+        ).filter(pending__gte=options['min_transactions'])
+
+        taken = 0
+        for wallet in wallets.iterator():
+            wallet.take_snapshot()
+            taken += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Took {taken} wallet snapshots."))
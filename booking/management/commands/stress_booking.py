@@ -0,0 +1,110 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+import random
+import sys
+import threading
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from booking.models import Route, Bus, Passenger, Ticket, Wallet, SeatAllocation
+from booking.services import create_booking
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Stress-test concurrent bookings on one bus and verify that it is never oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=300, help='Number of concurrent booking attempts')
+        parser.add_argument('--threads', type=int, default=32, help='Worker threads')
+        parser.add_argument('--seats', type=int, default=40, help='Seats on the test bus')
+        parser.add_argument('--party-size', type=int, default=2, help='Maximum seats per booking')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated bus, users and tickets')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING(
+            f"Running {options['bookings']} bookings on {options['threads']} threads "
+            f"against a {options['seats']}-seat bus..."
+        ))
+        if connections['default'].vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite serialises writers, so some attempts may fail with "database is locked". '
+                'Use PostgreSQL for a meaningful row-locking test.'
+            ))
+
+        tag = timezone.now().strftime('%Y%m%d%H%M%S%f')
+        route, _created = Route.objects.get_or_create(origin='Stress Origin', destination='Stress Destination')
+        departure = timezone.now() + timedelta(days=7)
+        bus = Bus.objects.create(
+            route=route, bus_number=f"STRESS-{tag}"[:20], departure_time=departure,
+            arrival_time=departure + timedelta(hours=4), total_seats=options['seats'],
+            available_seats=options['seats'], fare=Decimal('100.00'),
+        )
+        users = [
+            User.objects.create_user(email=f"stress-{tag}-{i}@example.com", full_name=f"Stress User {i}",
+                                     password=None)
+            for i in range(options['threads'])
+        ]
+        Wallet.objects.filter(user__in=users).update(balance=Decimal('1000000.00'))
+
+        outcomes = Counter()
+        lock = threading.Lock()
+
+        def attempt(number):
+            user = User.objects.get(pk=users[number % len(users)].pk)
+            party = random.randint(1, options['party_size'])
+            seats = ','.join(str(seat) for seat in random.sample(range(1, options['seats'] + 1), party))
+            passenger = {'name': user.full_name, 'age': 30, 'gender': 'O'}
+            try:
+                create_booking(user, Bus.objects.get(pk=bus.pk), seats, Decimal('100.00') * party,
+                               [passenger] * party)
+                result = 'booked'
+            except Exception as e:
+                result = type(e).__name__
+            finally:
+                connections.close_all()
+            with lock:
+                outcomes[result] += 1
+
+        try:
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                list(pool.map(attempt, range(options['bookings'])))
+
+            bus.refresh_from_db()
+            booked_seats = SeatAllocation.objects.filter(bus=bus).count()
+            seat_counts = Counter(SeatAllocation.objects.filter(bus=bus).values_list('seat_no', flat=True))
+            double_sold = [seat for seat, count in seat_counts.items() if count > 1]
+            passengers = sum(ticket.passengers.count() for ticket in Ticket.objects.filter(bus=bus, status='BOOKED'))
+
+            for result, count in sorted(outcomes.items()):
+                self.stdout.write(f"  {result}: {count}")
+            self.stdout.write(f"Available seats: {bus.available_seats}/{bus.total_seats}")
+            self.stdout.write(f"Allocated seats: {booked_seats}, booked passengers: {passengers}")
+
+            problems = []
+            if bus.available_seats < 0:
+                problems.append('available seats went negative')
+            if bus.total_seats - bus.available_seats != booked_seats:
+                problems.append('seat counter does not match allocations (lost update or double decrement)')
+            if passengers != booked_seats:
+                problems.append('passenger count does not match allocations')
+            if double_sold:
+                problems.append(f"seats sold more than once: {sorted(double_sold)}")
+
+            if problems:
+                for problem in problems:
+                    self.stdout.write(self.style.ERROR(f"❌ {problem}"))
+                sys.exit(1)
+            self.stdout.write(self.style.SUCCESS('✅ No overselling detected.'))
+        finally:
+            if not options['keep']:
+                Passenger.objects.filter(tickets__bus=bus).delete()
+                Ticket.objects.filter(bus=bus).delete()
+                bus.delete()
+                User.objects.filter(pk__in=[user.pk for user in users]).delete()
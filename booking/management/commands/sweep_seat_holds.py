@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from booking.holds import sweep_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Delete expired checkout seat holds and refresh the seat maps that showed them (run every minute)'
+
+    def handle(self, *args, **options):
+        swept = sweep_expired_holds()
+        self.stdout.write(self.style.SUCCESS(f"Removed {swept} expired seat holds."))
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0012_ticket_end_stop_ticket_start_stop'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatOccupancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seats', models.PositiveIntegerField(verbose_name='seats')),
+                ('legs', models.PositiveIntegerField(verbose_name='legs')),
+                ('bitmap', models.BinaryField(default=b'', verbose_name='occupancy bitmap')),
+                ('bus', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='occupancy', to='booking.bus')),
+                ('multistop_bus', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='occupancy', to='booking.multistopbus')),
+            ],
+            options={
+                'verbose_name': 'seat occupancy',
+                'verbose_name_plural': 'seat occupancies',
+            },
+        ),
+    ]
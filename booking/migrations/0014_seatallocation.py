@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0013_seatoccupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seat_no', models.PositiveIntegerField(verbose_name='seat number')),
+                ('start_seq', models.PositiveIntegerField(verbose_name='leg start sequence')),
+                ('end_seq', models.PositiveIntegerField(verbose_name='leg end sequence')),
+                ('bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_allocations', to='booking.bus')),
+                ('multistop_bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_allocations', to='booking.multistopbus')),
+                ('multistop_ticket', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_allocations', to='booking.multistopticket')),
+                ('ticket', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_allocations', to='booking.ticket')),
+            ],
+            options={
+                'verbose_name': 'seat allocation',
+                'verbose_name_plural': 'seat allocations',
+                'constraints': [models.UniqueConstraint(condition=models.Q(('bus__isnull', False)), fields=('bus', 'seat_no', 'start_seq'), name='unique_bus_seat_leg'), models.UniqueConstraint(condition=models.Q(('multistop_bus__isnull', False)), fields=('multistop_bus', 'seat_no', 'start_seq'), name='unique_multistop_bus_seat_leg'), models.CheckConstraint(condition=models.Q(('start_seq__lt', models.F('end_seq'))), name='seat_allocation_leg_order')],
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:30
+
+from django.db import migrations
+
+
+def parse_seats(seat_numbers):
+    """Numeric seats from a comma-separated string, skipping malformed entries."""
+    return [int(seat.strip()) for seat in (seat_numbers or '').split(',') if seat.strip().isdigit()]
+
+
+def backfill_seat_allocations(apps, schema_editor):
+    """
+    Create SeatAllocation rows (one per seat per leg) for every booked ticket.
+    Seats that were already double-sold keep the first allocation written.
+    """
+    Ticket = apps.get_model('booking', 'Ticket')
+    MultiStopTicket = apps.get_model('booking', 'MultiStopTicket')
+    RouteStop = apps.get_model('booking', 'RouteStop')
+    SeatAllocation = apps.get_model('booking', 'SeatAllocation')
+    SeatOccupancy = apps.get_model('booking', 'SeatOccupancy')
+
+    batch = []
+    tickets = Ticket.objects.filter(status='BOOKED').order_by('booking_time', 'id')
+    for ticket_id, bus_id, seat_numbers in tickets.values_list('id', 'bus_id', 'seat_numbers').iterator():
+        for seat in parse_seats(seat_numbers):
+            batch.append(SeatAllocation(bus_id=bus_id, ticket_id=ticket_id, seat_no=seat, start_seq=0, end_seq=1))
+
+    route_sequences = {}
+    for route_id, sequence in RouteStop.objects.order_by('route_id', 'sequence').values_list('route_id', 'sequence'):
+        route_sequences.setdefault(route_id, []).append(sequence)
+
+    multistop_tickets = MultiStopTicket.objects.filter(status='BOOKED').order_by('booking_time', 'id').values_list(
+        'id', 'bus_id', 'bus__route_id', 'start_stop__sequence', 'end_stop__sequence', 'seat_numbers')
+    for ticket_id, bus_id, route_id, start_seq, end_seq, seat_numbers in multistop_tickets.iterator():
+        sequences = [sequence for sequence in route_sequences.get(route_id, []) if start_seq <= sequence <= end_seq]
+        legs = list(zip(sequences, sequences[1:]))
+        for seat in parse_seats(seat_numbers):
+            for leg_start, leg_end in legs:
+                batch.append(SeatAllocation(multistop_bus_id=bus_id, multistop_ticket_id=ticket_id,
+                                            seat_no=seat, start_seq=leg_start, end_seq=leg_end))
+
+    SeatAllocation.objects.bulk_create(batch, batch_size=500, ignore_conflicts=True)
+
+    # Bitmaps written before this migration were built from the seat strings;
+    # drop them so they are rebuilt from the allocations on next use.
+    SeatOccupancy.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0014_seatallocation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_seat_allocations, migrations.RunPython.noop),
+    ]
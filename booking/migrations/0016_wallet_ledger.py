@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0015_backfill_seat_allocations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='balance_after',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Wallet balance right after this entry was applied', max_digits=10, null=True, verbose_name='balance after'),
+        ),
+        migrations.CreateModel(
+            name='WalletSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='balance')),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='taken at')),
+                ('last_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='booking.transaction')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='booking.wallet')),
+            ],
+            options={
+                'verbose_name': 'wallet snapshot',
+                'verbose_name_plural': 'wallet snapshots',
+                'ordering': ['-taken_at'],
+                'indexes': [models.Index(fields=['wallet', '-id'], name='wallet_snapshot_latest')],
+            },
+        ),
+    ]
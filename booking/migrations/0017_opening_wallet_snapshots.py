@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:10
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def create_opening_snapshots(apps, schema_editor):
+    """
+    Checkpoint every wallet at its current balance. History written before the
+    ledger double-recorded payments and refunds, so reconciliation starts here.
+    """
+    Wallet = apps.get_model('booking', 'Wallet')
+    Transaction = apps.get_model('booking', 'Transaction')
+    WalletSnapshot = apps.get_model('booking', 'WalletSnapshot')
+
+    now = timezone.now()
+    snapshots = []
+    for wallet_id, balance in Wallet.objects.values_list('id', 'balance').iterator():
+        last_transaction = Transaction.objects.filter(wallet_id=wallet_id).order_by('-id').values_list(
+            'id', flat=True).first()
+        snapshots.append(WalletSnapshot(wallet_id=wallet_id, balance=balance,
+                                        last_transaction_id=last_transaction, taken_at=now))
+    WalletSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0016_wallet_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_opening_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:36
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_passenger_counts(apps, schema_editor):
+    """Store the current number of passengers on every ticket."""
+    for model_name, column in (('Ticket', 'ticket'), ('MultiStopTicket', 'multistopticket')):
+        model = apps.get_model('booking', model_name)
+        through = model.passengers.through
+        counts = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(column).annotate(
+            total=Count('pk')).values('total')
+        model.objects.update(passenger_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0017_opening_wallet_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='multistopticket',
+            name='passenger_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='passenger count'),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='passenger_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='passenger count'),
+        ),
+        migrations.RunPython(backfill_passenger_counts, migrations.RunPython.noop),
+    ]
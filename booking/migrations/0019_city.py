@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0018_ticket_passenger_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='city name')),
+                ('normalized_name', models.CharField(editable=False, max_length=100, unique=True, verbose_name='normalized name')),
+            ],
+            options={
+                'verbose_name': 'city',
+                'verbose_name_plural': 'cities',
+                'ordering': ['name'],
+                'indexes': [models.Index(fields=['normalized_name'], name='city_name_prefix', opclasses=['varchar_pattern_ops'])],
+            },
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='destination_city',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='arriving_routes', to='booking.city'),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='origin_city',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='departing_routes', to='booking.city'),
+        ),
+        migrations.AddField(
+            model_name='routestop',
+            name='canonical_city',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='stops', to='booking.city'),
+        ),
+        migrations.CreateModel(
+            name='CityAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(max_length=100, verbose_name='alias')),
+                ('normalized_alias', models.CharField(editable=False, max_length=100, unique=True, verbose_name='normalized alias')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='booking.city')),
+            ],
+            options={
+                'verbose_name': 'city alias',
+                'verbose_name_plural': 'city aliases',
+                'indexes': [models.Index(fields=['normalized_alias'], name='city_alias_prefix', opclasses=['varchar_pattern_ops'])],
+            },
+        ),
+    ]
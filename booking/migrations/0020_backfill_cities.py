@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+from django.db import migrations
+
+
+def normalize(name):
+    return ' '.join((name or '').split()).casefold()
+
+
+def backfill_cities(apps, schema_editor):
+    """
+    Create a City for every distinct route origin/destination and stop city,
+    and point the new foreign keys at them.
+    """
+    City = apps.get_model('booking', 'City')
+    Route = apps.get_model('booking', 'Route')
+    RouteStop = apps.get_model('booking', 'RouteStop')
+
+    names = {}
+    for origin, destination in Route.objects.values_list('origin', 'destination'):
+        for name in (origin, destination):
+            names.setdefault(normalize(name), ' '.join(name.split()))
+    for name in RouteStop.objects.values_list('city', flat=True):
+        names.setdefault(normalize(name), ' '.join(name.split()))
+    names.pop('', None)
+
+    City.objects.bulk_create(
+        [City(name=name, normalized_name=normalized) for normalized, name in names.items()],
+        ignore_conflicts=True,
+    )
+    city_ids = dict(City.objects.values_list('normalized_name', 'id'))
+
+    routes = list(Route.objects.all())
+    for route in routes:
+        route.origin_city_id = city_ids.get(normalize(route.origin))
+        route.destination_city_id = city_ids.get(normalize(route.destination))
+    Route.objects.bulk_update(routes, ['origin_city', 'destination_city'], batch_size=500)
+
+    stops = list(RouteStop.objects.all())
+    for stop in stops:
+        stop.canonical_city_id = city_ids.get(normalize(stop.city))
+    RouteStop.objects.bulk_update(stops, ['canonical_city'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0019_city'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_cities, migrations.RunPython.noop),
+    ]
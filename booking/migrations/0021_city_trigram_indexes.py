@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+from django.db import migrations
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """
+    On PostgreSQL, enable pg_trgm and index city names and aliases for
+    substring (LIKE '%x%') and similarity search. Other backends skip this.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS city_name_trgm ON booking_city USING gin (normalized_name gin_trgm_ops)'
+    )
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS city_alias_trgm ON booking_cityalias USING gin (normalized_alias gin_trgm_ops)'
+    )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS city_name_trgm')
+    schema_editor.execute('DROP INDEX IF EXISTS city_alias_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0020_backfill_cities'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
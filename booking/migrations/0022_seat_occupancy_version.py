@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0021_city_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seatoccupancy',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='version'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0022_seat_occupancy_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeatHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seat_no', models.PositiveIntegerField(verbose_name='seat number')),
+                ('start_seq', models.PositiveIntegerField(verbose_name='leg start sequence')),
+                ('end_seq', models.PositiveIntegerField(verbose_name='leg end sequence')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='expires at')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_holds', to='booking.bus')),
+                ('multistop_bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seat_holds', to='booking.multistopbus')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seat_holds', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'seat hold',
+                'verbose_name_plural': 'seat holds',
+                'constraints': [models.UniqueConstraint(condition=models.Q(('bus__isnull', False)), fields=('bus', 'seat_no', 'start_seq'), name='unique_bus_seat_hold'), models.UniqueConstraint(condition=models.Q(('multistop_bus__isnull', False)), fields=('multistop_bus', 'seat_no', 'start_seq'), name='unique_multistop_bus_seat_hold')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:54
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0023_seat_hold'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CancellationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed')], default='PENDING', max_length=20, verbose_name='status')),
+                ('refund_percent', models.DecimalField(decimal_places=2, default=Decimal('100.00'), max_digits=5, verbose_name='refund percent')),
+                ('total_tickets', models.PositiveIntegerField(default=0, verbose_name='total tickets')),
+                ('processed_tickets', models.PositiveIntegerField(default=0, verbose_name='processed tickets')),
+                ('refunded_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12, verbose_name='refunded amount')),
+                ('last_ticket_id', models.PositiveIntegerField(default=0, verbose_name='last ticket id')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='cancellation_jobs', to='booking.bus')),
+                ('multistop_bus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='cancellation_jobs', to='booking.multistopbus')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'cancellation job',
+                'verbose_name_plural': 'cancellation jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0024_cancellation_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('XLSX', 'Excel'), ('CSV', 'CSV')], default='XLSX', max_length=4, verbose_name='format')),
+                ('is_multi_stop', models.BooleanField(default=False, verbose_name='multi-stop buses')),
+                ('bus_ids', models.JSONField(default=list, verbose_name='bus ids')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed')], default='PENDING', max_length=20, verbose_name='status')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='rows')),
+                ('file_name', models.CharField(blank=True, max_length=255, verbose_name='file name')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'booking export',
+                'verbose_name_plural': 'booking exports',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
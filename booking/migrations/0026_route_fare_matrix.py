@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0025_booking_export'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteFareMatrix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cells', models.JSONField(default=dict, verbose_name='cells')),
+                ('built_at', models.DateTimeField(auto_now=True, verbose_name='built at')),
+                ('route', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fare_matrix', to='booking.multistoproute')),
+            ],
+            options={
+                'verbose_name': 'route fare matrix',
+                'verbose_name_plural': 'route fare matrices',
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:21
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def drop_fare_matrices(apps, schema_editor):
+    """Matrices built with JSON cells are rebuilt as RouteStopFare rows on first use."""
+    apps.get_model('booking', 'RouteFareMatrix').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0026_route_fare_matrix'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_fare_matrices, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='routefarematrix',
+            name='cells',
+        ),
+        migrations.AddField(
+            model_name='bus',
+            name='price_multiplier',
+            field=models.DecimalField(decimal_places=6, default=Decimal('1'), editable=False, max_digits=8, verbose_name='price multiplier'),
+        ),
+        migrations.AddField(
+            model_name='multistopbus',
+            name='price_multiplier',
+            field=models.DecimalField(decimal_places=6, default=Decimal('1'), editable=False, max_digits=8, verbose_name='price multiplier'),
+        ),
+        migrations.CreateModel(
+            name='RouteStopFare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True, verbose_name='distance (km)')),
+                ('duration', models.DurationField(blank=True, null=True, verbose_name='journey time')),
+                ('fare_multiplier', models.DecimalField(decimal_places=2, max_digits=6, verbose_name='fare multiplier')),
+                ('end_stop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.routestop')),
+                ('matrix', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fares', to='booking.routefarematrix')),
+                ('segment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='booking.routesegment')),
+                ('start_stop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.routestop')),
+            ],
+            options={
+                'verbose_name': 'route stop fare',
+                'verbose_name_plural': 'route stop fares',
+                'constraints': [models.UniqueConstraint(fields=('start_stop', 'end_stop'), name='route_stop_fare_pair_uniq')],
+            },
+        ),
+    ]
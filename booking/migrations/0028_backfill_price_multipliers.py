@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Sum
+from django.utils import timezone
+
+
+def backfill_price_multipliers(apps, schema_editor):
+    """Price upcoming buses, which bookings and search now both read from price_multiplier."""
+    from booking.pricing import yield_multiplier
+
+    if not settings.BOOKING_DYNAMIC_PRICING:
+        return
+    now = timezone.now()
+    since = now - timedelta(hours=settings.BOOKING_PRICING_DEMAND_HOURS)
+    for bus_model, ticket_model in (('Bus', 'Ticket'), ('MultiStopBus', 'MultiStopTicket')):
+        buses = list(apps.get_model('booking', bus_model).objects.filter(is_active=True, departure_time__gt=now))
+        sales = dict(apps.get_model('booking', ticket_model).objects
+                     .filter(bus__is_active=True, bus__departure_time__gt=now, status='BOOKED',
+                             booking_time__gte=since)
+                     .values_list('bus_id')
+                     .annotate(seats=Sum('passenger_count')))
+        for bus in buses:
+            bus.price_multiplier = yield_multiplier(bus, sales.get(bus.pk) or 0, now)
+        apps.get_model('booking', bus_model).objects.bulk_update(buses, ['price_multiplier'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0027_ranked_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_price_multipliers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+
+def build_fare_matrices(apps, schema_editor):
+    """Store the matrix of every route that has none; reads no longer build them."""
+    from booking.fares import compute_cells
+
+    RouteFareMatrix = apps.get_model('booking', 'RouteFareMatrix')
+    RouteStop = apps.get_model('booking', 'RouteStop')
+    RouteSegment = apps.get_model('booking', 'RouteSegment')
+    RouteStopFare = apps.get_model('booking', 'RouteStopFare')
+
+    built = RouteFareMatrix.objects.values_list('route_id', flat=True)
+    for route_id in apps.get_model('booking', 'MultiStopRoute').objects.exclude(pk__in=built) \
+            .values_list('pk', flat=True).iterator():
+        stops = list(RouteStop.objects.filter(route_id=route_id).order_by('sequence'))
+        cells = compute_cells(stops, RouteSegment.objects.filter(route_id=route_id))
+        matrix = RouteFareMatrix.objects.create(route_id=route_id)
+        RouteStopFare.objects.bulk_create([
+            RouteStopFare(matrix=matrix, start_stop_id=start_id, end_stop_id=end_id, distance=distance,
+                          duration=duration, fare_multiplier=multiplier, segment_id=segment_id)
+            for (start_id, end_id), (distance, duration, multiplier, segment_id) in cells.items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0028_backfill_price_multipliers'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_fare_matrices, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,80 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.core.validators import MinValueValidator
 from decimal import Decimal
-from django.db.models import Q
+from django.db.models import Q, F, Sum, Case, When
 from django.db.models.query import EmptyQuerySet
 from itertools import chain
 
 
+def normalize_city_name(name):
+    """
+    Canonical form of a city name for lookups (case and whitespace insensitive).
+    """
+    return ' '.join((name or '').split()).casefold()
+
+
+class City(models.Model):
+    """
+    Canonical city referenced by routes and route stops, looked up by normalized name.
+    """
+    name = models.CharField(_('city name'), max_length=100)
+    normalized_name = models.CharField(_('normalized name'), max_length=100, unique=True, editable=False)
+    
+    class Meta:
+        verbose_name = _('city')
+        verbose_name_plural = _('cities')
+        ordering = ['name']
+        indexes = [
+            # Prefix (LIKE 'x%') lookups for autocomplete; the pattern opclass only applies on PostgreSQL
+            models.Index(fields=['normalized_name'], name='city_name_prefix', opclasses=['varchar_pattern_ops']),
+        ]
+    
+    def __str__(self):
+        return self.name
+    
+    def save(self, *args, **kwargs):
+        self.name = ' '.join(self.name.split())
+        self.normalized_name = normalize_city_name(self.name)
+        super().save(*args, **kwargs)
+
+
+class CityAlias(models.Model):
+    """
+    Alternative spelling or old name of a city (e.g. Bombay for Mumbai).
+    """
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='aliases')
+    alias = models.CharField(_('alias'), max_length=100)
+    normalized_alias = models.CharField(_('normalized alias'), max_length=100, unique=True, editable=False)
+    
+    class Meta:
+        verbose_name = _('city alias')
+        verbose_name_plural = _('city aliases')
+        indexes = [
+            models.Index(fields=['normalized_alias'], name='city_alias_prefix', opclasses=['varchar_pattern_ops']),
+        ]
+    
+    def __str__(self):
+        return f"{self.alias} → {self.city.name}"
+    
+    def save(self, *args, **kwargs):
+        self.normalized_alias = normalize_city_name(self.alias)
+        super().save(*args, **kwargs)
+
+
 class Route(models.Model):
     """
     Simple Route model for bus journeys from one city to another.
     """
     origin = models.CharField(_('origin city'), max_length=100)
     destination = models.CharField(_('destination city'), max_length=100)
+    # Canonical cities for the free-text names above, resolved on save
+    origin_city = models.ForeignKey(City, on_delete=models.PROTECT, null=True, blank=True, editable=False,
+                                    related_name='departing_routes')
+    destination_city = models.ForeignKey(City, on_delete=models.PROTECT, null=True, blank=True, editable=False,
+                                         related_name='arriving_routes')
     distance = models.DecimalField(_('distance (km)'), max_digits=8, decimal_places=2, null=True, blank=True)
     estimated_duration = models.DurationField(_('estimated journey time'), null=True, blank=True)
     
@@ -25,6 +85,12 @@ class Route(models.Model):
     
     def __str__(self):
         return f"{self.origin} to {self.destination}"
+    
+    def save(self, *args, **kwargs):
+        from booking.cities import resolve_city
+        self.origin_city = resolve_city(self.origin)
+        self.destination_city = resolve_city(self.destination)
+        super().save(*args, **kwargs)
 
 
 class MultiStopRoute(models.Model):
@@ -68,6 +134,9 @@ class RouteStop(models.Model):
     """
     route = models.ForeignKey(MultiStopRoute, on_delete=models.CASCADE, related_name='stops')
     city = models.CharField(_('city name'), max_length=100)
+    # Canonical city for the free-text name above, resolved on save
+    canonical_city = models.ForeignKey(City, on_delete=models.PROTECT, null=True, blank=True, editable=False,
+                                       related_name='stops')
     sequence = models.PositiveIntegerField(_('stop sequence'))
     arrival_offset = models.DurationField(_('arrival time offset'), null=True, blank=True,
                                         help_text=_("Time offset from route start for arrival"))
@@ -85,6 +154,11 @@ class RouteStop(models.Model):
     def __str__(self):
         return f"{self.city} (Stop #{self.sequence})"
     
+    def save(self, *args, **kwargs):
+        from booking.cities import resolve_city
+        self.canonical_city = resolve_city(self.city)
+        super().save(*args, **kwargs)
+    
     def get_arrival_time(self, bus_departure_time):
         """Calculate actual arrival time based on bus departure and offset"""
         if self.arrival_offset:
@@ -131,6 +205,49 @@ class RouteSegment(models.Model):
         return self.end_stop.get_arrival_time(bus_departure_time)
 
 
+class RouteFareMatrix(models.Model):
+    """
+    Marks a multi-stop route's stop-to-stop fare matrix as built. Its
+    RouteStopFare rows give the distance, duration and fare multiplier
+    between every pair of stops; booking.fares builds them from the
+    route's RouteSegments and rebuilds them whenever a stop or segment of
+    the route changes.
+    """
+    route = models.OneToOneField(MultiStopRoute, on_delete=models.CASCADE, related_name='fare_matrix')
+    built_at = models.DateTimeField(_('built at'), auto_now=True)
+    
+    class Meta:
+        verbose_name = _('route fare matrix')
+        verbose_name_plural = _('route fare matrices')
+    
+    def __str__(self):
+        return f"Fare matrix for {self.route.name}"
+
+
+class RouteStopFare(models.Model):
+    """
+    One cell of a route fare matrix: boarding at start_stop and alighting at end_stop.
+    """
+    matrix = models.ForeignKey(RouteFareMatrix, on_delete=models.CASCADE, related_name='fares')
+    start_stop = models.ForeignKey(RouteStop, on_delete=models.CASCADE, related_name='+')
+    end_stop = models.ForeignKey(RouteStop, on_delete=models.CASCADE, related_name='+')
+    distance = models.DecimalField(_('distance (km)'), max_digits=10, decimal_places=2, null=True, blank=True)
+    duration = models.DurationField(_('journey time'), null=True, blank=True)
+    fare_multiplier = models.DecimalField(_('fare multiplier'), max_digits=6, decimal_places=2)
+    # The RouteSegment entered for this pair; pairs without one are chained from several
+    segment = models.ForeignKey(RouteSegment, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    
+    class Meta:
+        verbose_name = _('route stop fare')
+        verbose_name_plural = _('route stop fares')
+        constraints = [
+            models.UniqueConstraint(fields=['start_stop', 'end_stop'], name='route_stop_fare_pair_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.start_stop_id} to {self.end_stop_id} (x{self.fare_multiplier})"
+
+
 class MultiStopBus(models.Model):
     """
     Bus model with route, timings, and seat details for multi-stop routes.
@@ -159,6 +276,9 @@ class MultiStopBus(models.Model):
     # Additional seat class fares
     sleeper_fare = models.DecimalField(_('sleeper fare'), max_digits=10, decimal_places=2, null=True, blank=True)
     luxury_fare = models.DecimalField(_('luxury fare'), max_digits=10, decimal_places=2, null=True, blank=True)
+    # Dynamic pricing multiplier, kept current by booking.pricing; search ranks fares with it
+    price_multiplier = models.DecimalField(_('price multiplier'), max_digits=8, decimal_places=6,
+                                           default=Decimal('1'), editable=False)
     
     # Seat class availability
     has_general_seats = models.BooleanField(_('has general seats'), default=True)
@@ -238,18 +358,9 @@ class MultiStopBus(models.Model):
         Check seat availability for a specific segment.
         Takes into account overlapping bookings on other segments.
         """
-        # Get all tickets for this bus
-        booked_tickets = MultiStopTicket.objects.filter(bus=self, status='BOOKED')
-        
-        # Count seats booked on this segment or overlapping segments
-        booked_seats_count = 0
-        for ticket in booked_tickets:
-            # Check if the ticket's segment overlaps with the requested segment
-            if (ticket.start_stop.sequence <= segment.end_stop.sequence and 
-                ticket.end_stop.sequence >= segment.start_stop.sequence):
-                booked_seats_count += ticket.passenger_count
-        
-        return self.total_seats - booked_seats_count
+        # Answered from the seat x leg occupancy bitmap, no ticket scan
+        from booking.occupancy import segment_availability
+        return segment_availability(self, segment.start_stop, segment.end_stop)
 
 
 class Bus(models.Model):
@@ -280,6 +391,9 @@ class Bus(models.Model):
     # Additional seat class fares
     sleeper_fare = models.DecimalField(_('sleeper fare'), max_digits=10, decimal_places=2, null=True, blank=True)
     luxury_fare = models.DecimalField(_('luxury fare'), max_digits=10, decimal_places=2, null=True, blank=True)
+    # Dynamic pricing multiplier, kept current by booking.pricing; search ranks fares with it
+    price_multiplier = models.DecimalField(_('price multiplier'), max_digits=8, decimal_places=6,
+                                           default=Decimal('1'), editable=False)
     
     # Seat class availability
     has_general_seats = models.BooleanField(_('has general seats'), default=True)
@@ -387,50 +501,94 @@ class Wallet(models.Model):
     def __str__(self):
         return f"{self.user.email}'s Wallet (₹{self.balance})"
     
-    def deposit(self, amount, description=None):
-        """Add funds to wallet"""
-        if amount <= 0:
-            return False
-        
-        # Ensure amount is a Decimal
-        if not isinstance(amount, Decimal):
-            amount = Decimal(str(float(amount)))
-        
-        self.balance += amount
-        self.save()
-        
-        # Create transaction record
-        Transaction.objects.create(
+    def _post(self, amount, transaction_type, description, related_ticket=None, related_multistop_ticket=None):
+        """
+        Append a ledger row for a balance change that has just been applied.
+        Reads the balance back inside the same transaction, so the row records
+        the exact balance this change produced.
+        """
+        self.balance, self.updated_at = Wallet.objects.filter(pk=self.pk).values_list(
+            'balance', 'updated_at').get()
+        return Transaction.objects.create(
             wallet=self,
             amount=amount,
-            transaction_type='DEPOSIT',
-            description=description or f"Deposit of ₹{amount}"
+            transaction_type=transaction_type,
+            description=description,
+            balance_after=self.balance,
+            related_ticket=related_ticket,
+            related_multistop_ticket=related_multistop_ticket,
         )
-        
-        return True
     
-    def withdraw(self, amount):
-        """Withdraw funds from wallet"""
-        if amount <= 0 or amount > self.balance:
+    def deposit(self, amount, description=None, transaction_type='DEPOSIT',
+                related_ticket=None, related_multistop_ticket=None):
+        """Add funds to wallet (deposits and refunds)"""
+        # Ensure amount is a Decimal
+        if not isinstance(amount, Decimal):
+            amount = Decimal(str(amount))
+        amount = amount.quantize(Decimal('0.01'))
+        if amount <= 0:
             return False
         
+        # No savepoint needed: nothing is written unless both statements succeed
+        with transaction.atomic(savepoint=False):
+            # Single UPDATE ... SET balance = balance + amount; never loses a concurrent change
+            Wallet.objects.filter(pk=self.pk).update(balance=F('balance') + amount, updated_at=timezone.now())
+            self._post(amount, transaction_type, description or f"Deposit of ₹{amount}",
+                       related_ticket, related_multistop_ticket)
+        
+        return True
+    
+    def withdraw(self, amount, description=None, transaction_type='WITHDRAW',
+                 related_ticket=None, related_multistop_ticket=None):
+        """Withdraw funds from wallet (withdrawals and payments)"""
         # Ensure amount is a Decimal
         if not isinstance(amount, Decimal):
-            amount = Decimal(str(float(amount)))
-        
-        self.balance -= amount
-        self.save()
+            amount = Decimal(str(amount))
+        amount = amount.quantize(Decimal('0.01'))
+        if amount <= 0:
+            return False
         
-        # Create transaction record
-        Transaction.objects.create(
-            wallet=self,
-            amount=amount,
-            transaction_type='WITHDRAW',
-            description=f"Withdrawal of ₹{amount}"
-        )
+        with transaction.atomic(savepoint=False):
+            # Conditional UPDATE: the balance check and the debit happen in one
+            # statement, so a stale in-memory balance can never overdraw the wallet
+            debited = Wallet.objects.filter(pk=self.pk, balance__gte=amount).update(
+                balance=F('balance') - amount, updated_at=timezone.now())
+            if not debited:
+                return False
+            self._post(amount, transaction_type, description or f"Withdrawal of ₹{amount}",
+                       related_ticket, related_multistop_ticket)
         
         return True
     
+    def ledger_balance(self):
+        """
+        Balance computed from the ledger: the latest snapshot plus the signed
+        sum of the transactions recorded after it.
+        """
+        snapshot = self.snapshots.order_by('-id').first()
+        transactions = self.transactions.all()
+        balance = Decimal('0.00')
+        if snapshot:
+            balance = snapshot.balance
+            if snapshot.last_transaction_id:
+                transactions = transactions.filter(id__gt=snapshot.last_transaction_id)
+        delta = transactions.aggregate(total=Sum(Case(
+            When(transaction_type__in=Transaction.CREDIT_TYPES, then=F('amount')),
+            default=-F('amount'),
+        )))['total']
+        return balance + (delta or Decimal('0.00'))
+    
+    def take_snapshot(self):
+        """
+        Record the current balance against the latest ledger row, so later
+        reconciliation only has to sum transactions written after it.
+        """
+        with transaction.atomic():
+            # Lock the wallet so no balance change lands between the two reads
+            balance = Wallet.objects.select_for_update().filter(pk=self.pk).values_list('balance', flat=True).get()
+            last_transaction = self.transactions.order_by('-id').first()
+            return WalletSnapshot.objects.create(wallet=self, balance=balance, last_transaction=last_transaction)
+    
     def has_sufficient_balance(self, amount):
         """Check if wallet has sufficient balance"""
         return self.balance >= amount
@@ -446,12 +604,16 @@ class Transaction(models.Model):
         ('PAYMENT', _('Payment')),
         ('REFUND', _('Refund')),
     )
+    # Types that add to the balance; the others are debits
+    CREDIT_TYPES = ('DEPOSIT', 'REFUND')
     
     wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='transactions')
     amount = models.DecimalField(_('amount'), max_digits=10, decimal_places=2)
     transaction_type = models.CharField(_('transaction type'), max_length=20, choices=TRANSACTION_TYPES)
     description = models.CharField(_('description'), max_length=255, blank=True)
     timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
+    balance_after = models.DecimalField(_('balance after'), max_digits=10, decimal_places=2, null=True, blank=True,
+                                        help_text="Wallet balance right after this entry was applied")
     related_ticket = models.ForeignKey('Ticket', on_delete=models.SET_NULL, null=True, blank=True, 
                                        related_name='transactions')
     related_multistop_ticket = models.ForeignKey('MultiStopTicket', on_delete=models.SET_NULL, null=True, blank=True, 
@@ -464,6 +626,34 @@ class Transaction(models.Model):
     
     def __str__(self):
         return f"{self.transaction_type} - ₹{self.amount} - {self.timestamp.strftime('%d %b %Y, %H:%M')}"
+    
+    @property
+    def signed_amount(self):
+        """Amount as applied to the balance (negative for debits)"""
+        return self.amount if self.transaction_type in self.CREDIT_TYPES else -self.amount
+
+
+class WalletSnapshot(models.Model):
+    """
+    Periodic checkpoint of a wallet balance. The ledger balance is the latest
+    snapshot plus every transaction with a higher id than last_transaction.
+    """
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='snapshots')
+    balance = models.DecimalField(_('balance'), max_digits=10, decimal_places=2)
+    last_transaction = models.ForeignKey(Transaction, on_delete=models.SET_NULL, null=True, blank=True,
+                                         related_name='+')
+    taken_at = models.DateTimeField(_('taken at'), default=timezone.now)
+    
+    class Meta:
+        verbose_name = _('wallet snapshot')
+        verbose_name_plural = _('wallet snapshots')
+        ordering = ['-taken_at']
+        indexes = [
+            models.Index(fields=['wallet', '-id'], name='wallet_snapshot_latest'),
+        ]
+    
+    def __str__(self):
+        return f"{self.wallet.user.email} - ₹{self.balance} @ {self.taken_at.strftime('%d %b %Y, %H:%M')}"
 
 
 class Ticket(models.Model):
@@ -484,6 +674,8 @@ class Ticket(models.Model):
     total_fare = models.DecimalField(_('total fare'), max_digits=10, decimal_places=2)
     seat_numbers = models.CharField(_('seat numbers'), max_length=255, help_text="Comma-separated seat numbers")
     seat_class = models.CharField(_('seat class'), max_length=20, choices=Bus.SEAT_CLASS_CHOICES, default='GENERAL')
+    # Denormalized len(passengers); kept in sync by booking.signals and the booking service
+    passenger_count = models.PositiveIntegerField(_('passenger count'), default=0, editable=False)
     
     # For multi-stop routes - optional fields
     start_stop = models.ForeignKey('RouteStop', null=True, blank=True, on_delete=models.SET_NULL, related_name='departing_tickets')
@@ -497,44 +689,27 @@ class Ticket(models.Model):
     def __str__(self):
         return f"Ticket #{self.id} - {self.user.email} - {self.bus.bus_number}"
     
-    @property
-    def passenger_count(self):
-        return self.passengers.count()
-    
     def cancel(self):
         """Cancel the ticket and update available seats."""
-        if self.status == 'BOOKED':
+        with transaction.atomic():
+            # Claim the ticket with a conditional UPDATE, so that of two racing cancellations
+            # (or one racing a bus cancellation job) only one returns the seats and refunds
+            if not Ticket.objects.filter(pk=self.pk, status='BOOKED').update(status='CANCELLED'):
+                return False
             self.status = 'CANCELLED'
-            self.bus.available_seats += self.passenger_count
-            self.bus.save()
-            self.save()
             
-            # Process refund to wallet
-            try:
-                wallet = self.user.wallet
-                wallet.deposit(self.total_fare)
-                
-                # Update transaction description
-                latest_transaction = wallet.transactions.latest('timestamp')
-                latest_transaction.transaction_type = 'REFUND'
-                latest_transaction.description = f"Refund for cancelled ticket #{self.id}"
-                latest_transaction.related_ticket = self
-                latest_transaction.save()
-                
-            except Wallet.DoesNotExist:
-                # If user doesn't have a wallet, create one and deposit refund
-                wallet = Wallet.objects.create(user=self.user)
-                wallet.deposit(self.total_fare)
-                
-                # Update transaction
-                latest_transaction = wallet.transactions.latest('timestamp')
-                latest_transaction.transaction_type = 'REFUND'
-                latest_transaction.description = f"Refund for cancelled ticket #{self.id}"
-                latest_transaction.related_ticket = self
-                latest_transaction.save()
+            # Return the seats with an atomic UPDATE and free them in the occupancy bitmap
+            from booking.services import return_seat_count
+            from booking.occupancy import release_ticket_seats
+            return_seat_count(self.bus, self.passenger_count)
+            release_ticket_seats(self)
             
-            return True
-        return False
+            # Process refund to wallet (create one if the user has none)
+            wallet, _created = Wallet.objects.get_or_create(user=self.user)
+            wallet.deposit(self.total_fare, f"Refund for cancelled ticket #{self.id}",
+                           transaction_type='REFUND', related_ticket=self)
+        
+        return True
     
     def book_with_wallet(self):
         """
@@ -542,19 +717,9 @@ class Ticket(models.Model):
         """
         try:
             wallet = self.user.wallet
-            if wallet.has_sufficient_balance(self.total_fare):
-                # Create a transaction for the payment
-                transaction = Transaction.objects.create(
-                    wallet=wallet,
-                    amount=self.total_fare,
-                    transaction_type='PAYMENT',
-                    description=f"Payment for ticket #{self.id} - {self.bus.bus_number}",
-                    related_ticket=self
-                )
-                
-                # Deduct amount from wallet
-                return wallet.withdraw(self.total_fare)
-            return False
+            # Debit and ledger entry in one step; fails if the balance is too low
+            return wallet.withdraw(self.total_fare, f"Payment for ticket #{self.id} - {self.bus.bus_number}",
+                                   transaction_type='PAYMENT', related_ticket=self)
         except Exception:
             return False
     
@@ -580,29 +745,24 @@ class Ticket(models.Model):
             else:  # 25% refund if < 6 hours before departure
                 refund_percentage = 0.25
             
-            refund_amount = self.total_fare * refund_percentage
-            
-            # Process refund
-            wallet = self.user.wallet
-            wallet.deposit(refund_amount)
-            
-            # Create transaction record for the refund
-            Transaction.objects.create(
-                wallet=wallet,
-                amount=refund_amount,
-                transaction_type='REFUND',
-                description=f"Refund for cancelled ticket #{self.id} - {self.bus.bus_number} ({int(refund_percentage*100)}%)",
-                related_ticket=self
-            )
+            refund_amount = (self.total_fare * Decimal(str(refund_percentage))).quantize(Decimal('0.01'))
             
-            # Update bus available seats
-            seat_count = self.passenger_count
-            self.bus.available_seats += seat_count
-            self.bus.save()
-            
-            # Mark ticket as cancelled
-            self.status = 'CANCELLED'
-            self.save()
+            with transaction.atomic():
+                # Claim the ticket; another cancellation got there first if nothing was updated
+                if not Ticket.objects.filter(pk=self.pk, status='BOOKED').update(status='CANCELLED'):
+                    return False
+                self.status = 'CANCELLED'
+                
+                # Return the seats with an atomic UPDATE and free them in the occupancy bitmap
+                from booking.services import return_seat_count
+                from booking.occupancy import release_ticket_seats
+                return_seat_count(self.bus, self.passenger_count)
+                release_ticket_seats(self)
+                
+                # Process refund (single ledger entry)
+                wallet = self.user.wallet
+                wallet.deposit(refund_amount, f"Refund for cancelled ticket #{self.id} - {self.bus.bus_number} ({int(refund_percentage*100)}%)",
+                               transaction_type='REFUND', related_ticket=self)
             
             return True
         except Exception:
@@ -632,6 +792,8 @@ class MultiStopTicket(models.Model):
     total_fare = models.DecimalField(_('total fare'), max_digits=10, decimal_places=2)
     seat_numbers = models.CharField(_('seat numbers'), max_length=255, help_text="Comma-separated seat numbers")
     seat_class = models.CharField(_('seat class'), max_length=20, choices=MultiStopBus.SEAT_CLASS_CHOICES, default='GENERAL')
+    # Denormalized len(passengers); kept in sync by booking.signals and the booking service
+    passenger_count = models.PositiveIntegerField(_('passenger count'), default=0, editable=False)
     
     class Meta:
         verbose_name = _('multi-stop ticket')
@@ -641,10 +803,6 @@ class MultiStopTicket(models.Model):
     def __str__(self):
         return f"Ticket #{self.id} - {self.user.email} - {self.bus.bus_number} ({self.start_stop.city} to {self.end_stop.city})"
     
-    @property
-    def passenger_count(self):
-        return self.passengers.count()
-    
     @property
     def segment_description(self):
         """Get a description of the booked segment"""
@@ -662,38 +820,25 @@ class MultiStopTicket(models.Model):
     
     def cancel(self):
         """Cancel the ticket and update available seats."""
-        if self.status == 'BOOKED':
+        with transaction.atomic():
+            # Claim the ticket with a conditional UPDATE, so that of two racing cancellations
+            # (or one racing a bus cancellation job) only one returns the seats and refunds
+            if not MultiStopTicket.objects.filter(pk=self.pk, status='BOOKED').update(status='CANCELLED'):
+                return False
             self.status = 'CANCELLED'
-            self.bus.available_seats += self.passenger_count
-            self.bus.save()
-            self.save()
             
-            # Process refund to wallet
-            try:
-                wallet = self.user.wallet
-                wallet.deposit(self.total_fare)
-                
-                # Update transaction description
-                latest_transaction = wallet.transactions.latest('timestamp')
-                latest_transaction.transaction_type = 'REFUND'
-                latest_transaction.description = f"Refund for cancelled ticket #{self.id}"
-                latest_transaction.related_multistop_ticket = self
-                latest_transaction.save()
-                
-            except Wallet.DoesNotExist:
-                # If user doesn't have a wallet, create one and deposit refund
-                wallet = Wallet.objects.create(user=self.user)
-                wallet.deposit(self.total_fare)
-                
-                # Update transaction
-                latest_transaction = wallet.transactions.latest('timestamp')
-                latest_transaction.transaction_type = 'REFUND'
-                latest_transaction.description = f"Refund for cancelled ticket #{self.id}"
-                latest_transaction.related_multistop_ticket = self
-                latest_transaction.save()
+            # Return the seats with an atomic UPDATE and free them in the occupancy bitmap
+            from booking.services import return_seat_count
+            from booking.occupancy import release_ticket_seats
+            return_seat_count(self.bus, self.passenger_count)
+            release_ticket_seats(self)
             
-            return True
-        return False
+            # Process refund to wallet (create one if the user has none)
+            wallet, _created = Wallet.objects.get_or_create(user=self.user)
+            wallet.deposit(self.total_fare, f"Refund for cancelled ticket #{self.id}",
+                           transaction_type='REFUND', related_multistop_ticket=self)
+        
+        return True
     
     def book_with_wallet(self):
         """
@@ -701,19 +846,9 @@ class MultiStopTicket(models.Model):
         """
         try:
             wallet = self.user.wallet
-            if wallet.has_sufficient_balance(self.total_fare):
-                # Create a transaction for the payment
-                transaction = Transaction.objects.create(
-                    wallet=wallet,
-                    amount=self.total_fare,
-                    transaction_type='PAYMENT',
-                    description=f"Payment for ticket #{self.id} - {self.bus.bus_number} ({self.segment_description})",
-                    related_multistop_ticket=self
-                )
-                
-                # Deduct amount from wallet
-                return wallet.withdraw(self.total_fare)
-            return False
+            # Debit and ledger entry in one step; fails if the balance is too low
+            return wallet.withdraw(self.total_fare, f"Payment for ticket #{self.id} - {self.bus.bus_number} ({self.segment_description})",
+                                   transaction_type='PAYMENT', related_multistop_ticket=self)
         except Exception:
             return False
     
@@ -739,30 +874,213 @@ class MultiStopTicket(models.Model):
             else:  # 25% refund if < 6 hours before departure
                 refund_percentage = 0.25
             
-            refund_amount = self.total_fare * refund_percentage
-            
-            # Process refund
-            wallet = self.user.wallet
-            wallet.deposit(refund_amount)
-            
-            # Create transaction record for the refund
-            Transaction.objects.create(
-                wallet=wallet,
-                amount=refund_amount,
-                transaction_type='REFUND',
-                description=f"Refund for cancelled ticket #{self.id} - {self.bus.bus_number} ({int(refund_percentage*100)}%)",
-                related_multistop_ticket=self
-            )
-            
-            # Update bus available seats
-            seat_count = self.passenger_count
-            self.bus.available_seats += seat_count
-            self.bus.save()
+            refund_amount = (self.total_fare * Decimal(str(refund_percentage))).quantize(Decimal('0.01'))
             
-            # Mark ticket as cancelled
-            self.status = 'CANCELLED'
-            self.save()
+            with transaction.atomic():
+                # Claim the ticket; another cancellation got there first if nothing was updated
+                if not MultiStopTicket.objects.filter(pk=self.pk, status='BOOKED').update(status='CANCELLED'):
+                    return False
+                self.status = 'CANCELLED'
+                
+                # Return the seats with an atomic UPDATE and free them in the occupancy bitmap
+                from booking.services import return_seat_count
+                from booking.occupancy import release_ticket_seats
+                return_seat_count(self.bus, self.passenger_count)
+                release_ticket_seats(self)
+                
+                # Process refund (single ledger entry)
+                wallet = self.user.wallet
+                wallet.deposit(refund_amount, f"Refund for cancelled ticket #{self.id} - {self.bus.bus_number} ({int(refund_percentage*100)}%)",
+                               transaction_type='REFUND', related_multistop_ticket=self)
             
             return True
         except Exception:
             return False
+
+
+class SeatOccupancy(models.Model):
+    """
+    Seat x leg occupancy bitmap for a bus, maintained by booking.occupancy.
+    Exactly one of bus / multistop_bus is set.
+    """
+    bus = models.OneToOneField(Bus, on_delete=models.CASCADE, null=True, blank=True,
+                               related_name='occupancy')
+    multistop_bus = models.OneToOneField(MultiStopBus, on_delete=models.CASCADE, null=True, blank=True,
+                                         related_name='occupancy')
+    seats = models.PositiveIntegerField(_('seats'))
+    legs = models.PositiveIntegerField(_('legs'))
+    bitmap = models.BinaryField(_('occupancy bitmap'), default=b'')
+    # Bumped on every bitmap write; the seat map API uses it as its ETag
+    version = models.PositiveIntegerField(_('version'), default=0, editable=False)
+    
+    class Meta:
+        verbose_name = _('seat occupancy')
+        verbose_name_plural = _('seat occupancies')
+    
+    def __str__(self):
+        return f"Occupancy for {self.bus or self.multistop_bus}"
+
+
+class SeatAllocation(models.Model):
+    """
+    A seat held by a ticket on one leg (consecutive stop pair) of a bus journey.
+    Direct buses have a single leg from sequence 0 to 1. The per-bus unique
+    constraint on (seat, leg) makes double-booking impossible at the database level.
+    """
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, null=True, blank=True,
+                            related_name='seat_allocations')
+    multistop_bus = models.ForeignKey(MultiStopBus, on_delete=models.CASCADE, null=True, blank=True,
+                                      related_name='seat_allocations')
+    seat_no = models.PositiveIntegerField(_('seat number'))
+    start_seq = models.PositiveIntegerField(_('leg start sequence'))
+    end_seq = models.PositiveIntegerField(_('leg end sequence'))
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, null=True, blank=True,
+                               related_name='seat_allocations')
+    multistop_ticket = models.ForeignKey(MultiStopTicket, on_delete=models.CASCADE, null=True, blank=True,
+                                         related_name='seat_allocations')
+    
+    class Meta:
+        verbose_name = _('seat allocation')
+        verbose_name_plural = _('seat allocations')
+        constraints = [
+            models.UniqueConstraint(fields=['bus', 'seat_no', 'start_seq'],
+                                    condition=Q(bus__isnull=False),
+                                    name='unique_bus_seat_leg'),
+            models.UniqueConstraint(fields=['multistop_bus', 'seat_no', 'start_seq'],
+                                    condition=Q(multistop_bus__isnull=False),
+                                    name='unique_multistop_bus_seat_leg'),
+            models.CheckConstraint(condition=Q(start_seq__lt=models.F('end_seq')),
+                                   name='seat_allocation_leg_order'),
+        ]
+    
+    def __str__(self):
+        return f"Seat {self.seat_no} ({self.start_seq}-{self.end_seq}) on {self.bus or self.multistop_bus}"
+
+
+class SeatHold(models.Model):
+    """
+    A seat kept for one user's checkout on one leg of a bus journey until
+    expires_at. Placed by booking.holds.place_hold when checkout starts and
+    consumed by the booking that follows; expired holds are ignored and
+    removed by the sweep_seat_holds command.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='seat_holds')
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, null=True, blank=True,
+                            related_name='seat_holds')
+    multistop_bus = models.ForeignKey(MultiStopBus, on_delete=models.CASCADE, null=True, blank=True,
+                                      related_name='seat_holds')
+    seat_no = models.PositiveIntegerField(_('seat number'))
+    start_seq = models.PositiveIntegerField(_('leg start sequence'))
+    end_seq = models.PositiveIntegerField(_('leg end sequence'))
+    expires_at = models.DateTimeField(_('expires at'), db_index=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    
+    class Meta:
+        verbose_name = _('seat hold')
+        verbose_name_plural = _('seat holds')
+        constraints = [
+            models.UniqueConstraint(fields=['bus', 'seat_no', 'start_seq'],
+                                    condition=Q(bus__isnull=False),
+                                    name='unique_bus_seat_hold'),
+            models.UniqueConstraint(fields=['multistop_bus', 'seat_no', 'start_seq'],
+                                    condition=Q(multistop_bus__isnull=False),
+                                    name='unique_multistop_bus_seat_hold'),
+        ]
+    
+    def __str__(self):
+        return f"Seat {self.seat_no} ({self.start_seq}-{self.end_seq}) held on {self.bus or self.multistop_bus}"
+    
+    @property
+    def is_expired(self):
+        return self.expires_at <= timezone.now()
+
+
+class CancellationJob(models.Model):
+    """
+    Background cancellation of every booked ticket on a bus, with refunds.
+    Run in batches by booking.cancellations; last_ticket_id is committed with
+    each batch, so an interrupted job resumes where it stopped.
+    Exactly one of bus / multistop_bus is set.
+    """
+    STATUS_CHOICES = (
+        ('PENDING', _('Pending')),
+        ('RUNNING', _('Running')),
+        ('COMPLETED', _('Completed')),
+        ('FAILED', _('Failed')),
+    )
+    
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, null=True, blank=True,
+                            related_name='cancellation_jobs')
+    multistop_bus = models.ForeignKey(MultiStopBus, on_delete=models.CASCADE, null=True, blank=True,
+                                      related_name='cancellation_jobs')
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='+')
+    status = models.CharField(_('status'), max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    refund_percent = models.DecimalField(_('refund percent'), max_digits=5, decimal_places=2, default=Decimal('100.00'))
+    total_tickets = models.PositiveIntegerField(_('total tickets'), default=0)
+    processed_tickets = models.PositiveIntegerField(_('processed tickets'), default=0)
+    refunded_amount = models.DecimalField(_('refunded amount'), max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    # Resume point: tickets are processed in id order
+    last_ticket_id = models.PositiveIntegerField(_('last ticket id'), default=0)
+    error = models.TextField(_('error'), blank=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    started_at = models.DateTimeField(_('started at'), null=True, blank=True)
+    finished_at = models.DateTimeField(_('finished at'), null=True, blank=True)
+    
+    class Meta:
+        verbose_name = _('cancellation job')
+        verbose_name_plural = _('cancellation jobs')
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Cancellation of {self.bus or self.multistop_bus} ({self.get_status_display()})"
+    
+    @property
+    def target_bus(self):
+        return self.bus or self.multistop_bus
+    
+    @property
+    def progress(self):
+        """Percentage of the job's tickets processed so far."""
+        if not self.total_tickets:
+            return 100 if self.status == 'COMPLETED' else 0
+        return min(100, round(self.processed_tickets * 100 / self.total_tickets))
+
+
+class BookingExport(models.Model):
+    """
+    A booking export too large to build during the admin request. Written to
+    settings.BOOKING_EXPORT_DIR by booking.exports on a background thread and
+    downloaded from the admin once completed.
+    """
+    FORMAT_CHOICES = (
+        ('XLSX', _('Excel')),
+        ('CSV', _('CSV')),
+    )
+    STATUS_CHOICES = CancellationJob.STATUS_CHOICES
+    
+    format = models.CharField(_('format'), max_length=4, choices=FORMAT_CHOICES, default='XLSX')
+    is_multi_stop = models.BooleanField(_('multi-stop buses'), default=False)
+    bus_ids = models.JSONField(_('bus ids'), default=list)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='+')
+    status = models.CharField(_('status'), max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    rows = models.PositiveIntegerField(_('rows'), default=0)
+    file_name = models.CharField(_('file name'), max_length=255, blank=True)
+    error = models.TextField(_('error'), blank=True)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    finished_at = models.DateTimeField(_('finished at'), null=True, blank=True)
+    
+    class Meta:
+        verbose_name = _('booking export')
+        verbose_name_plural = _('booking exports')
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        kind = _('multi-stop') if self.is_multi_stop else _('direct')
+        return f"{self.get_format_display()} export of {len(self.bus_ids)} {kind} buses ({self.get_status_display()})"
+    
+    @property
+    def buses(self):
+        model = MultiStopBus if self.is_multi_stop else Bus
+        return model.objects.filter(pk__in=self.bus_ids).order_by('departure_time', 'pk')
@@ -0,0 +1,440 @@
+"""
+Per-seat, per-leg occupancy bitmaps for buses.
+
+Every bus has one SeatOccupancy row holding a seat x leg bitmap. A leg is the
+stretch between two consecutive stops of a multi-stop route; direct buses
+have a single leg. Row L of the bitmap has bit (seat - 1) set when that seat
+is taken on leg L, so checking a segment is an OR over its legs.
+
+The authoritative record is the SeatAllocation table (one row per seat per
+leg, unique per bus); the bitmap is derived from it and kept in step inside
+the same transaction. Every bitmap write bumps the row's version, which the
+seat map API serves as its ETag; bookings and cancellations also publish the
+changed seats to live seat map streams (booking.events) when they commit.
+
+Seats held for another customer's checkout (SeatHold, see booking.holds)
+count as taken for everyone but the holder until the hold expires.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .events import publish_seat_changes
+from .models import MultiStopBus, MultiStopTicket, SeatAllocation, SeatHold, SeatOccupancy
+
+
+# Stop sequences of the single leg used for direct buses
+DIRECT_LEG = (0, 1)
+
+
+class SeatUnavailable(Exception):
+    """Raised when a requested seat is invalid or already taken on the segment."""
+
+
+def parse_seat_numbers(seat_numbers):
+    """
+    Parse a comma-separated seat string (or an iterable of seats) into a list of ints.
+    """
+    if isinstance(seat_numbers, str):
+        seat_numbers = seat_numbers.split(',')
+    seats = []
+    for seat in seat_numbers:
+        seat = str(seat).strip()
+        if seat:
+            seats.append(int(seat))
+    return seats
+
+
+class SeatBitmap:
+    """
+    In-memory seat x leg bitmap. Each leg row is a Python int used as a bitset.
+    """
+
+    def __init__(self, seats, legs, data=b''):
+        self.seats = seats
+        self.legs = legs
+        self.row_bytes = (seats + 7) // 8
+        self.rows = [
+            int.from_bytes(data[leg * self.row_bytes:(leg + 1) * self.row_bytes], 'little')
+            for leg in range(legs)
+        ]
+
+    def to_bytes(self):
+        return b''.join(row.to_bytes(self.row_bytes, 'little') for row in self.rows)
+
+    def occupied_mask(self, first_leg, last_leg):
+        """Bitmask of seats taken on any leg in [first_leg, last_leg)."""
+        mask = 0
+        for row in self.rows[first_leg:last_leg]:
+            mask |= row
+        return mask
+
+    def seat_mask(self, seats):
+        mask = 0
+        for seat in seats:
+            if seat < 1 or seat > self.seats:
+                raise SeatUnavailable(f"Seat {seat} does not exist on this bus.")
+            mask |= 1 << (seat - 1)
+        return mask
+
+    def available_count(self, first_leg, last_leg):
+        return self.seats - self.occupied_mask(first_leg, last_leg).bit_count()
+
+    def seat_states(self, first_leg, last_leg, held=0):
+        """List of booleans, index seat - 1, True when the seat is taken (or in `held`) on the span."""
+        mask = self.occupied_mask(first_leg, last_leg) | held
+        return [bool(mask >> index & 1) for index in range(self.seats)]
+
+    def taken_seats(self, seats, first_leg, last_leg, held=0):
+        """The subset of `seats` already taken (or in `held`) on the span."""
+        mask = self.occupied_mask(first_leg, last_leg) | held
+        return [seat for seat in seats if mask >> (seat - 1) & 1]
+
+    def book(self, seats, first_leg, last_leg):
+        mask = self.seat_mask(seats)
+        for leg in range(first_leg, last_leg):
+            self.rows[leg] |= mask
+
+    def seat_legs(self, seat):
+        """Bitmask of the legs (bit L for leg L) on which `seat` is taken."""
+        mask = 0
+        for leg, row in enumerate(self.rows):
+            if row >> (seat - 1) & 1:
+                mask |= 1 << leg
+        return mask
+
+    def mark(self, seat, leg):
+        self.rows[leg] |= 1 << (seat - 1)
+
+    def unmark(self, seat, leg):
+        self.rows[leg] &= ~(1 << (seat - 1))
+
+
+def is_multi_stop_bus(bus):
+    return isinstance(bus, MultiStopBus)
+
+
+def get_stop_sequences(bus):
+    """
+    Get the ordered stop sequences of a multi-stop bus route (empty for direct buses).
+    """
+    if not is_multi_stop_bus(bus):
+        return []
+    return list(bus.route.stops.order_by('sequence').values_list('sequence', flat=True))
+
+
+def leg_count(sequences):
+    return max(1, len(sequences) - 1)
+
+
+def leg_span(sequences, start_stop=None, end_stop=None):
+    """
+    Get the [first_leg, last_leg) span covered by travelling start_stop -> end_stop.
+    Without stops (or for direct buses) the whole journey is covered. Raises
+    ValueError unless end_stop comes after start_stop on the route.
+    """
+    if not sequences or start_stop is None or end_stop is None:
+        return 0, leg_count(sequences)
+    first_leg, last_leg = sequences.index(start_stop.sequence), sequences.index(end_stop.sequence)
+    if first_leg >= last_leg:
+        raise ValueError(f"Stop {end_stop.sequence} does not come after stop {start_stop.sequence}.")
+    return first_leg, last_leg
+
+
+def leg_pairs(sequences, first_leg=0, last_leg=None):
+    """
+    Get the (start_seq, end_seq) stop sequences of each leg in [first_leg, last_leg).
+    Direct buses have the single leg (0, 1).
+    """
+    if len(sequences) < 2:
+        return [DIRECT_LEG]
+    if last_leg is None:
+        last_leg = leg_count(sequences)
+    return [(sequences[leg], sequences[leg + 1]) for leg in range(first_leg, last_leg)]
+
+
+def leg_mask(first_leg, last_leg):
+    """Bitmask of the legs in [first_leg, last_leg), comparable with SeatBitmap.seat_legs()."""
+    return (1 << last_leg) - (1 << first_leg)
+
+
+def bus_lookup(bus):
+    if is_multi_stop_bus(bus):
+        return {'multistop_bus': bus}
+    return {'bus': bus}
+
+
+def _ticket_lookup(ticket):
+    if isinstance(ticket, MultiStopTicket):
+        return {'multistop_ticket': ticket}
+    return {'ticket': ticket}
+
+
+def build_bitmap(bus, sequences):
+    """
+    Rebuild the bitmap for a bus from its seat allocations (one indexed query).
+    """
+    bitmap = SeatBitmap(bus.total_seats, leg_count(sequences))
+    positions = {start_seq: leg for leg, (start_seq, _end_seq) in enumerate(leg_pairs(sequences))}
+    allocations = SeatAllocation.objects.filter(**bus_lookup(bus)).values_list('seat_no', 'start_seq')
+    for seat_no, start_seq in allocations:
+        leg = positions.get(start_seq)
+        if leg is not None and 1 <= seat_no <= bitmap.seats:
+            bitmap.mark(seat_no, leg)
+    return bitmap
+
+
+def store_bitmap(occupancy, bitmap):
+    """
+    Write a bitmap to its occupancy row and bump the row's version (one UPDATE).
+    """
+    occupancy.seats, occupancy.legs, occupancy.bitmap = bitmap.seats, bitmap.legs, bitmap.to_bytes()
+    SeatOccupancy.objects.filter(pk=occupancy.pk).update(
+        seats=occupancy.seats, legs=occupancy.legs, bitmap=occupancy.bitmap, version=F('version') + 1,
+    )
+    # Exact for writers holding the row lock, which all booking paths do
+    occupancy.version += 1
+
+
+def bump_version(occupancy):
+    """
+    Bump the seat map version after a change outside the bitmap, such as a seat hold.
+    """
+    SeatOccupancy.objects.filter(pk=occupancy.pk).update(version=F('version') + 1)
+    occupancy.version += 1
+
+
+def active_holds(bus):
+    """Unexpired seat holds on a bus."""
+    return SeatHold.objects.filter(**bus_lookup(bus), expires_at__gt=timezone.now())
+
+
+def held_mask(bus, sequences, first_leg, last_leg, exclude_user=None):
+    """
+    Bitmask of the seats held on any leg of the span, except by `exclude_user` (one query).
+    """
+    starts = [start_seq for start_seq, _end_seq in leg_pairs(sequences, first_leg, last_leg)]
+    holds = active_holds(bus).filter(start_seq__in=starts)
+    if exclude_user is not None:
+        holds = holds.exclude(user=exclude_user)
+    mask = 0
+    for seat_no in holds.values_list('seat_no', flat=True):
+        mask |= 1 << (seat_no - 1)
+    return mask
+
+
+def hold_legs(sequences, holds):
+    """
+    Get {seat: {user id: leg bitmask}} for a queryset of seat holds (one query).
+    """
+    positions = {start_seq: leg for leg, (start_seq, _end_seq) in enumerate(leg_pairs(sequences))}
+    legs = {}
+    for seat_no, start_seq, user_id in holds.values_list('seat_no', 'start_seq', 'user_id'):
+        leg = positions.get(start_seq)
+        if leg is not None:
+            holders = legs.setdefault(seat_no, {})
+            holders[user_id] = holders.get(user_id, 0) | 1 << leg
+    return legs
+
+
+def publish_on_commit(bus, occupancy, bitmap, sequences, seats, holds=None):
+    """
+    Publish the new state of `seats` (booked legs and holds) to live seat maps
+    once the transaction commits. `holds` is the hold_legs() of those seats,
+    read here when not given.
+    """
+    if holds is None:
+        holds = hold_legs(sequences, active_holds(bus).filter(seat_no__in=seats))
+    states = {seat: (bitmap.seat_legs(seat), holds.get(seat, {})) for seat in seats}
+    version = occupancy.version
+    transaction.on_commit(lambda: publish_seat_changes(is_multi_stop_bus(bus), bus.pk, version, states))
+
+
+def touch_seat_map(bus=None, route=None):
+    """
+    Bump the seat map version of a bus (or of every multi-stop bus on a route)
+    whose layout may have changed without a bitmap write, so cached seat maps
+    are fetched again.
+    """
+    occupancies = SeatOccupancy.objects.all()
+    if bus is not None:
+        occupancies = occupancies.filter(**bus_lookup(bus))
+    else:
+        occupancies = occupancies.filter(multistop_bus__route=route)
+    occupancies.update(version=F('version') + 1)
+
+
+def seat_map_version(bus_id):
+    """
+    Get (is_multi_stop, occupancy id, version) for the active bus with this id
+    in a single query, or None when it has no occupancy row yet. As in the
+    views, a multi-stop bus wins when both tables use the id.
+    """
+    rows = SeatOccupancy.objects.filter(
+        Q(multistop_bus_id=bus_id, multistop_bus__is_active=True) | Q(bus_id=bus_id, bus__is_active=True)
+    ).values_list('multistop_bus_id', 'pk', 'version')
+    versions = sorted((multistop_bus_id is None, pk, version) for multistop_bus_id, pk, version in rows)
+    if not versions:
+        return None
+    is_direct, pk, version = versions[0]
+    return not is_direct, pk, version
+
+
+def load_occupancy(bus, sequences=None, for_update=False):
+    """
+    Get the (SeatOccupancy, SeatBitmap) pair for a bus.
+
+    The row is created from the bus's tickets on first use, and rebuilt if the
+    bus's seat count or route stops changed since it was written. With
+    for_update the row is locked for the rest of the current transaction.
+    """
+    if sequences is None:
+        sequences = get_stop_sequences(bus)
+    legs = leg_count(sequences)
+
+    queryset = SeatOccupancy.objects.all()
+    if for_update:
+        queryset = queryset.select_for_update()
+    occupancy = queryset.filter(**bus_lookup(bus)).first()
+
+    if occupancy is None:
+        bitmap = build_bitmap(bus, sequences)
+        occupancy, created = SeatOccupancy.objects.get_or_create(
+            **bus_lookup(bus),
+            defaults={'seats': bitmap.seats, 'legs': bitmap.legs, 'bitmap': bitmap.to_bytes()},
+        )
+        if created:
+            return occupancy, bitmap
+        if for_update:
+            occupancy = SeatOccupancy.objects.select_for_update().get(pk=occupancy.pk)
+
+    if occupancy.seats != bus.total_seats or occupancy.legs != legs:
+        bitmap = build_bitmap(bus, sequences)
+        store_bitmap(occupancy, bitmap)
+        return occupancy, bitmap
+
+    return occupancy, SeatBitmap(occupancy.seats, occupancy.legs, bytes(occupancy.bitmap))
+
+
+def seat_map(bus, start_stop=None, end_stop=None, user=None):
+    """
+    Get the (SeatOccupancy, seat states) pair for the segment from one occupancy
+    read, counting seats held by anyone but `user` as taken.
+    """
+    sequences = get_stop_sequences(bus)
+    occupancy, bitmap = load_occupancy(bus, sequences)
+    first_leg, last_leg = leg_span(sequences, start_stop, end_stop)
+    held = held_mask(bus, sequences, first_leg, last_leg, exclude_user=user)
+    return occupancy, bitmap.seat_states(first_leg, last_leg, held)
+
+
+def segment_availability(bus, start_stop=None, end_stop=None):
+    """
+    Number of seats free on every leg of the segment.
+    """
+    sequences = get_stop_sequences(bus)
+    _occupancy, bitmap = load_occupancy(bus, sequences)
+    return bitmap.available_count(*leg_span(sequences, start_stop, end_stop))
+
+
+def check_seats(bus, seats, start_stop=None, end_stop=None, user=None):
+    """
+    Raise SeatUnavailable unless all seats exist and are free on the segment
+    (not booked, and not held by anyone but `user`).
+    """
+    sequences = get_stop_sequences(bus)
+    _occupancy, bitmap = load_occupancy(bus, sequences)
+    first_leg, last_leg = leg_span(sequences, start_stop, end_stop)
+    ensure_free(bitmap, seats, first_leg, last_leg)
+    ensure_not_held(seats, held_mask(bus, sequences, first_leg, last_leg, exclude_user=user))
+
+
+def ensure_free(bitmap, seats, first_leg, last_leg):
+    bitmap.seat_mask(seats)
+    taken = bitmap.taken_seats(seats, first_leg, last_leg)
+    if taken:
+        raise SeatUnavailable(
+            f"Seat(s) {', '.join(str(seat) for seat in taken)} already booked for this journey."
+        )
+
+
+def ensure_not_held(seats, held):
+    """Raise SeatUnavailable if any seat is in the `held` seat bitmask."""
+    taken = [seat for seat in seats if held >> (seat - 1) & 1]
+    if taken:
+        raise SeatUnavailable(
+            f"Seat(s) {', '.join(str(seat) for seat in taken)} are being booked by another customer. "
+            f"Please choose other seats or try again in a few minutes."
+        )
+
+
+def reserve_seats(bus, seats, start_stop=None, end_stop=None, ticket=None):
+    """
+    Atomically allocate seats on the segment to a ticket, raising SeatUnavailable
+    if any is not free or is held by someone else. The ticket owner's seat holds
+    on the bus are consumed. Must run in the same transaction that creates the ticket.
+    """
+    seats = parse_seat_numbers(seats)
+    user_id = ticket.user_id if ticket else None
+    with transaction.atomic():
+        sequences = get_stop_sequences(bus)
+        occupancy, bitmap = load_occupancy(bus, sequences, for_update=True)
+        first_leg, last_leg = leg_span(sequences, start_stop, end_stop)
+        ensure_free(bitmap, seats, first_leg, last_leg)
+
+        # Holds on these seats, and on any seat the ticket owner held, in one query
+        own_holds = SeatHold.objects.filter(**bus_lookup(bus), user_id=user_id)
+        holds = hold_legs(sequences, active_holds(bus).filter(
+            Q(seat_no__in=seats) | Q(seat_no__in=own_holds.values('seat_no'))))
+        span = leg_mask(first_leg, last_leg)
+        held = 0
+        for seat in seats:
+            if any(legs & span for holder, legs in holds.get(seat, {}).items() if holder != user_id):
+                held |= 1 << (seat - 1)
+        ensure_not_held(seats, held)
+
+        allocations = [
+            SeatAllocation(seat_no=seat, start_seq=start_seq, end_seq=end_seq,
+                           **bus_lookup(bus), **_ticket_lookup(ticket))
+            for seat in seats
+            for start_seq, end_seq in leg_pairs(sequences, first_leg, last_leg)
+        ]
+        try:
+            with transaction.atomic():
+                SeatAllocation.objects.bulk_create(allocations)
+        except IntegrityError:
+            # The unique (bus, seat, leg) constraint caught a concurrent booking
+            raise SeatUnavailable("One or more selected seats were just booked by someone else.")
+
+        bitmap.book(seats, first_leg, last_leg)
+        store_bitmap(occupancy, bitmap)
+
+        # The booking consumes the owner's holds on this bus
+        if user_id is not None:
+            own_holds.delete()
+            for holders in holds.values():
+                holders.pop(user_id, None)
+        publish_on_commit(bus, occupancy, bitmap, sequences, set(seats) | set(holds), holds)
+
+
+def release_ticket_seats(ticket):
+    """
+    Free the seats held by a Ticket or MultiStopTicket (on cancellation or delete).
+    """
+    bus = ticket.bus
+    with transaction.atomic():
+        sequences = get_stop_sequences(bus)
+        occupancy, bitmap = load_occupancy(bus, sequences, for_update=True)
+        positions = {start_seq: leg for leg, (start_seq, _end_seq) in enumerate(leg_pairs(sequences))}
+
+        allocations = SeatAllocation.objects.filter(**_ticket_lookup(ticket))
+        released = set()
+        for seat_no, start_seq in allocations.values_list('seat_no', 'start_seq'):
+            leg = positions.get(start_seq)
+            if leg is not None and 1 <= seat_no <= bitmap.seats:
+                bitmap.unmark(seat_no, leg)
+                released.add(seat_no)
+        allocations.delete()
+
+        store_bitmap(occupancy, bitmap)
+        publish_on_commit(bus, occupancy, bitmap, sequences, released)
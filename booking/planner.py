@@ -0,0 +1,397 @@
+"""
+Connecting-journey planner.
+
+Direct buses and the stop-to-stop legs of multi-stop buses make up a
+timetable of elementary connections (city -> city, departure, arrival, bus),
+kept in memory in departure order. Queries run the Connection Scan Algorithm
+for the earliest arrival: one pass over the connections departing after the
+requested time, changing buses at any city where at least
+settings.BOOKING_MIN_TRANSFER_MINUTES separate arrival and departure.
+
+Schedule changes (bus, route and stop edits) are recorded in a cache-backed
+changelog of changed buses. Each process applies the changelog to its
+timetable before its next query, reloading only those buses and merging
+their connections in, and rebuilds from scratch only when the changelog has
+been evicted or the timetable is a day old (to drop past departures).
+"""
+import threading
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .cities import matching_city_ids
+from .fares import attach_segment_fares
+from .models import Bus, MultiStopBus, RouteStop
+from .pricing import attach_live_fares
+
+DIRECT = 'd'
+MULTI_STOP = 'm'
+
+# Connections departing this long before the build time are left out
+PAST_DEPARTURES = timedelta(days=1)
+
+# Full rebuild interval, which also drops departures that have passed
+REBUILD_INTERVAL = timedelta(days=1)
+
+# Longest journey a query looks for
+MAX_JOURNEY_TIME = timedelta(days=2)
+
+VERSION_KEY = 'booking:planner:version'
+CHANGES_KEY = 'booking:planner:changes:{}'
+CHANGES_TIMEOUT = 7 * 24 * 3600
+
+# Connection tuple fields
+DEPARTURE, ARRIVAL, FROM_CITY, TO_CITY, TRIP, FROM_STOP, TO_STOP = range(7)
+
+
+def _timestamp(value):
+    return value.timestamp()
+
+
+def _datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+def load_trips(direct_ids=None, multi_stop_ids=None, since=None):
+    """
+    Connections of active buses departing after `since`, as {trip: [connection, ...]}.
+    A trip is (DIRECT or MULTI_STOP, bus id); a connection is a (departure,
+    arrival, from city, to city, trip, from stop, to stop) tuple with epoch
+    timestamps (stops are None for direct buses). Pass id lists to load only
+    those buses. Three queries.
+    """
+    trips = {}
+
+    buses = Bus.objects.filter(is_active=True)
+    if since:
+        buses = buses.filter(departure_time__gte=since)
+    if direct_ids is not None:
+        buses = buses.filter(pk__in=direct_ids)
+    for pk, departure, arrival, origin, destination in buses.values_list(
+            'id', 'departure_time', 'arrival_time', 'route__origin_city_id', 'route__destination_city_id'):
+        if origin is None or destination is None or origin == destination:
+            continue
+        trip = (DIRECT, pk)
+        trips[trip] = [(_timestamp(departure), _timestamp(arrival), origin, destination, trip, None, None)]
+
+    multi_stop = MultiStopBus.objects.filter(is_active=True)
+    if since:
+        multi_stop = multi_stop.filter(departure_time__gte=since)
+    if multi_stop_ids is not None:
+        multi_stop = multi_stop.filter(pk__in=multi_stop_ids)
+    multi_stop = list(multi_stop.values_list('id', 'route_id', 'departure_time'))
+
+    stops = {}
+    for route_id, stop_id, city_id, arrival_offset, departure_offset in RouteStop.objects.filter(
+            route_id__in={route_id for _pk, route_id, _departure in multi_stop}).order_by(
+            'route_id', 'sequence').values_list('route_id', 'id', 'canonical_city_id', 'arrival_offset',
+                                                'departure_offset'):
+        stops.setdefault(route_id, []).append((stop_id, city_id, arrival_offset, departure_offset))
+
+    for pk, route_id, departure in multi_stop:
+        trip = (MULTI_STOP, pk)
+        legs = []
+        route_stops = stops.get(route_id, ())
+        for i, ((from_stop, from_city, waits, leaves), (to_stop, to_city, arrives, stays)) in enumerate(
+                zip(route_stops, route_stops[1:])):
+            if from_city is None or to_city is None or from_city == to_city:
+                continue
+            # A stop missing one offset uses its other one; the first stop leaves at the
+            # bus's departure, as in search. Legs still without times are left out.
+            if leaves is None:
+                leaves = waits
+            if leaves is None and i == 0:
+                leaves = timedelta()
+            if arrives is None:
+                arrives = stays
+            if leaves is None or arrives is None or arrives < leaves:
+                continue
+            legs.append((_timestamp(departure + leaves), _timestamp(departure + arrives),
+                         from_city, to_city, trip, from_stop, to_stop))
+        if legs:
+            trips[trip] = legs
+    return trips
+
+
+class Timetable:
+    """
+    Every connection in departure order, plus each trip's connections so
+    changed trips can be swapped out. Queries read `connections` and
+    `departures` without locking: updates replace them, never mutate them.
+    """
+
+    def __init__(self, trips=None):
+        self.trips = {}
+        self.connections = []
+        self.departures = []
+        self.built_at = None
+        self.version = None
+        if trips is not None:
+            self.replace_all(trips)
+
+    def replace_all(self, trips):
+        self.trips = dict(trips)
+        connections = sorted(connection for legs in self.trips.values() for connection in legs)
+        self.connections, self.departures = connections, [c[DEPARTURE] for c in connections]
+
+    def replace_trips(self, changed, trips):
+        """
+        Swap the connections of the `changed` trips for `trips` (changed trips
+        missing from it are dropped). A few changes are bisected into copies
+        of the sorted lists; many trigger a full re-sort.
+        """
+        removed = [connection for trip in set(changed) for connection in self.trips.pop(trip, ())]
+        self.trips.update(trips)
+        added = [connection for legs in trips.values() for connection in legs]
+        if len(removed) + len(added) > len(self.connections) // 100:
+            self.replace_all(self.trips)
+            return
+
+        connections, departures = list(self.connections), list(self.departures)
+        for connection in removed:
+            i = bisect_left(connections, connection)
+            del connections[i]
+            del departures[i]
+        for connection in added:
+            i = bisect_left(connections, connection)
+            connections.insert(i, connection)
+            departures.insert(i, connection[DEPARTURE])
+        self.connections, self.departures = connections, departures
+
+    def earliest_arrival(self, sources, targets, depart_after, transfer_seconds, depart_before=None):
+        """
+        Connection scan for the earliest arrival at any of the `targets` cities
+        from any of the `sources` cities, leaving at or after `depart_after`
+        and before `depart_before` (epoch seconds). Returns the journey as a
+        list of legs, each a (boarding connection, alighting connection) pair,
+        or None.
+        """
+        connections, departures = self.connections, self.departures
+        sources = set(sources)
+        targets = set(targets) - sources
+        if not sources or not targets:
+            return None
+
+        never = float('inf')
+        # Earliest time a new bus can be boarded at each city
+        ready = dict.fromkeys(sources, depart_after)
+        arrival = dict.fromkeys(sources, depart_after)
+        boarded = {}
+        via = {}
+        best, best_city = never, None
+        # Set once the first bus is boarded; journeys longer than MAX_JOURNEY_TIME are not looked for
+        give_up = never
+        if depart_before is None:
+            depart_before = never
+
+        for i in range(bisect_left(departures, depart_after), len(connections)):
+            connection = connections[i]
+            departure = connection[DEPARTURE]
+            if departure > best or departure > give_up:
+                break
+            if give_up == never and departure >= depart_before:
+                break
+            trip = connection[TRIP]
+            if trip not in boarded:
+                if ready.get(connection[FROM_CITY], never) > departure:
+                    continue
+                boarded[trip] = i
+                if give_up == never:
+                    give_up = departure + MAX_JOURNEY_TIME.total_seconds()
+            to_city = connection[TO_CITY]
+            if connection[ARRIVAL] < arrival.get(to_city, never):
+                arrival[to_city] = connection[ARRIVAL]
+                ready[to_city] = connection[ARRIVAL] + transfer_seconds
+                via[to_city] = (boarded[trip], i)
+                if to_city in targets and connection[ARRIVAL] < best:
+                    best, best_city = connection[ARRIVAL], to_city
+
+        if best_city is None:
+            return None
+        legs = []
+        city = best_city
+        while city in via:
+            board, alight = via[city]
+            legs.append((connections[board], connections[alight]))
+            city = connections[board][FROM_CITY]
+        legs.reverse()
+        return legs
+
+
+_timetable = None
+_timetable_lock = threading.Lock()
+
+
+def mark_trips_changed(direct_ids=(), multi_stop_ids=()):
+    """
+    Record that these buses' schedules changed, once the current transaction
+    commits; every process reloads them before its next query.
+    """
+    trips = [(DIRECT, pk) for pk in direct_ids] + [(MULTI_STOP, pk) for pk in multi_stop_ids]
+    if not trips:
+        return
+
+    def record():
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            return
+        cache.set(CHANGES_KEY.format(version), trips, CHANGES_TIMEOUT)
+
+    transaction.on_commit(record)
+
+
+def _build(version):
+    timetable = Timetable(load_trips(since=timezone.now() - PAST_DEPARTURES))
+    timetable.built_at = timezone.now()
+    timetable.version = version
+    return timetable
+
+
+def get_timetable():
+    """The process's timetable, brought up to date with the changelog."""
+    global _timetable
+    version = cache.get(VERSION_KEY, 0)
+    timetable = _timetable
+    if (timetable is not None and timetable.version == version
+            and timezone.now() - timetable.built_at < REBUILD_INTERVAL):
+        return timetable
+
+    with _timetable_lock:
+        timetable = _timetable
+        if timetable is None or version < timetable.version \
+                or timezone.now() - timetable.built_at >= REBUILD_INTERVAL:
+            _timetable = _build(version)
+            return _timetable
+        if version == timetable.version:
+            return timetable
+
+        changes = cache.get_many([CHANGES_KEY.format(v) for v in range(timetable.version + 1, version + 1)])
+        if len(changes) < version - timetable.version:
+            # Part of the changelog was evicted
+            _timetable = _build(version)
+            return _timetable
+
+        changed = {trip for trips in changes.values() for trip in trips}
+        trips = load_trips(
+            [pk for kind, pk in changed if kind == DIRECT],
+            [pk for kind, pk in changed if kind == MULTI_STOP],
+            since=timetable.built_at - PAST_DEPARTURES,
+        )
+        timetable.replace_trips(changed, trips)
+        timetable.version = version
+        return timetable
+
+
+def reset_timetable():
+    """Drop this process's timetable; the next query rebuilds it."""
+    global _timetable
+    _timetable = None
+
+
+def _journey_option(legs):
+    return {
+        'legs': [{
+            'kind': board[TRIP][0],
+            'bus_id': board[TRIP][1],
+            'start_stop_id': board[FROM_STOP],
+            'end_stop_id': alight[TO_STOP],
+            'departure': _datetime(board[DEPARTURE]),
+            'arrival': _datetime(alight[ARRIVAL]),
+        } for board, alight in legs],
+        'departure': _datetime(legs[0][0][DEPARTURE]),
+        'arrival': _datetime(legs[-1][1][ARRIVAL]),
+    }
+
+
+def plan_journeys(source_ids, destination_ids, depart_after, depart_before=None, limit=5,
+                  min_legs=1, timetable=None):
+    """
+    Earliest-arrival journeys between two sets of city ids, in departure
+    order: the best journey leaving after `depart_after`, then the best
+    leaving after that one, and so on, up to `limit` journeys leaving before
+    `depart_before`. Journeys with fewer than `min_legs` buses are skipped
+    (min_legs=2 finds only connecting journeys).
+
+    Each journey is a dict with 'departure', 'arrival' and 'legs'; a leg has
+    'kind' (DIRECT or MULTI_STOP), 'bus_id', the multi-stop 'start_stop_id'
+    and 'end_stop_id', 'departure' and 'arrival'.
+    """
+    timetable = timetable or get_timetable()
+    transfer = settings.BOOKING_MIN_TRANSFER_MINUTES * 60
+    after = _timestamp(depart_after)
+    before = _timestamp(depart_before) if depart_before else None
+
+    journeys = []
+    # Later departures can only repeat or worsen: stop after a bounded number of scans
+    for _attempt in range(limit * 4):
+        legs = timetable.earliest_arrival(source_ids, destination_ids, after, transfer, before)
+        if legs is None:
+            break
+        if len(legs) >= min_legs:
+            journeys.append(_journey_option(legs))
+            if len(journeys) == limit:
+                break
+        after = legs[0][0][DEPARTURE] + 1
+    return journeys
+
+
+def hydrate_journeys(journeys):
+    """
+    Attach 'bus', 'start_stop' and 'end_stop' objects to each leg, with one
+    query per model. Legs whose bus has gone drop their journey.
+    """
+    direct = Bus.objects.select_related('route').in_bulk(
+        {leg['bus_id'] for journey in journeys for leg in journey['legs'] if leg['kind'] == DIRECT})
+    multi_stop = MultiStopBus.objects.select_related('route').in_bulk(
+        {leg['bus_id'] for journey in journeys for leg in journey['legs'] if leg['kind'] == MULTI_STOP})
+    stops = RouteStop.objects.in_bulk(
+        {stop_id for journey in journeys for leg in journey['legs']
+         for stop_id in (leg['start_stop_id'], leg['end_stop_id']) if stop_id})
+
+    hydrated = []
+    for journey in journeys:
+        legs = journey['legs']
+        for leg in legs:
+            leg['bus'] = (direct if leg['kind'] == DIRECT else multi_stop).get(leg['bus_id'])
+            leg['start_stop'] = stops.get(leg['start_stop_id'])
+            leg['end_stop'] = stops.get(leg['end_stop_id'])
+        if all(leg['bus'] is not None for leg in legs):
+            journey['transfers'] = len(legs) - 1
+            journey['duration'] = journey['arrival'] - journey['departure']
+            hydrated.append(journey)
+    return hydrated
+
+
+def find_connecting_journeys(source, destination, date=None, limit=5):
+    """
+    Journeys changing buses at least once between the cities matching the
+    free-text `source` and `destination`, leaving on `date` (or from now on).
+    Each leg has a live 'fare' (None for a multi-stop pair without one).
+    """
+    source_ids = matching_city_ids(source)
+    destination_ids = matching_city_ids(destination)
+    if not source_ids or not destination_ids:
+        return []
+
+    now = timezone.now()
+    depart_after, depart_before = now, None
+    if date:
+        start = timezone.make_aware(datetime.combine(date, datetime.min.time()))
+        depart_after, depart_before = max(start, now), start + timedelta(days=1)
+    journeys = hydrate_journeys(plan_journeys(
+        source_ids, destination_ids, depart_after, depart_before, limit=limit, min_legs=2))
+
+    # Price every leg in one pass, like a page of search results
+    legs = [leg for journey in journeys for leg in journey['legs']]
+    direct = [leg for leg in legs if leg['kind'] == DIRECT]
+    segments = [leg for leg in legs if leg['kind'] == MULTI_STOP and leg['start_stop'] and leg['end_stop']]
+    attach_live_fares([leg['bus'] for leg in direct], attach_segment_fares(segments))
+    for leg in legs:
+        leg['fare'] = leg['bus'].live_fare if leg['kind'] == DIRECT else leg.get('fare')
+    return journeys
@@ -0,0 +1,219 @@
+"""
+Dynamic fares.
+
+A bus's live fare is its static class fare (times the segment multiplier of
+the route fare matrix on multi-stop buses) times a yield multiplier built
+from the rule tables in settings.BOOKING_PRICING_RULES:
+
+- load_factor: share of the bus's seats sold,
+- days_to_departure: days left before the bus leaves,
+- demand: seats sold in the last BOOKING_PRICING_DEMAND_HOURS, as a share
+  of all seats.
+
+Each table maps lower bounds to multipliers. The multipliers of the bands a
+bus falls in are multiplied together, clamped to BOOKING_PRICING_LIMITS and
+rounded to six places.
+
+Each bus keeps its multiplier in its price_multiplier column, the one value
+that search ranks fares by and bookings are charged with. It is recomputed
+and saved for a bus once a booking or cancellation of it, or an edit to the
+bus, commits, and for every upcoming bus by refresh_prices (the
+refresh_prices command, run every 15 minutes) as time-based bands move.
+Pricing a page of buses reads the column of the rows already loaded.
+"""
+from bisect import bisect_right
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Bus, MultiStopBus, MultiStopTicket, Ticket
+from .occupancy import is_multi_stop_bus
+from .search import invalidate_search_dates
+
+PRICE_KEY_PREFIX = 'booking:price'
+
+ONE = Decimal('1')
+CENTS = Decimal('0.01')
+# Places of price_multiplier: exact for products of three two-place rule multipliers
+MULTIPLIER_PLACES = Decimal('0.000001')
+
+REFRESH_BATCH_SIZE = 1000
+
+
+def price_key(bus):
+    return f"{PRICE_KEY_PREFIX}:{'m' if is_multi_stop_bus(bus) else 'd'}{bus.pk}"
+
+
+def _compile(table):
+    """(sorted lower bounds, multipliers) of a rule table of (bound, multiplier) pairs."""
+    table = sorted(table)
+    return [bound for bound, _multiplier in table], [Decimal(str(multiplier)) for _bound, multiplier in table]
+
+
+def _band(rule, value):
+    """Multiplier of the band `value` falls in; 1 below the first bound."""
+    bounds, multipliers = rule
+    i = bisect_right(bounds, value)
+    return multipliers[i - 1] if i else ONE
+
+
+def _recent_sales(buses, since):
+    """Seats sold on each bus since `since`, as {price key: seats}; one query per bus model."""
+    sales = {}
+    for model, ticket_model, kind in ((Bus, Ticket, 'd'), (MultiStopBus, MultiStopTicket, 'm')):
+        ids = [bus.pk for bus in buses if isinstance(bus, model)]
+        if not ids:
+            continue
+        rows = (ticket_model.objects
+                .filter(bus_id__in=ids, status='BOOKED', booking_time__gte=since)
+                .values_list('bus_id')
+                .annotate(seats=Sum('passenger_count')))
+        for bus_id, seats in rows:
+            sales[f"{PRICE_KEY_PREFIX}:{kind}{bus_id}"] = seats or 0
+    return sales
+
+
+def _rules():
+    """The compiled rule tables and the (low, high) multiplier limits."""
+    rules = {name: _compile(table) for name, table in settings.BOOKING_PRICING_RULES.items()}
+    return rules, tuple(Decimal(str(limit)) for limit in settings.BOOKING_PRICING_LIMITS)
+
+
+def yield_multiplier(bus, recent_sales, now, rules=None):
+    """
+    Yield multiplier of one bus (anything with seat counts and a departure
+    time), given the seats sold on it since BOOKING_PRICING_DEMAND_HOURS ago.
+    """
+    rules, (low, high) = rules or _rules()
+    seats = bus.total_seats or 1
+    signals = {
+        'load_factor': (bus.total_seats - bus.available_seats) / seats,
+        'days_to_departure': (bus.departure_time - now).total_seconds() / 86400,
+        'demand': recent_sales / seats,
+    }
+    multiplier = ONE
+    for name, rule in rules.items():
+        multiplier *= _band(rule, signals[name])
+    return min(max(multiplier, low), high).quantize(MULTIPLIER_PLACES, rounding=ROUND_HALF_UP)
+
+
+def compute_multipliers(buses, now=None):
+    """
+    Yield multipliers of `buses` (Bus or MultiStopBus rows with their seat
+    counts and departure time loaded), as {price key: Decimal}.
+    """
+    now = now or timezone.now()
+    rules = _rules()
+    sales = _recent_sales(buses, now - timedelta(hours=settings.BOOKING_PRICING_DEMAND_HOURS)) \
+        if 'demand' in settings.BOOKING_PRICING_RULES else {}
+    return {price_key(bus): yield_multiplier(bus, sales.get(price_key(bus), 0), now, rules) for bus in buses}
+
+
+def get_multipliers(buses):
+    """
+    Yield multipliers of `buses`, as {price key: Decimal}: the persisted
+    price_multiplier that search ranks by. Every multiplier is 1 with
+    dynamic pricing off.
+    """
+    if not settings.BOOKING_DYNAMIC_PRICING:
+        return {price_key(bus): ONE for bus in buses}
+    return {price_key(bus): bus.price_multiplier for bus in buses}
+
+
+def refresh_price(bus):
+    """
+    Recompute and persist one bus's multiplier from its current row, e.g.
+    after a booking or cancellation of it commits.
+    """
+    if not settings.BOOKING_DYNAMIC_PRICING:
+        return
+    current = type(bus).objects.filter(pk=bus.pk).only(
+        'total_seats', 'available_seats', 'departure_time').first()
+    if current is None:
+        return
+    multiplier = compute_multipliers([current])[price_key(current)]
+    type(bus).objects.filter(pk=bus.pk).exclude(price_multiplier=multiplier).update(price_multiplier=multiplier)
+    bus.price_multiplier = multiplier
+
+
+def refresh_prices(now=None, batch_size=REFRESH_BATCH_SIZE):
+    """
+    Recompute and persist the multipliers of every active bus yet to depart, batch by batch. Cached searches of the dates whose prices moved
+    are dropped. Returns the number of buses whose multiplier changed.
+    """
+    if not settings.BOOKING_DYNAMIC_PRICING:
+        return 0
+    now = now or timezone.now()
+    changed = 0
+    dates = set()
+    for model in (Bus, MultiStopBus):
+        buses = (model.objects.filter(is_active=True, departure_time__gt=now)
+                 .only('total_seats', 'available_seats', 'departure_time', 'price_multiplier')
+                 .order_by('pk'))
+        last_pk = 0
+        while True:
+            batch = list(buses.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            multipliers = compute_multipliers(batch, now)
+            moved = []
+            for bus in batch:
+                if bus.price_multiplier != multipliers[price_key(bus)]:
+                    bus.price_multiplier = multipliers[price_key(bus)]
+                    moved.append(bus)
+            model.objects.bulk_update(moved, ['price_multiplier'])
+            changed += len(moved)
+            dates.update(timezone.localtime(bus.departure_time).date() for bus in moved)
+    if dates:
+        invalidate_search_dates(*dates)
+    return changed
+
+
+def live_fare(bus, seat_class='GENERAL', segment=None, multiplier=None):
+    """
+    Fare per seat right now for a seat class (and, on multi-stop buses, a
+    segment: a RouteSegment or fare matrix SegmentFare).
+    """
+    if multiplier is None:
+        multiplier = get_multipliers([bus])[price_key(bus)]
+    if segment is not None:
+        base = bus.calculate_segment_fare(segment, seat_class)
+    else:
+        base = bus.get_fare_for_class(seat_class)
+    return (Decimal(base) * multiplier).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def live_class_fares(bus, segment=None):
+    """Live fare per seat for each seat class the bus offers."""
+    multiplier = get_multipliers([bus])[price_key(bus)]
+    offered = {
+        'GENERAL': bus.has_general_seats,
+        'SLEEPER': bus.has_sleeper_seats,
+        'LUXURY': bus.has_luxury_seats,
+    }
+    return {
+        seat_class: live_fare(bus, seat_class, segment, multiplier)
+        for seat_class, _label in Bus.SEAT_CLASS_CHOICES if offered[seat_class]
+    }
+
+
+def attach_live_fares(buses=(), segments=()):
+    """
+    Price a page of results in one pass: sets `live_fare` (General class) on
+    each bus, and 'fare' on each multi-stop segment dict that has a
+    'segment_fare' from the route fare matrix.
+    """
+    buses = list(buses)
+    all_buses = buses + [item['bus'] for item in segments]
+    multipliers = get_multipliers(all_buses) if all_buses else {}
+    for bus in buses:
+        bus.live_fare = live_fare(bus, multiplier=multipliers[price_key(bus)])
+    for item in segments:
+        if item.get('segment_fare') is not None:
+            item['fare'] = live_fare(item['bus'], segment=item['segment_fare'],
+                                     multiplier=multipliers[price_key(item['bus'])])
+    return buses, segments
@@ -0,0 +1,612 @@
+"""
+Bus search.
+
+Resolves free-text city queries to canonical city ids (booking.cities), maps
+them to stops through a precomputed city -> stops index and picks, from the
+index alone, the (start_stop, end_stop) pair each multi-stop route serves
+the search on. Direct buses are filtered on the routes' city foreign keys.
+
+Results are ranked in SQL: direct buses and multi-stop segments are selected
+as one UNION of identically shaped rows (segment departure, arrival,
+duration, distance and General fare, the latter from the route fare matrix
+and the bus's persisted price multiplier), ordered by the sort key and
+sliced to a page, so only one page of rows is ever loaded.
+
+Pages are keyset paginated: a page's cursor carries the sort key of its last
+row, and the next page is the rows ranked after it, filtered on each side of
+the UNION so no offset is ever scanned. Facet counts (seat classes with free
+seats, departure time bands and price bands) come from one aggregate query
+over the whole search; facet filters narrow both sides' WHERE clauses.
+
+Pages and facet counts are cached per normalized (source, destination, date)
+plus sort, filters and cursor. Each entry key embeds a version for its travel
+date, bumped whenever a bus on that date changes or has seats booked or
+returned, so only the affected dates are invalidated.
+"""
+import hashlib
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache, caches
+from django.db.models import (
+    Case, CharField, Count, DateTimeField, DecimalField, DurationField, ExpressionWrapper, F, IntegerField, OuterRef,
+    Q, Subquery, Value, When,
+)
+from django.db.models.functions import Coalesce, ExtractHour, Round
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+
+from .cities import matching_city_ids
+from .models import Bus, MultiStopBus, RouteStop, RouteStopFare, SeatAllocation, normalize_city_name
+
+CITY_STOP_INDEX_CACHE_KEY = 'booking:city_stop_index'
+CITY_STOP_INDEX_VERSION_KEY = f'{CITY_STOP_INDEX_CACHE_KEY}:version'
+SEARCH_CACHE_PREFIX = 'booking:search'
+SEARCH_STATS_KEYS = {'hits': f'{SEARCH_CACHE_PREFIX}:stats:hits', 'misses': f'{SEARCH_CACHE_PREFIX}:stats:misses'}
+
+# Result ordering for each sort option, over the ranked columns
+SORT_ORDERING = {
+    'fare_low': ('fare', 'departure'),
+    'fare_high': ('-fare', 'departure'),
+    'departure_early': ('departure',),
+    'departure_late': ('-departure',),
+    'duration': ('duration', 'departure'),
+    'departure_time': ('departure',),
+}
+
+# Columns of a ranked search row, in the order both sides of the UNION select them
+RESULT_COLUMNS = ('kind', 'bus', 'start_stop', 'end_stop', 'departure', 'arrival', 'duration', 'distance',
+                  'fare', 'seats', 'bus_seats', 'general', 'sleeper', 'luxury', 'hour')
+
+# Seat class facet: the column telling whether a result's bus offers the class
+SEAT_CLASS_COLUMNS = {'GENERAL': 'general', 'SLEEPER': 'sleeper', 'LUXURY': 'luxury'}
+
+# Departure time facet: key -> (label, first hour, hour after the last), in local time
+DEPARTURE_BANDS = {
+    'night': (_('Before 6 AM'), 0, 6),
+    'morning': (_('6 AM - 12 PM'), 6, 12),
+    'afternoon': (_('12 PM - 6 PM'), 12, 18),
+    'evening': (_('After 6 PM'), 18, 24),
+}
+
+CURSOR_SALT = 'booking.search.cursor'
+
+
+# Search keys and city lookups share one normalization
+normalize_city = normalize_city_name
+
+
+def build_city_stop_index():
+    """
+    Build the city id -> [(route_id, sequence, stop_id), ...] index.
+    """
+    index = {}
+    stops = RouteStop.objects.values_list('canonical_city_id', 'route_id', 'sequence', 'id')
+    for city_id, route_id, sequence, stop_id in stops:
+        index.setdefault(city_id, []).append((route_id, sequence, stop_id))
+    return index
+
+
+def _city_stop_index_key():
+    version = search_cache().get(CITY_STOP_INDEX_VERSION_KEY, 0)
+    return f"{CITY_STOP_INDEX_CACHE_KEY}:v{version}"
+
+
+def get_city_stop_index():
+    """
+    Get the city index from the cache, building it on a miss. The entry key
+    carries a version kept in the search cache, so an invalidation on one
+    worker reaches every worker sharing that cache; entries also expire with
+    cached search results, bounding staleness where the cache is per-process.
+    """
+    key = _city_stop_index_key()
+    index = cache.get(key)
+    if index is None:
+        index = build_city_stop_index()
+        cache.set(key, index, getattr(settings, 'BOOKING_SEARCH_CACHE_TIMEOUT', 300))
+    return index
+
+
+def invalidate_city_stop_index():
+    """
+    Retire the cached city index by bumping its version. Called whenever a
+    RouteStop or City changes.
+    """
+    store = search_cache()
+    try:
+        store.incr(CITY_STOP_INDEX_VERSION_KEY)
+    except ValueError:
+        store.set(CITY_STOP_INDEX_VERSION_KEY, timezone.now().timestamp(), None)
+
+
+def match_city_stops(query, index=None, city_ids=None):
+    """
+    Get the stops whose city matches the query, as (route_id, sequence, stop_id) tuples.
+    Matching is a substring match on the city name or an alias, like the old icontains
+    filter; pass `city_ids` when the query has already been resolved.
+    """
+    if index is None:
+        index = get_city_stop_index()
+    if city_ids is None:
+        city_ids = matching_city_ids(query)
+    matches = []
+    for city_id in city_ids:
+        matches.extend(index.get(city_id, ()))
+    return matches
+
+
+def candidate_stop_pairs(source, destination, source_ids=None, destination_ids=None):
+    """
+    The segment each multi-stop route serves source -> destination on, as
+    {route_id: (start_stop_id, end_stop_id)}: the earliest boarding stop, then
+    the earliest alighting stop after it. Answered from the city index alone.
+    """
+    index = get_city_stop_index()
+    first_start = {}
+    for route_id, sequence, stop_id in match_city_stops(source, index, source_ids):
+        if route_id not in first_start or sequence < first_start[route_id][0]:
+            first_start[route_id] = (sequence, stop_id)
+    first_end = {}
+    for route_id, sequence, stop_id in match_city_stops(destination, index, destination_ids):
+        if route_id in first_start and sequence > first_start[route_id][0] \
+                and (route_id not in first_end or sequence < first_end[route_id][0]):
+            first_end[route_id] = (sequence, stop_id)
+    return {route_id: (first_start[route_id][1], stop_id) for route_id, (_sequence, stop_id) in first_end.items()}
+
+
+def search_cache():
+    """
+    The cache backing search results (settings.BOOKING_SEARCH_CACHE alias).
+    """
+    return caches[getattr(settings, 'BOOKING_SEARCH_CACHE', 'default')]
+
+
+def _version_key(date):
+    return f"{SEARCH_CACHE_PREFIX}:version:{date.isoformat() if date else 'any'}"
+
+
+def _get_version(store, date):
+    version = store.get(_version_key(date))
+    if version is None:
+        version = 1
+        store.add(_version_key(date), version, None)
+    return version
+
+
+def _bump_version(store, date):
+    key = _version_key(date)
+    try:
+        store.incr(key)
+    except ValueError:
+        # Missing (never searched or evicted): any value nobody has cached under works
+        store.set(key, timezone.now().timestamp(), None)
+
+
+def search_cache_key(source, destination, date, sort, *extra):
+    """
+    Cache key for a normalized search, including the current version of its date.
+    `extra` parts (filters, cursor) are appended as given.
+    """
+    store = search_cache()
+    raw = '|'.join([normalize_city(source), normalize_city(destination),
+                    date.isoformat() if date else '', sort, *extra])
+    digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return f"{SEARCH_CACHE_PREFIX}:v{_get_version(store, date)}:{digest}"
+
+
+def invalidate_search_dates(*dates):
+    """
+    Drop cached searches for the given travel dates. Searches without a date
+    span every day, so they are always dropped as well.
+    """
+    store = search_cache()
+    for date in set(dates) | {None}:
+        _bump_version(store, date)
+
+
+def invalidate_bus_searches(bus, *extra_dates):
+    """
+    Drop cached searches that may include `bus` (its departure date, plus any
+    dates it has moved away from).
+    """
+    invalidate_search_dates(timezone.localtime(bus.departure_time).date(), *extra_dates)
+
+
+def invalidate_all_searches():
+    """
+    Drop every cached search, e.g. after a route or stop rename that can
+    change results on any date.
+    """
+    store = search_cache()
+    try:
+        store.incr(f"{SEARCH_CACHE_PREFIX}:generation")
+    except ValueError:
+        store.set(f"{SEARCH_CACHE_PREFIX}:generation", timezone.now().timestamp(), None)
+
+
+def _count(name):
+    store = search_cache()
+    try:
+        store.incr(SEARCH_STATS_KEYS[name])
+    except ValueError:
+        if not store.add(SEARCH_STATS_KEYS[name], 1, None):
+            store.incr(SEARCH_STATS_KEYS[name])
+
+
+def search_cache_stats():
+    """
+    Hit/miss counters of the search cache since the last reset.
+    """
+    store = search_cache()
+    values = store.get_many(SEARCH_STATS_KEYS.values())
+    stats = {name: values.get(key, 0) for name, key in SEARCH_STATS_KEYS.items()}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_search_cache_stats():
+    search_cache().delete_many(SEARCH_STATS_KEYS.values())
+
+
+def _price_multiplier():
+    # The persisted multiplier only counts while dynamic pricing is on
+    if settings.BOOKING_DYNAMIC_PRICING:
+        return F('price_multiplier')
+    return Value(Decimal('1'))
+
+
+def _ranked_fare(expression):
+    """
+    A fare rounded to paise in SQL, so ordering, keyset comparisons and the
+    cursor all see the same value.
+    """
+    return Round(expression, 2, output_field=DecimalField(max_digits=12, decimal_places=2))
+
+
+def _ranked_rows(**columns):
+    """Annotations for RESULT_COLUMNS, each under a `ranked_` name to avoid clashing with model fields."""
+    return {f'ranked_{name}': columns[name] for name in RESULT_COLUMNS}
+
+
+def direct_results(source_ids=None, destination_ids=None, date=None):
+    """Direct buses as ranked search rows."""
+    buses = Bus.objects.filter(is_active=True)
+    if source_ids is not None:
+        buses = buses.filter(route__origin_city_id__in=source_ids)
+    if destination_ids is not None:
+        buses = buses.filter(route__destination_city_id__in=destination_ids)
+    if date:
+        buses = buses.filter(departure_time__date=date)
+    rows = _ranked_rows(
+        kind=Value('d', output_field=CharField()),
+        bus=F('id'),
+        start_stop=Value(None, output_field=IntegerField()),
+        end_stop=Value(None, output_field=IntegerField()),
+        departure=F('departure_time'),
+        arrival=F('arrival_time'),
+        duration=ExpressionWrapper(F('arrival_time') - F('departure_time'), output_field=DurationField()),
+        distance=F('route__distance'),
+        fare=_ranked_fare(F('fare') * _price_multiplier()),
+        seats=F('available_seats'),
+        bus_seats=F('available_seats'),
+        general=F('has_general_seats'),
+        sleeper=F('has_sleeper_seats'),
+        luxury=F('has_luxury_seats'),
+        hour=ExtractHour('departure_time'),
+    )
+    return buses.annotate(**rows).values(*rows).order_by()
+
+
+def multi_stop_results(pairs, date=None):
+    """
+    Multi-stop buses on the routes of `pairs` ({route_id: (start_stop_id,
+    end_stop_id)}, see candidate_stop_pairs) as ranked search rows. Stop
+    times, the fare multiplier and the seats taken on the pair's legs are
+    correlated subqueries on the pair; a route whose stored fare matrix is
+    missing ranks without fares until it is rebuilt.
+    """
+    buses = MultiStopBus.objects.filter(is_active=True, route_id__in=list(pairs))
+    if date:
+        buses = buses.filter(departure_time__date=date)
+    buses = buses.annotate(
+        pair_start=Case(*[When(route_id=route_id, then=Value(start_id)) for route_id, (start_id, _end_id) in pairs.items()],
+                        output_field=IntegerField()),
+        pair_end=Case(*[When(route_id=route_id, then=Value(end_id)) for route_id, (_start_id, end_id) in pairs.items()],
+                      output_field=IntegerField()),
+    )
+    start = RouteStop.objects.filter(pk=OuterRef('pair_start'))
+    end = RouteStop.objects.filter(pk=OuterRef('pair_end'))
+    buses = buses.annotate(pair_start_seq=Subquery(start.values('sequence')[:1]),
+                           pair_end_seq=Subquery(end.values('sequence')[:1]))
+    # Seats allocated on any leg of the pair, as the occupancy bitmap ORs them
+    taken = (SeatAllocation.objects
+             .filter(multistop_bus=OuterRef('pk'), start_seq__gte=OuterRef('pair_start_seq'),
+                     start_seq__lt=OuterRef('pair_end_seq'))
+             .order_by()
+             .values('multistop_bus')
+             .annotate(seats=Count('seat_no', distinct=True))
+             .values('seats'))
+    cell = RouteStopFare.objects.filter(start_stop_id=OuterRef('pair_start'), end_stop_id=OuterRef('pair_end'))
+    departure = ExpressionWrapper(
+        F('departure_time') + Coalesce(Subquery(start.values('departure_offset')[:1]), Value(timedelta())),
+        output_field=DateTimeField())
+    arrival = Coalesce(
+        ExpressionWrapper(F('departure_time') + Subquery(end.values('arrival_offset')[:1]), output_field=DateTimeField()),
+        F('arrival_time'))
+    rows = _ranked_rows(
+        kind=Value('m', output_field=CharField()),
+        bus=F('id'),
+        start_stop=F('pair_start'),
+        end_stop=F('pair_end'),
+        departure=departure,
+        arrival=arrival,
+        duration=ExpressionWrapper(arrival - departure, output_field=DurationField()),
+        distance=Subquery(cell.values('distance')[:1]),
+        fare=_ranked_fare(F('fare') * Subquery(cell.values('fare_multiplier')[:1]) * _price_multiplier()),
+        seats=F('total_seats') - Coalesce(Subquery(taken), Value(0)),
+        bus_seats=F('available_seats'),
+        general=F('has_general_seats'),
+        sleeper=F('has_sleeper_seats'),
+        luxury=F('has_luxury_seats'),
+        hour=ExtractHour(departure),
+    )
+    return buses.annotate(**rows).values(*rows).order_by()
+
+
+def price_bands():
+    """
+    Price facet from settings.BOOKING_SEARCH_PRICE_BANDS: key -> (label,
+    lowest fare, first fare above the band or None).
+    """
+    bounds = (0,) + tuple(settings.BOOKING_SEARCH_PRICE_BANDS)
+    bands = {}
+    for low, high in zip(bounds, bounds[1:] + (None,)):
+        if high is None:
+            bands[f'{low}-'] = (_('₹%(low)s and above') % {'low': low}, low, None)
+        elif low == 0:
+            bands[f'0-{high}'] = (_('Under ₹%(high)s') % {'high': high}, low, high)
+        else:
+            bands[f'{low}-{high}'] = (_('₹%(low)s - ₹%(high)s') % {'low': low, 'high': high}, low, high)
+    return bands
+
+
+def _facet_conditions():
+    """Every facet value as (facet, key, label, Q over the ranked columns)."""
+    conditions = []
+    for seat_class, label in Bus.SEAT_CLASS_CHOICES:
+        conditions.append(('seat_class', seat_class, label,
+                           Q(**{f'ranked_{SEAT_CLASS_COLUMNS[seat_class]}': True}, ranked_seats__gt=0)))
+    for key, (label, first, last) in DEPARTURE_BANDS.items():
+        conditions.append(('departure', key, label, Q(ranked_hour__gte=first, ranked_hour__lt=last)))
+    for key, (label, low, high) in price_bands().items():
+        condition = Q(ranked_fare__gte=low)
+        if high is not None:
+            condition &= Q(ranked_fare__lt=high)
+        conditions.append(('price', key, label, condition))
+    return conditions
+
+
+def _filter_q(filters):
+    """
+    WHERE clause for facet filters ({facet: [keys]}): any selected value of a
+    facet matches, and every facet with a selection must match.
+    """
+    q = Q()
+    by_facet = {}
+    for facet, key, _label, condition in _facet_conditions():
+        if key in (filters or {}).get(facet, ()):
+            by_facet[facet] = by_facet.get(facet, Q()) | condition
+    for condition in by_facet.values():
+        q &= condition
+    return q
+
+
+def _sort_keys(sort):
+    # Ties are broken by kind and bus id, so every row has a unique position
+    return SORT_ORDERING[sort] + ('kind', 'bus')
+
+
+def _keyset_q(sort, after):
+    """
+    WHERE clause for the rows ranked after the row whose sort key values are
+    `after` ({column: value}), matching ranked_results' ordering (NULLs last).
+    """
+    q = None
+    for key in reversed(_sort_keys(sort)):
+        name = key.lstrip('-')
+        column = f'ranked_{name}'
+        value = after[name]
+        if value is None:
+            # Only other NULLs come after a NULL, tied on the remaining keys
+            # (the last key, the bus id, is never NULL)
+            q = Q(**{f'{column}__isnull': True}) & q
+            continue
+        later = Q(**{f"{column}__{'lt' if key.startswith('-') else 'gt'}": value}) | Q(**{f'{column}__isnull': True})
+        q = later | (Q(**{column: value}) & q) if q is not None else later
+    return q
+
+
+def encode_cursor(sort, row):
+    """Opaque, signed cursor for the page after `row` under `sort`."""
+    values = []
+    for key in _sort_keys(sort):
+        value = row[key.lstrip('-')]
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        elif value is not None and not isinstance(value, (int, str)):
+            value = str(value)
+        values.append(value)
+    return signing.dumps([sort, values], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(sort, cursor):
+    """Sort key values ({column: value}) of a cursor; None if it is invalid or from another sort."""
+    try:
+        cursor_sort, values = signing.loads(cursor, salt=CURSOR_SALT)
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+    keys = [key.lstrip('-') for key in _sort_keys(sort)]
+    if cursor_sort != sort or len(values) != len(keys):
+        return None
+    after = {}
+    for name, value in zip(keys, values):
+        if value is not None and name in ('departure', 'arrival'):
+            value = parse_datetime(value)
+        elif value is not None and name == 'duration':
+            value = timedelta(seconds=value)
+        elif value is not None and name in ('fare', 'distance'):
+            value = Decimal(value)
+        after[name] = value
+    return after
+
+
+def _result_sides(source, destination, date=None):
+    """The direct and (with both cities given) multi-stop ranked-row querysets of a search."""
+    # Resolve each city once; routes and stops are then matched on indexed foreign keys
+    source_ids = matching_city_ids(source) if source else None
+    destination_ids = matching_city_ids(destination) if destination else None
+
+    sides = [direct_results(source_ids, destination_ids, date)]
+    pairs = candidate_stop_pairs(source, destination, source_ids, destination_ids) if source and destination else {}
+    if pairs:
+        sides.append(multi_stop_results(pairs, date))
+    return sides
+
+
+def _union(sides):
+    results = sides[0]
+    if len(sides) > 1:
+        results = results.union(*sides[1:], all=True)
+    return results
+
+
+def ranked_results(source, destination, date=None, sort='departure_time', filters=None, after=None):
+    """
+    Direct and multi-stop results as one queryset of ranked rows (dicts of
+    `ranked_` + RESULT_COLUMNS), narrowed by facet `filters`, ordered by
+    `sort` and starting after the row with sort key values `after` (see
+    decode_cursor). Slice it to a page.
+    """
+    where = _filter_q(filters)
+    if after is not None:
+        where &= _keyset_q(sort, after)
+    sides = [side.filter(where) for side in _result_sides(source, destination, date)]
+
+    # Results without a fare or duration sort last either way
+    ordering = [
+        F(f"ranked_{key[1:]}").desc(nulls_last=True) if key.startswith('-')
+        else F(f"ranked_{key}").asc(nulls_last=True)
+        for key in _sort_keys(sort)
+    ]
+    return _union(sides).order_by(*ordering)
+
+
+def compute_facets(source, destination, date=None):
+    """
+    Facet counts of a search, unaffected by facet filters, from one aggregate
+    query over the UNION: {(facet, key): count}.
+    """
+    conditions = _facet_conditions()
+    counts = _union(_result_sides(source, destination, date)).aggregate(**{
+        f'facet_{i}': Count('ranked_bus', filter=condition)
+        for i, (_facet, _key, _label, condition) in enumerate(conditions)
+    })
+    return {(facet, key): counts[f'facet_{i}'] for i, (facet, key, _label, _condition) in enumerate(conditions)}
+
+
+def _hydrate(rows):
+    """
+    Turn ranked rows into result dicts with 'bus', 'start_stop' and
+    'end_stop' (None for direct buses) loaded in bulk. Returns None if a bus
+    or stop is gone or a bus's seats no longer match the row (a change that
+    bypassed invalidation), so the caller re-runs the search.
+    """
+    ids = {'d': set(), 'm': set()}
+    stop_ids = set()
+    for row in rows:
+        ids[row['kind']].add(row['bus'])
+        stop_ids.update(stop_id for stop_id in (row['start_stop'], row['end_stop']) if stop_id is not None)
+    buses = {
+        'd': Bus.objects.select_related('route').in_bulk(ids['d']) if ids['d'] else {},
+        'm': MultiStopBus.objects.select_related('route').in_bulk(ids['m']) if ids['m'] else {},
+    }
+    stops = RouteStop.objects.in_bulk(stop_ids) if stop_ids else {}
+
+    results = []
+    for row in rows:
+        bus = buses[row['kind']].get(row['bus'])
+        if bus is None or bus.available_seats != row['bus_seats'] \
+                or any(stop_id is not None and stop_id not in stops for stop_id in (row['start_stop'], row['end_stop'])):
+            return None
+        results.append(dict(
+            row,
+            bus=bus,
+            start_stop=stops.get(row['start_stop']),
+            end_stop=stops.get(row['end_stop']),
+        ))
+    return results
+
+
+def search_buses(source, destination, date=None, sort='departure_time', filters=None, cursor=None):
+    """
+    One page of ranked search results, served from the search cache.
+
+    Returns (results, next_cursor); next_cursor is None on the last page.
+    Each result is a dict with 'bus', 'start_stop' and 'end_stop' (None for
+    direct buses), plus the segment's 'departure', 'arrival', 'duration',
+    'distance', General 'fare' and free 'seats' (on the segment, for
+    multi-stop buses) as ranked in SQL. `filters`
+    maps facets to selected keys (see compute_facets); `cursor` is the
+    next_cursor of the previous page. Cache entries hold the ranked rows and
+    are hydrated with primary-key lookups; the ranking query only runs on a
+    miss (or when a bus's seats no longer match the row).
+    """
+    if sort not in SORT_ORDERING:
+        sort = 'departure_time'
+    after = decode_cursor(sort, cursor) if cursor else None
+    if after is None:
+        cursor = None
+    filters = {facet: sorted(keys) for facet, keys in (filters or {}).items() if keys}
+    size = settings.BOOKING_SEARCH_PAGE_SIZE
+    store = search_cache()
+    generation = store.get(f"{SEARCH_CACHE_PREFIX}:generation", 0)
+    extra = '|'.join(f"{facet}={','.join(keys)}" for facet, keys in sorted(filters.items()))
+    key = f"{search_cache_key(source, destination, date, sort, extra, cursor or '')}:g{generation}"
+
+    entry = store.get(key)
+    results = _hydrate(entry['rows']) if entry is not None else None
+    if results is not None:
+        _count('hits')
+        return results, entry['next']
+
+    _count('misses')
+    rows = [
+        {name[len('ranked_'):]: value for name, value in row.items()}
+        for row in ranked_results(source, destination, date, sort, filters, after)[:size + 1]
+    ]
+    next_cursor = encode_cursor(sort, rows[size - 1]) if len(rows) > size else None
+    rows = rows[:size]
+    store.set(key, {'rows': rows, 'next': next_cursor}, getattr(settings, 'BOOKING_SEARCH_CACHE_TIMEOUT', 300))
+    return _hydrate(rows) or [], next_cursor
+
+
+def search_facets(source, destination, date=None):
+    """
+    Facet values of a search with their counts (see compute_facets), served
+    from the search cache: {facet: [(key, label, count), ...]}.
+    """
+    store = search_cache()
+    generation = store.get(f"{SEARCH_CACHE_PREFIX}:generation", 0)
+    key = f"{search_cache_key(source, destination, date, 'facets')}:g{generation}"
+    counts = store.get(key)
+    if counts is None:
+        counts = compute_facets(source, destination, date)
+        store.set(key, counts, getattr(settings, 'BOOKING_SEARCH_CACHE_TIMEOUT', 300))
+    facets = {}
+    for facet, key, label, _condition in _facet_conditions():
+        facets.setdefault(facet, []).append((key, label, counts.get((facet, key), 0)))
+    return facets
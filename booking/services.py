@@ -0,0 +1,134 @@
+"""
+Booking write path shared by the direct and OTP-verified booking views.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Least
+from django.utils.translation import gettext_lazy as _
+
+from .models import MultiStopTicket, Passenger, Ticket
+from .occupancy import is_multi_stop_bus, parse_seat_numbers, reserve_seats
+from .pricing import refresh_price
+from .search import invalidate_bus_searches
+
+
+class BookingError(Exception):
+    """Raised when a booking cannot be completed; the transaction is rolled back."""
+
+
+def claim_seat_count(bus, count):
+    """
+    Decrement the bus's available seats by `count` with a single conditional
+    UPDATE, so concurrent bookings can never take the counter below zero.
+    Returns True when the seats were claimed.
+    """
+    claimed = type(bus).objects.filter(
+        pk=bus.pk, is_active=True, available_seats__gte=count
+    ).update(available_seats=F('available_seats') - count) == 1
+    if claimed:
+        # Cached searches show seat availability and fares follow the load factor;
+        # update both once the booking commits, repricing first as search ranks by fare
+        transaction.on_commit(lambda: refresh_price(bus))
+        transaction.on_commit(lambda: invalidate_bus_searches(bus))
+    return claimed
+
+
+def return_seat_count(bus, count):
+    """
+    Give `count` seats back to the bus (capped at total seats) with a single UPDATE.
+    """
+    type(bus).objects.filter(pk=bus.pk).update(
+        available_seats=Least(F('available_seats') + count, F('total_seats'))
+    )
+    transaction.on_commit(lambda: refresh_price(bus))
+    transaction.on_commit(lambda: invalidate_bus_searches(bus))
+
+
+def passenger_count_subquery(model):
+    """
+    Correlated COUNT of a ticket model's passenger through rows, for annotate()/update().
+    """
+    through = model.passengers.through
+    column = model.passengers.field.m2m_field_name()
+    counts = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(column).annotate(
+        total=Count('pk')).values('total')
+    return Coalesce(Subquery(counts), 0)
+
+
+def sync_passenger_counts(model, pks=None):
+    """
+    Recompute the stored passenger_count of the given tickets (all when pks is None)
+    with a single UPDATE. Returns the number of tickets updated.
+    """
+    tickets = model.objects.all() if pks is None else model.objects.filter(pk__in=pks)
+    return tickets.update(passenger_count=passenger_count_subquery(model))
+
+
+def through_ticket_field(ticket):
+    """Name of the ticket id column on the passengers through table."""
+    return type(ticket).passengers.field.m2m_column_name()
+
+
+def create_booking(user, bus, seat_numbers, total_fare, passenger_data,
+                   seat_class='GENERAL', start_stop=None, end_stop=None):
+    """
+    Book seats on a bus (direct or multi-stop) and pay from the user's wallet.
+
+    Everything runs in one transaction with one authoritative seat decrement,
+    one bulk insert each for passengers, through rows and seat allocations, and
+    one ledger row; the query count does not grow with the party size. Any
+    failure raises BookingError or SeatUnavailable and rolls back the whole
+    booking. Returns the created Ticket or MultiStopTicket.
+    """
+    seats = parse_seat_numbers(seat_numbers)
+    if not seats:
+        raise BookingError(_("Please select at least one seat."))
+    if is_multi_stop_bus(bus) and not (start_stop and end_stop):
+        raise BookingError(_("Segment information is missing for multi-stop booking."))
+
+    with transaction.atomic():
+        # Claim the seat count first: this row lock also serialises concurrent
+        # bookings of the same bus for the rest of the transaction.
+        if not claim_seat_count(bus, len(seats)):
+            raise BookingError(_("Sorry, not enough seats are available on this bus."))
+
+        # One INSERT for the whole party
+        passengers = Passenger.objects.bulk_create([Passenger(**data) for data in passenger_data])
+
+        ticket_data = {
+            'user': user,
+            'bus': bus,
+            'total_fare': Decimal(str(total_fare)),
+            'seat_numbers': seat_numbers,
+            'seat_class': seat_class or 'GENERAL',
+            'status': 'BOOKED',
+            'passenger_count': len(passengers),
+        }
+        if start_stop and end_stop:
+            ticket_data.update({'start_stop': start_stop, 'end_stop': end_stop})
+
+        if is_multi_stop_bus(bus):
+            ticket = MultiStopTicket.objects.create(**ticket_data)
+        else:
+            ticket = Ticket.objects.create(**ticket_data)
+
+        # Allocate the seats; raises if another booking took them
+        reserve_seats(bus, seats, start_stop, end_stop, ticket=ticket)
+
+        # One INSERT for the m2m through rows (the ticket is new, so no existing-row check).
+        # bulk_create skips m2m_changed; passenger_count was set on the ticket above.
+        through = type(ticket).passengers.through
+        through.objects.bulk_create([
+            through(**{through_ticket_field(ticket): ticket.pk, 'passenger_id': passenger.pk})
+            for passenger in passengers
+        ])
+
+        # Book with wallet (deduct money)
+        if not ticket.book_with_wallet():
+            raise BookingError(_("Failed to process payment."))
+
+    # Keep the caller's instance in step with the database
+    bus.refresh_from_db(fields=['available_seats'])
+    return ticket
@@ -1,8 +1,16 @@
-from django.db.models.signals import post_save, m2m_changed, pre_delete
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
-from .models import Ticket, Wallet
+from .models import City, CityAlias, Route, Bus, MultiStopBus, Ticket, MultiStopTicket, Passenger, Wallet, RouteStop, RouteSegment
+from .fares import invalidate_fare_matrix
+from .search import invalidate_city_stop_index, invalidate_bus_searches, invalidate_all_searches
+from .occupancy import release_ticket_seats, touch_seat_map
+from .planner import mark_trips_changed
+from .pricing import refresh_price
+from .services import return_seat_count, sync_passenger_counts
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_user_wallet(sender, instance, created, **kwargs):
@@ -12,32 +20,163 @@ def create_user_wallet(sender, instance, created, **kwargs):
     if created:
         Wallet.objects.create(user=instance)
 
-@receiver(m2m_changed, sender=Ticket.passengers.through)
-def update_available_seats_on_passenger_change(sender, instance, action, **kwargs):
-    """
-    Update available seats when passengers are added or removed from a ticket.
-    """
-    if action == 'post_add' and instance.status == 'BOOKED':
-        # Decrease available seats when passengers are added
-        bus = instance.bus
-        passengers_count = instance.passengers.count()
-        bus.available_seats = max(0, bus.available_seats - passengers_count)
-        bus.save()
-    
-    elif action == 'post_remove' and instance.status == 'BOOKED':
-        # Increase available seats when passengers are removed
-        bus = instance.bus
-        passengers_count = kwargs.get('pk_set', set())
-        bus.available_seats = min(bus.total_seats, bus.available_seats + len(passengers_count))
-        bus.save()
-
 @receiver(pre_delete, sender=Ticket)
 def update_available_seats_on_ticket_delete(sender, instance, **kwargs):
     """
     Update available seats when a ticket is deleted.
     """
     if instance.status == 'BOOKED':
-        bus = instance.bus
-        passengers_count = instance.passengers.count()
-        bus.available_seats = min(bus.total_seats, bus.available_seats + passengers_count)
-        bus.save() 
\ No newline at end of file
+        return_seat_count(instance.bus, instance.passenger_count)
+        release_ticket_seats(instance)
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def invalidate_search_index_on_stop_change(sender, instance, **kwargs):
+    """
+    Rebuild the city -> stop search index lazily when route stops change.
+    """
+    invalidate_city_stop_index()
+    invalidate_all_searches()
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def touch_seat_maps_on_stop_change(sender, instance, **kwargs):
+    """
+    Stops define the legs of a multi-stop seat map, so cached seat maps of the route are stale.
+    """
+    touch_seat_map(route=instance.route_id)
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+@receiver(post_save, sender=RouteSegment)
+@receiver(post_delete, sender=RouteSegment)
+def rebuild_fare_matrix_on_route_change(sender, instance, **kwargs):
+    """
+    Stops and segments define a route's stop-to-stop fare matrix, which search ranks fares with.
+    """
+    invalidate_fare_matrix(instance.route_id)
+    invalidate_all_searches()
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=CityAlias)
+@receiver(post_delete, sender=CityAlias)
+def invalidate_searches_on_route_change(sender, instance, **kwargs):
+    """
+    Route, city and alias changes can change search results on any date.
+    """
+    invalidate_all_searches()
+
+@receiver(pre_save, sender=Bus)
+@receiver(pre_save, sender=MultiStopBus)
+def remember_previous_departure(sender, instance, **kwargs):
+    """
+    Remember the departure being replaced, so searches on the old date are dropped too.
+    """
+    instance._previous_departure = None
+    if instance.pk:
+        instance._previous_departure = sender.objects.filter(pk=instance.pk).values_list(
+            'departure_time', flat=True).first()
+
+@receiver(post_save, sender=Bus)
+@receiver(post_delete, sender=Bus)
+@receiver(post_save, sender=MultiStopBus)
+@receiver(post_delete, sender=MultiStopBus)
+def invalidate_searches_on_bus_change(sender, instance, **kwargs):
+    """
+    Drop cached searches for the dates the bus departs on (and used to).
+    """
+    previous = getattr(instance, '_previous_departure', None)
+    extra_dates = [timezone.localtime(previous).date()] if previous else []
+    invalidate_bus_searches(instance, *extra_dates)
+
+@receiver(post_save, sender=Bus)
+@receiver(post_save, sender=MultiStopBus)
+def reprice_on_bus_change(sender, instance, **kwargs):
+    """
+    Seats and departure time drive the bus's price multiplier, which search ranks fares with.
+    """
+    def reprice():
+        refresh_price(instance)
+        invalidate_bus_searches(instance)
+
+    transaction.on_commit(reprice)
+
+@receiver(post_save, sender=Bus)
+@receiver(post_delete, sender=Bus)
+@receiver(post_save, sender=MultiStopBus)
+@receiver(post_delete, sender=MultiStopBus)
+def update_journey_planner_on_bus_change(sender, instance, **kwargs):
+    """
+    Reload the bus's connections into the journey planner's timetable.
+    """
+    if sender is Bus:
+        mark_trips_changed(direct_ids=[instance.pk])
+    else:
+        mark_trips_changed(multi_stop_ids=[instance.pk])
+
+@receiver(post_save, sender=Route)
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def update_journey_planner_on_route_change(sender, instance, **kwargs):
+    """
+    Route endpoints and stop offsets shape the connections of every bus on the route.
+    Deleted routes need nothing: their buses are deleted with them.
+    """
+    if sender is Route:
+        mark_trips_changed(direct_ids=list(instance.buses.values_list('pk', flat=True)))
+    else:
+        mark_trips_changed(multi_stop_ids=list(
+            MultiStopBus.objects.filter(route_id=instance.route_id).values_list('pk', flat=True)))
+
+@receiver(post_save, sender=Bus)
+@receiver(post_save, sender=MultiStopBus)
+def touch_seat_map_on_bus_change(sender, instance, created, **kwargs):
+    """
+    A changed seat count rebuilds the bitmap on next use; make cached seat maps refetch it.
+    """
+    if not created:
+        touch_seat_map(instance)
+
+@receiver(m2m_changed, sender=Ticket.passengers.through)
+@receiver(m2m_changed, sender=MultiStopTicket.passengers.through)
+def sync_passenger_count_on_m2m_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep Ticket/MultiStopTicket.passenger_count in step with passengers.add/remove/clear/set.
+    """
+    ticket_model = Ticket if sender is Ticket.passengers.through else MultiStopTicket
+    if reverse and action == 'pre_clear':
+        # passenger.tickets.clear(): remember which tickets lose the passenger
+        column = ticket_model.passengers.field.m2m_reverse_field_name()
+        instance._cleared_ticket_ids = list(sender.objects.filter(**{column: instance.pk}).values_list(
+            ticket_model.passengers.field.m2m_column_name(), flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        sync_passenger_counts(ticket_model, [instance.pk])
+        instance.refresh_from_db(fields=['passenger_count'])
+    elif action == 'post_clear':
+        sync_passenger_counts(ticket_model, getattr(instance, '_cleared_ticket_ids', []))
+    else:
+        sync_passenger_counts(ticket_model, pk_set)
+
+@receiver(pre_delete, sender=Passenger)
+def remember_passenger_tickets(sender, instance, **kwargs):
+    """
+    Remember the tickets of a passenger being deleted; the cascade removes the
+    through rows without sending m2m_changed.
+    """
+    instance._ticket_ids = list(instance.tickets.values_list('pk', flat=True))
+    instance._multistop_ticket_ids = list(instance.multistop_tickets.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Passenger)
+def sync_passenger_count_on_passenger_delete(sender, instance, **kwargs):
+    """
+    Recount the tickets that lost a deleted passenger.
+    """
+    sync_passenger_counts(Ticket, getattr(instance, '_ticket_ids', []))
+    sync_passenger_counts(MultiStopTicket, getattr(instance, '_multistop_ticket_ids', []))
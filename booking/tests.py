@@ -1,3 +1,473 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import EmailOutbox, User
+from booking import planner
+from booking.cancellations import process_batch, start_bus_cancellation
+from booking.exports import claim_export, export_path
+from booking.fares import get_segment_fare
+from booking.occupancy import SeatUnavailable, get_stop_sequences, leg_span
+from booking.pricing import compute_multipliers, live_fare, price_key
+from booking.search import get_city_stop_index, invalidate_city_stop_index, match_city_stops
+from booking.services import BookingError, create_booking
+from booking.models import (
+    BookingExport, Bus, CancellationJob, MultiStopBus, MultiStopRoute, MultiStopTicket, Route, RouteFareMatrix, RouteSegment,
+    RouteStop, RouteStopFare, SeatAllocation, Ticket, Transaction, Wallet,
+)
+
+
+class BookingTestMixin:
+    """
+    A user with a funded wallet, a direct Pilani -> Delhi bus and a multi-stop
+    bus over Pilani, Jaipur, Agra and Delhi, an hour apart, with a segment
+    between every pair of stops.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='rider@example.com', full_name='Test Rider', password='pw12345!x')
+        self.client.force_login(self.user)
+        Wallet.objects.filter(user=self.user).update(balance=Decimal('10000.00'))
+        self.departure = timezone.now() + timedelta(days=3)
+
+        self.route = Route.objects.create(origin='Pilani', destination='Delhi')
+        self.bus = Bus.objects.create(
+            route=self.route, bus_number='DL-001', departure_time=self.departure,
+            arrival_time=self.departure + timedelta(hours=5), total_seats=10, available_seats=10,
+            fare=Decimal('100.00'))
+
+        # Route changes rebuild the fare matrix once they commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_multi_stop_route()
+        self.multi_bus = MultiStopBus.objects.create(
+            route=self.multi_route, bus_number='MS-001', departure_time=self.departure,
+            arrival_time=self.departure + timedelta(hours=5), total_seats=10, available_seats=10,
+            fare=Decimal('100.00'))
+
+    def create_multi_stop_route(self):
+        self.multi_route = MultiStopRoute.objects.create(name='Pilani Express')
+        self.stops = [
+            RouteStop.objects.create(route=self.multi_route, city=city, sequence=i + 1,
+                                     arrival_offset=timedelta(hours=i), departure_offset=timedelta(hours=i))
+            for i, city in enumerate(['Pilani', 'Jaipur', 'Agra', 'Delhi'])
+        ]
+        for i in range(len(self.stops)):
+            for j in range(i + 1, len(self.stops)):
+                RouteSegment.objects.create(route=self.multi_route, start_stop=self.stops[i], end_stop=self.stops[j],
+                                            base_fare_multiplier=Decimal('0.30') * (j - i))
+
+    def search(self, **params):
+        return self.client.get(reverse('booking:bus_search'), params)
+
+
+class ConnectingJourneyTests(BookingTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        planner.reset_timetable()
+        self.addCleanup(planner.reset_timetable)
+
+    def test_connection_through_multi_stop_bus(self):
+        onward = Bus.objects.create(
+            route=Route.objects.create(origin='Jaipur', destination='Lucknow'), bus_number='LK-001',
+            departure_time=self.departure + timedelta(hours=3), arrival_time=self.departure + timedelta(hours=8),
+            total_seats=10, available_seats=10, fare=Decimal('50.00'))
+
+        response = self.search(source='Pilani', destination='Lucknow', date=self.departure.date().isoformat())
+
+        journeys = response.context['connecting_journeys']
+        self.assertEqual(len(journeys), 1)
+        self.assertEqual([leg['bus'] for leg in journeys[0]['legs']], [self.multi_bus, onward])
+
+    def test_search_with_stops_missing_offsets(self):
+        # A second route whose stops have no timetable, or only half of one
+        route = MultiStopRoute.objects.create(name='Untimed')
+        RouteStop.objects.create(route=route, city='Pilani', sequence=1)
+        RouteStop.objects.create(route=route, city='Jaipur', sequence=2, arrival_offset=timedelta(hours=2))
+        RouteStop.objects.create(route=route, city='Delhi', sequence=3)
+        MultiStopBus.objects.create(
+            route=route, bus_number='MS-002', departure_time=self.departure,
+            arrival_time=self.departure + timedelta(hours=6), total_seats=10, available_seats=10,
+            fare=Decimal('100.00'))
+
+        response = self.search(source='Pilani', destination='Delhi', date=self.departure.date().isoformat())
+
+        self.assertEqual(response.status_code, 200)
+        legs = planner.load_trips()
+        untimed = [connections for (kind, pk), connections in legs.items()
+                   if kind == planner.MULTI_STOP and pk != self.multi_bus.pk]
+        # Pilani -> Jaipur keeps its times; Jaipur -> Delhi has no arrival and is left out
+        self.assertEqual([len(connections) for connections in untimed], [1])
+
+
+class CityStopIndexTests(BookingTestMixin, TestCase):
+
+    def test_invalidation_retires_the_cached_index(self):
+        get_city_stop_index()
+        # Saved without signals, like an edit made on another worker
+        stop = RouteStop.objects.bulk_create([RouteStop(
+            route=MultiStopRoute.objects.create(name='Desert Line'), city='Pilani', sequence=1,
+            canonical_city=self.stops[0].canonical_city)])[0]
+        self.assertNotIn(stop.pk, [stop_id for _route, _sequence, stop_id in match_city_stops('Pilani')])
+
+        invalidate_city_stop_index()
+        self.assertIn(stop.pk, [stop_id for _route, _sequence, stop_id in match_city_stops('Pilani')])
+
+
+@override_settings(BOOKING_DYNAMIC_PRICING=True, BOOKING_SEARCH_PAGE_SIZE=3)
+class SearchPagingTests(BookingTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Fares that only differ past the paise once multiplied, and ties on departure
+        for i in range(10):
+            bus = Bus.objects.create(
+                route=self.route, bus_number=f'DL-1{i:02}', departure_time=self.departure + timedelta(minutes=i % 3),
+                arrival_time=self.departure + timedelta(hours=2 + i % 4), total_seats=10, available_seats=10,
+                fare=Decimal('333.33'))
+            Bus.objects.filter(pk=bus.pk).update(price_multiplier=Decimal('1') + Decimal(i) / 1000000)
+        # A multi-stop route without segments has no fare
+        route = MultiStopRoute.objects.create(name='Unpriced')
+        RouteStop.objects.create(route=route, city='Pilani', sequence=1)
+        RouteStop.objects.create(route=route, city='Delhi', sequence=2, arrival_offset=timedelta(hours=4))
+        MultiStopBus.objects.create(
+            route=route, bus_number='MS-002', departure_time=self.departure, arrival_time=self.departure + timedelta(hours=4),
+            total_seats=10, available_seats=10, fare=Decimal('100.00'))
+
+    def walk(self, **params):
+        """Every page of a search, following the cursors: [(kind, bus id), ...] in page order."""
+        params = dict(source='Pilani', destination='Delhi', date=self.departure.date().isoformat(), **params)
+        seen = []
+        response = self.search(**params)
+        while True:
+            results = response.context['results']
+            self.assertLessEqual(len(results), 3)
+            seen.extend((result['kind'], result['bus'].pk) for result in results)
+            if not response.context['next_cursor']:
+                return seen
+            response = self.search(after=response.context['next_cursor'], **params)
+
+    def test_every_sort_pages_without_duplicates_or_gaps(self):
+        everything = {('d', self.bus.pk), ('m', self.multi_bus.pk)}
+        everything |= {('d', pk) for pk in Bus.objects.filter(bus_number__startswith='DL-1').values_list('pk', flat=True)}
+        everything |= {('m', pk) for pk in MultiStopBus.objects.filter(bus_number='MS-002').values_list('pk', flat=True)}
+        for sort in ('fare_low', 'fare_high', 'departure_early', 'departure_late', 'duration'):
+            with self.subTest(sort=sort):
+                seen = self.walk(sort=sort)
+                self.assertEqual(len(seen), len(set(seen)))
+                self.assertEqual(set(seen), everything)
+
+    def test_fare_pages_follow_the_ranked_order(self):
+        fares = []
+        params = dict(source='Pilani', destination='Delhi', date=self.departure.date().isoformat(), sort='fare_high')
+        response = self.search(**params)
+        while True:
+            fares.extend(result['fare'] for result in response.context['results'])
+            if not response.context['next_cursor']:
+                break
+            response = self.search(after=response.context['next_cursor'], **params)
+        priced = [fare for fare in fares if fare is not None]
+        self.assertEqual(priced, sorted(priced, reverse=True))
+        # The route without segments sorts last
+        self.assertIsNone(fares[-1])
+
+
+class SegmentSeatsTests(BookingTestMixin, TestCase):
+    """Multi-stop results show the free seats of the searched segment, not of the whole bus."""
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.select_related('wallet').get(pk=self.user.pk)
+        passengers = [{'name': f'Passenger {seat}', 'age': 30, 'gender': 'O'} for seat in range(10)]
+        # Every seat taken from Pilani to Jaipur
+        with self.captureOnCommitCallbacks(execute=True):
+            create_booking(user, self.multi_bus, ','.join(map(str, range(1, 11))), Decimal('1000.00'), passengers,
+                           start_stop=self.stops[0], end_stop=self.stops[1])
+
+    def multi_stop_seats(self, source, destination, **filters):
+        response = self.search(source=source, destination=destination, date=self.departure.date().isoformat(),
+                               **filters)
+        return [result['seats'] for result in response.context['results'] if result['kind'] == 'm']
+
+    def test_seats_follow_the_segment(self):
+        self.assertEqual(self.multi_stop_seats('Pilani', 'Agra'), [0])
+        self.assertEqual(self.multi_stop_seats('Jaipur', 'Delhi'), [10])
+
+    def test_seat_class_facet_skips_full_segments(self):
+        self.assertEqual(self.multi_stop_seats('Pilani', 'Agra', seat_class='GENERAL'), [])
+        self.assertEqual(self.multi_stop_seats('Jaipur', 'Delhi', seat_class='GENERAL'), [10])
+
+    def test_segment_must_run_forward(self):
+        sequences = get_stop_sequences(self.multi_bus)
+        self.assertEqual(leg_span(sequences, self.stops[1], self.stops[3]), (1, 3))
+        for start, end in ((self.stops[2], self.stops[0]), (self.stops[1], self.stops[1])):
+            with self.subTest(start=start.city, end=end.city), self.assertRaises(ValueError):
+                leg_span(sequences, start, end)
+
+
+class FareMatrixTests(BookingTestMixin, TestCase):
+    """Search ranks multi-stop fares from the stored matrix; reading fares never writes one."""
+
+    def multi_stop_fares(self, source, destination):
+        response = self.search(source=source, destination=destination, date=self.departure.date().isoformat())
+        return [result['fare'] for result in response.context['results'] if result['kind'] == 'm']
+
+    def test_search_ranks_segment_fares(self):
+        self.assertTrue(RouteFareMatrix.objects.filter(route=self.multi_route).exists())
+        self.assertEqual(self.multi_stop_fares('Jaipur', 'Delhi'), [Decimal('60.00')])
+
+    def test_reads_do_not_build_missing_matrices(self):
+        RouteFareMatrix.objects.filter(route=self.multi_route).delete()
+
+        segment = get_segment_fare(self.multi_route.pk, self.stops[0], self.stops[2])
+        self.assertEqual(segment.base_fare_multiplier, Decimal('0.60'))
+        self.assertEqual(self.multi_stop_fares('Pilani', 'Agra'), [None])
+        self.assertFalse(RouteFareMatrix.objects.exists())
+        self.assertFalse(RouteStopFare.objects.exists())
+
+
+@override_settings(BOOKING_DYNAMIC_PRICING=True)
+class DynamicPricingTests(BookingTestMixin, TestCase):
+    """Search ranks with the same multiplier bookings are charged with."""
+
+    def test_booking_reprices_search_and_checkout_alike(self):
+        user = User.objects.select_related('wallet').get(pk=self.user.pk)
+        passengers = [{'name': 'Passenger', 'age': 30, 'gender': 'O'}] * 2
+        with self.captureOnCommitCallbacks(execute=True):
+            create_booking(user, self.bus, '1,2', Decimal('200.00'), passengers)
+
+        self.bus.refresh_from_db()
+        # Two of ten seats sold in the last day puts the bus in a higher demand band
+        self.assertEqual(self.bus.price_multiplier, compute_multipliers([self.bus])[price_key(self.bus)])
+        self.assertGreater(self.bus.price_multiplier, Decimal('1.1'))
+        response = self.search(source='Pilani', destination='Delhi', date=self.departure.date().isoformat())
+        fares = {result['bus'].pk: result['fare'] for result in response.context['results']
+                 if result['kind'] == 'd'}
+        self.assertEqual(fares[self.bus.pk], live_fare(self.bus))
+        self.assertGreater(live_fare(self.bus), self.bus.fare)
+
+
+class BookingQueryCountTests(BookingTestMixin, TestCase):
+    """The booking write path runs the same number of queries whatever the party size."""
+
+    DIRECT_QUERIES = 19
+    MULTI_STOP_QUERIES = 20
+
+    def setUp(self):
+        super().setUp()
+        Bus.objects.filter(pk=self.bus.pk).update(total_seats=20, available_seats=20)
+        MultiStopBus.objects.filter(pk=self.multi_bus.pk).update(total_seats=20, available_seats=20)
+        self.bus.refresh_from_db()
+        self.multi_bus.refresh_from_db()
+        self.user = User.objects.select_related('wallet').get(pk=self.user.pk)
+
+    def book(self, bus, seats, **segment):
+        passengers = [{'name': f'Passenger {seat}', 'age': 30, 'gender': 'O'} for seat in seats]
+        return create_booking(self.user, bus, ','.join(map(str, seats)), Decimal('10.00') * len(seats),
+                              passengers, **segment)
+
+    def assert_constant_queries(self, bus, expected, **segment):
+        # The first booking of a bus creates its occupancy row; measure the steady state
+        self.book(bus, [1], **segment)
+        next_seat = 2
+        for size in (1, 2, 4, 6):
+            with self.subTest(party_size=size), self.assertNumQueries(expected):
+                self.book(bus, list(range(next_seat, next_seat + size)), **segment)
+            next_seat += size
+
+    def test_direct_booking(self):
+        self.assert_constant_queries(self.bus, self.DIRECT_QUERIES)
+
+    def test_multi_stop_booking(self):
+        self.assert_constant_queries(self.multi_bus, self.MULTI_STOP_QUERIES,
+                                     start_stop=self.stops[0], end_stop=self.stops[2])
+
+
+class TicketCancellationTests(BookingTestMixin, TestCase):
+    """A ticket is refunded and its seats returned once, however many times it is cancelled."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.select_related('wallet').get(pk=self.user.pk)
+
+    def book(self, bus, **segment):
+        passengers = [{'name': 'Passenger', 'age': 30, 'gender': 'O'}] * 2
+        ticket = create_booking(self.user, bus, '1,2', Decimal('200.00'), passengers, **segment)
+        # Two copies loaded before either cancels, as in two racing requests
+        model = type(ticket)
+        return model.objects.get(pk=ticket.pk), model.objects.get(pk=ticket.pk)
+
+    def assert_refunded_once(self, bus, ticket):
+        bus.refresh_from_db()
+        self.assertEqual(bus.available_seats, bus.total_seats)
+        ticket_field = 'related_multistop_ticket' if isinstance(ticket, MultiStopTicket) else 'related_ticket'
+        self.assertEqual(Transaction.objects.filter(transaction_type='REFUND', **{ticket_field: ticket}).count(), 1)
+        self.assertEqual(Wallet.objects.get(user=self.user).balance, Decimal('10000.00'))
+
+    def test_cancel_twice(self):
+        first, second = self.book(self.bus)
+
+        self.assertTrue(first.cancel())
+        self.assertFalse(second.cancel())
+        self.assertFalse(second.cancel_and_refund())
+        self.assert_refunded_once(self.bus, first)
+
+    def test_multi_stop_cancel_twice(self):
+        first, second = self.book(self.multi_bus, start_stop=self.stops[1], end_stop=self.stops[3])
+
+        self.assertTrue(first.cancel_and_refund())
+        self.assertFalse(second.cancel())
+        self.assert_refunded_once(self.multi_bus, first)
+
+    def test_cancel_after_bus_cancellation(self):
+        ticket, _copy = self.book(self.bus)
+        job = start_bus_cancellation(self.bus)
+        process_batch(job)
+
+        self.assertFalse(ticket.cancel())
+        self.assertFalse(ticket.cancel_and_refund())
+        self.assert_refunded_once(self.bus, ticket)
+        notice = EmailOutbox.objects.get(subject__contains=self.bus.bus_number)
+        self.assertEqual(notice.recipients, [self.user.email])
+        self.assertIn(f'#{ticket.pk}', notice.body)
+        self.assertIn('Rs. 200.00 (100%)', notice.body)
+
+    def test_admin_queues_bus_cancellation_for_the_worker(self):
+        ticket, _copy = self.book(self.bus)
+        admin = User.objects.create_superuser(email='admin@example.com', full_name='Admin', password='pw12345!x')
+        self.client.force_login(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:booking_bus_changelist'),
+                             {'action': 'cancel_and_refund_buses', '_selected_action': [self.bus.pk]})
+
+        job = CancellationJob.objects.get(bus=self.bus)
+        self.assertEqual(job.status, 'PENDING')
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.status, 'BOOKED')
+
+        call_command('run_cancellation_jobs', stdout=io.StringIO())
+        job.refresh_from_db()
+        ticket.refresh_from_db()
+        self.assertEqual((job.status, ticket.status), ('COMPLETED', 'CANCELLED'))
+        self.assert_refunded_once(self.bus, ticket)
+
+
+class BookingExportTests(BookingTestMixin, TestCase):
+    """Large admin exports are queued, and only the worker that claims one writes it."""
+
+    def setUp(self):
+        super().setUp()
+        export_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(export_dir.cleanup)
+        settings = override_settings(BOOKING_EXPORT_BACKGROUND_TICKETS=0, BOOKING_EXPORT_DIR=export_dir.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_admin_queues_export_for_the_worker(self):
+        create_booking(self.user, self.bus, '1', Decimal('100.00'), [{'name': 'Passenger', 'age': 30, 'gender': 'O'}])
+        admin = User.objects.create_superuser(email='admin@example.com', full_name='Admin', password='pw12345!x')
+        self.client.force_login(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:booking_bus_changelist'),
+                             {'action': 'export_bookings_to_csv', '_selected_action': [self.bus.pk]})
+
+        export = BookingExport.objects.get()
+        self.assertEqual((export.status, export.file_name), ('PENDING', ''))
+
+        call_command('run_booking_exports', stdout=io.StringIO())
+        export.refresh_from_db()
+        self.assertEqual(export.status, 'COMPLETED')
+        self.assertTrue(os.path.exists(export_path(export)))
+
+    def test_running_export_is_left_to_its_worker(self):
+        export = BookingExport.objects.create(format='CSV', bus_ids=[self.bus.pk])
+        self.assertTrue(claim_export(export))
+        self.assertFalse(claim_export(export))
+
+        call_command('run_booking_exports', stdout=io.StringIO())
+        export.refresh_from_db()
+        self.assertEqual((export.status, export.file_name), ('RUNNING', ''))
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """
+    Many threads booking overlapping seats on one bus: no seat is sold twice,
+    the seat counter matches the allocations and each wallet matches its ledger.
+    """
+
+    SEATS = 12
+    THREADS = 8
+    ATTEMPTS_PER_THREAD = 6
+
+    def setUp(self):
+        cache.clear()
+        departure = timezone.now() + timedelta(days=7)
+        self.bus = Bus.objects.create(
+            route=Route.objects.create(origin='Pilani', destination='Delhi'), bus_number='ST-001',
+            departure_time=departure, arrival_time=departure + timedelta(hours=4), total_seats=self.SEATS,
+            available_seats=self.SEATS, fare=Decimal('100.00'))
+        self.users = []
+        for i in range(self.THREADS):
+            user = User.objects.create_user(email=f'stress{i}@example.com', full_name=f'Stress {i}', password=None)
+            user.wallet.deposit(Decimal('5000.00'))
+            self.users.append(user)
+
+    def attempt(self, user, seats):
+        for _retry in range(50):
+            try:
+                user = User.objects.select_related('wallet').get(pk=user.pk)
+                passengers = [{'name': user.full_name, 'age': 30, 'gender': 'O'}] * len(seats)
+                create_booking(user, Bus.objects.get(pk=self.bus.pk), ','.join(map(str, seats)),
+                               Decimal('100.00') * len(seats), passengers)
+            except OperationalError:
+                # SQLite lets one writer in at a time; try again like a client would
+                time.sleep(0.005)
+                continue
+            except (BookingError, SeatUnavailable):
+                # Seat taken or sold out: must leave no trace
+                pass
+            break
+
+    def run_threads(self):
+        def work(i):
+            try:
+                for attempt in range(self.ATTEMPTS_PER_THREAD):
+                    # Overlapping pairs, so threads compete for the same seats
+                    first = (i + attempt) % (self.SEATS - 1) + 1
+                    self.attempt(self.users[i], [first, first + 1])
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_no_overbooking(self):
+        self.run_threads()
+
+        self.bus.refresh_from_db()
+        allocations = list(SeatAllocation.objects.filter(bus=self.bus).values_list('seat_no', flat=True))
+        self.assertEqual(len(allocations), len(set(allocations)), 'a seat was sold twice')
+        self.assertTrue(0 <= self.bus.available_seats <= self.bus.total_seats)
+        self.assertEqual(self.bus.total_seats - self.bus.available_seats, len(allocations))
+        booked = Ticket.objects.filter(bus=self.bus, status='BOOKED')
+        self.assertTrue(booked.exists())
+        self.assertEqual(sum(ticket.passenger_count for ticket in booked), len(allocations))
+        for wallet in Wallet.objects.filter(user__in=self.users):
+            self.assertEqual(wallet.balance, wallet.ledger_balance())
+            spent = sum(ticket.total_fare for ticket in booked if ticket.user_id == wallet.user_id)
+            self.assertEqual(wallet.balance, Decimal('5000.00') - spent)
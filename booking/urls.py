@@ -7,10 +7,14 @@ urlpatterns = [
     # Search and main views
     path('', views.index, name='index'),
     path('search/', views.bus_search, name='bus_search'),
+    path('cities/autocomplete/', views.city_autocomplete, name='city_autocomplete'),
     path('bus/<int:bus_id>/', views.bus_detail, name='bus_detail'),
     path('bus/<int:bus_id>/seats/', views.view_seats, name='view_seats'),
+    path('bus/<int:bus_id>/seats/data/', views.seat_map_data, name='seat_map_data'),
+    path('bus/<int:bus_id>/seats/events/', views.seat_events, name='seat_events'),
     
     # Ticket booking flows
+    path('bus/<int:bus_id>/seats/hold/', views.hold_seats, name='hold_seats'),
     path('book/<int:bus_id>/', views.book_ticket, name='book_ticket'),
     path('booking/verify-otp/', views.verify_booking_otp, name='verify_booking_otp'),
     path('booking/resend-otp/', views.resend_booking_otp, name='resend_booking_otp'),
@@ -1,7 +1,8 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_http_methods, condition
+from django.views.decorators.cache import cache_control
 from django.urls import reverse
 from django.forms import formset_factory, modelformset_factory
 from django.db import transaction
@@ -10,13 +11,27 @@ from django.utils import timezone
 from datetime import timedelta
 from django.core.paginator import Paginator
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.db.models import Q
 from decimal import Decimal
 from django.http import Http404
+import re
+from asgiref.sync import sync_to_async
 
-from .models import Bus, Ticket, Passenger, Wallet, Transaction, RouteSegment, RouteStop, MultiStopBus, MultiStopTicket
+from .models import Bus, Ticket, Passenger, Wallet, Transaction, RouteStop, MultiStopBus, MultiStopTicket
 from .forms import PassengerForm, TicketBookingForm, BusSearchForm, WalletDepositForm, BusForm, PassengerEditForm
+from .search import search_buses, search_facets
+from .planner import find_connecting_journeys
+from .cities import autocomplete_cities
+from .journeys import journey_page
+from .events import seat_channel, seat_event_stream
+from .occupancy import seat_map, seat_map_version, get_stop_sequences, load_occupancy, leg_span, leg_mask, check_seats, parse_seat_numbers, SeatUnavailable
+from .holds import place_hold, hold_ttl
+from .cancellations import start_bus_cancellation
+from .services import create_booking
+from .fares import get_segment_fare
+from .pricing import attach_live_fares, live_class_fares, live_fare
+from accounts.ratelimit import ratelimit
 
 def index(request):
     """
@@ -27,6 +42,7 @@ def index(request):
         is_active=True, 
         departure_time__gt=timezone.now()
     ).order_by('departure_time')[:5]
+    featured_buses, _segments = attach_live_fares(featured_buses)
     
     # Initialize the search form
     search_form = BusSearchForm()
@@ -53,6 +69,7 @@ def bus_detail(request, bus_id):
     
     context = {
         'bus': bus,
+        'fare': live_fare(bus),
         'is_fully_booked': is_fully_booked,
         'booked_seats_count': booked_seats_count,
     }
@@ -167,8 +184,11 @@ def bus_search(request):
     Includes both direct routes and multi-stop bus segments.
     """
     form = BusSearchForm(request.GET or None)
-    buses = []
-    multi_stop_buses = []
+    results = []
+    facets = {}
+    next_cursor = None
+    connecting_journeys = []
+    cursor = request.GET.get('after')
     
     if form.is_valid():
         source = form.cleaned_data.get('source')
@@ -176,160 +196,191 @@ def bus_search(request):
         date = form.cleaned_data.get('date')
         sort_by = request.GET.get('sort', 'departure_time')  # Default sort by departure time
         
-        # Filter regular buses based on search criteria
-        buses_query = Bus.objects.filter(is_active=True)
-        
-        if source:
-            buses_query = buses_query.filter(route__origin__icontains=source)
-        
-        if destination:
-            buses_query = buses_query.filter(route__destination__icontains=destination)
-        
-        if date:
-            # Filter by departure date
-            buses_query = buses_query.filter(departure_time__date=date)
-        
-        # Get regular buses
-        buses = buses_query
-        
-        # Search for multi-stop buses with matching segments
-        if source and destination:
-            from django.db.models import F
-            
-            # Find multi-stop routes with matching segments
-            multi_stop_buses_query = MultiStopBus.objects.filter(is_active=True)
-            
-            # Filter by date if provided
-            if date:
-                multi_stop_buses_query = multi_stop_buses_query.filter(departure_time__date=date)
-            
-            # Get all multi-stop buses
-            potential_buses = list(multi_stop_buses_query)
-            matching_multi_stop_buses = []
-            
-            # For each bus, check if it has a segment that matches the search
-            for bus in potential_buses:
-                # Get all stops for this route
-                stops = bus.route.stops.all().order_by('sequence')
-                
-                # Check each combination of stops to see if any match the search
-                for i, start_stop in enumerate(stops):
-                    for end_stop in stops[i+1:]:  # Only consider stops after the start stop
-                        # Check if this segment matches the search
-                        if (source.lower() in start_stop.city.lower() and 
-                            destination.lower() in end_stop.city.lower()):
-                            # Add to matching buses with segment info
-                            matching_multi_stop_buses.append({
-                                'bus': bus,
-                                'start_stop': start_stop,
-                                'end_stop': end_stop
-                            })
-                            # Once we find a matching segment, break out of the inner loop
-                            break
-                    # If we found a match, no need to check other start stops
-                    if matching_multi_stop_buses and matching_multi_stop_buses[-1]['bus'] == bus:
-                        break
-            
-            multi_stop_buses = matching_multi_stop_buses
-        
-        # Apply sorting - note: this is simplified and may need adjustment
-        # For proper sorting of combined results
-        if sort_by == 'fare_low':
-            buses = buses.order_by('fare')
-            # For multi-stop buses, we'd need custom sorting based on segment fare
-        elif sort_by == 'fare_high':
-            buses = buses.order_by('-fare')
-        elif sort_by == 'departure_early':
-            buses = buses.order_by('departure_time')
-        elif sort_by == 'departure_late':
-            buses = buses.order_by('-departure_time')
-        elif sort_by == 'duration':
-            buses = buses.order_by('departure_time')
-        else:
-            buses = buses.order_by('departure_time')
+        # Direct buses and multi-stop segments ranked together in SQL, one keyset
+        # page at a time and narrowed by the facet filters, served from the search cache
+        results, next_cursor = search_buses(source, destination, date, sort_by, form.facet_filters(), cursor)
+        facets = search_facets(source, destination, date)
+
+        # Journeys changing buses on the way, from the in-memory timetable
+        if source and destination and not cursor:
+            connecting_journeys = find_connecting_journeys(source, destination, date)
+
+    # Sort, filter and page links keep the search, replacing their own parameters
+    query = request.GET.copy()
+    query.pop('after', None)
+    sort_query = query.copy()
+    sort_query.pop('sort', None)
+    selected = {facet: request.GET.getlist(facet) for facet in facets}
     
     context = {
         'form': form,
-        'buses': buses,
-        'multi_stop_buses': multi_stop_buses,
+        'results': results,
+        'next_cursor': next_cursor,
+        'is_first_page': not cursor,
+        'page_query': query.urlencode(),
+        'sort_query': sort_query.urlencode(),
+        'facets': [
+            (form[facet].label, facet, [(key, label, count, key in selected[facet]) for key, label, count in values])
+            for facet, values in facets.items()
+        ],
+        'connecting_journeys': connecting_journeys,
         'search_performed': form.is_valid(),
         'current_sort': request.GET.get('sort', 'departure_time'),
     }
     return render(request, 'booking/bus_search.html', context)
 
 
-@login_required
-def view_seats(request, bus_id):
+@require_http_methods(["GET"])
+def city_autocomplete(request):
     """
-    View to display available seats for a specific bus.
-    Handles both regular buses and multi-stop buses.
+    AJAX view returning cities whose name or alias starts with ?q=, for the search form.
+    """
+    results = [{'id': city_id, 'name': name} for city_id, name in autocomplete_cities(request.GET.get('q', ''))]
+    return JsonResponse({'results': results})
+
+
+def _get_seat_map_bus(bus_id):
+    """
+    Get the active bus for a seat map and whether it is a multi-stop bus.
     """
-    # Check if this is a multi-stop bus
     try:
-        bus = MultiStopBus.objects.get(id=bus_id, is_active=True)
-        is_multi_stop = True
+        return MultiStopBus.objects.get(id=bus_id, is_active=True), True
     except MultiStopBus.DoesNotExist:
-        bus = get_object_or_404(Bus, id=bus_id, is_active=True)
-        is_multi_stop = False
+        return get_object_or_404(Bus, id=bus_id, is_active=True), False
+
+
+def _get_seat_map_segment(request, bus):
+    """
+    Get (segment, start_stop, end_stop) from the ?segment=<start>-<end> stop ids
+    of a multi-stop request, the segment being the SegmentFare of the route
+    fare matrix; all None when absent or invalid.
+    """
+    try:
+        segment_params = request.GET.get('segment', '').split('-')
+        if len(segment_params) == 2:
+            start_stop_id, end_stop_id = segment_params
+            start_stop = RouteStop.objects.get(id=start_stop_id, route_id=bus.route_id)
+            end_stop = RouteStop.objects.get(id=end_stop_id, route_id=bus.route_id)
+            
+            # Any pair the fare matrix prices is a segment
+            segment = get_segment_fare(bus.route_id, start_stop, end_stop)
+            if segment:
+                return segment, start_stop, end_stop
+    except (ValueError, RouteStop.DoesNotExist):
+        # If any error occurs, proceed without segment info
+        pass
+    return None, None, None
+
+
+SEGMENT_PARAM = re.compile(r'\d+-\d+')
+
+
+def _seat_map_etag(is_multi_stop, occupancy_id, version, segment, user_id):
+    """
+    ETag of a user's seat map: changes whenever the bus's occupancy row is
+    written or replaced. Only the raw segment parameter is used, so no stop
+    lookups are needed; the user is part of it because their own seat holds
+    show as free.
+    """
+    if not (is_multi_stop and SEGMENT_PARAM.fullmatch(segment)):
+        segment = 'all'
+    return f"{'m' if is_multi_stop else 'd'}{occupancy_id}.{version}.{segment}.{user_id}"
+
+
+def seat_map_etag(request, bus_id):
+    """
+    ETag for seat_map_data from a single version query (None before the first seat map).
+    """
+    version = seat_map_version(bus_id)
+    if version is None:
+        return None
+    return _seat_map_etag(*version, request.GET.get('segment', ''), request.user.pk)
+
+
+@login_required
+@require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=seat_map_etag)
+def seat_map_data(request, bus_id):
+    """
+    AJAX view returning the seat states of a bus (and ?segment=) as a compact
+    0/1 array. Unchanged seat maps are answered with 304 Not Modified after
+    the version lookup alone.
+    """
+    bus, is_multi_stop = _get_seat_map_bus(bus_id)
+    segment, start_stop, end_stop = None, None, None
+    if is_multi_stop:
+        segment, start_stop, end_stop = _get_seat_map_segment(request, bus)
+    
+    # Without segment info a multi-stop bus shows every seat taken on any leg.
+    # Seats held for other customers' checkouts count as taken.
+    occupancy, states = seat_map(bus, start_stop, end_stop, user=request.user)
+    
+    response = JsonResponse({
+        'bus': bus.id,
+        'version': occupancy.version,
+        'seats': len(states),
+        'available': states.count(False),
+        'states': [int(is_booked) for is_booked in states],
+    })
+    # Tag the response with the row actually read, not the one checked before the view ran
+    etag = _seat_map_etag(is_multi_stop, occupancy.pk, occupancy.version, request.GET.get('segment', ''),
+                          request.user.pk)
+    response['ETag'] = f'"{etag}"'
+    return response
+
+
+def _seat_event_subscription(request, bus_id):
+    """
+    Get the (channel, segment leg mask, current version, user id) a seat event stream needs.
+    """
+    bus, is_multi_stop = _get_seat_map_bus(bus_id)
+    start_stop, end_stop = None, None
+    if is_multi_stop:
+        _segment, start_stop, end_stop = _get_seat_map_segment(request, bus)
     
-    # Get segment information if provided
-    segment = None
-    start_stop = None
-    end_stop = None
+    sequences = get_stop_sequences(bus)
+    occupancy, _bitmap = load_occupancy(bus, sequences)
+    return (seat_channel(is_multi_stop, bus.id), leg_mask(*leg_span(sequences, start_stop, end_stop)),
+            occupancy.version, request.user.pk)
+
+
+@login_required
+@require_http_methods(["GET"])
+async def seat_events(request, bus_id):
+    """
+    Server-sent event stream of seat changes on a bus (and ?segment=), pushed
+    as bookings and cancellations commit. Under ASGI an open stream holds no
+    thread while it waits.
+    """
+    channel, segment_mask, version, user_id = await sync_to_async(_seat_event_subscription)(request, bus_id)
+    response = StreamingHttpResponse(seat_event_stream(channel, segment_mask, version, user_id),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def view_seats(request, bus_id):
+    """
+    View to display the seat map for a specific bus.
+    Handles both regular buses and multi-stop buses. Seat states are loaded
+    (and kept fresh) by the page from seat_map_data.
+    """
+    bus, is_multi_stop = _get_seat_map_bus(bus_id)
     
+    # Get segment information if provided
+    segment, start_stop, end_stop = None, None, None
     if is_multi_stop and 'segment' in request.GET:
-        try:
-            segment_params = request.GET.get('segment', '').split('-')
-            if len(segment_params) == 2:
-                start_stop_id, end_stop_id = segment_params
-                start_stop = RouteStop.objects.get(id=start_stop_id, route=bus.route)
-                end_stop = RouteStop.objects.get(id=end_stop_id, route=bus.route)
-                
-                # Try to get the segment
-                segment = RouteSegment.objects.filter(
-                    route=bus.route,
-                    start_stop=start_stop,
-                    end_stop=end_stop
-                ).first()
-        except (ValueError, RouteStop.DoesNotExist, RouteSegment.DoesNotExist):
-            # If any error occurs, proceed without segment info
-            pass
+        segment, start_stop, end_stop = _get_seat_map_segment(request, bus)
     
-    # Get all booked seats for this bus
-    if is_multi_stop:
-        if segment:
-            # Get tickets that overlap with the requested segment
-            booked_tickets = MultiStopTicket.objects.filter(
-                bus=bus, status='BOOKED'
-            ).filter(
-                # Find tickets where the journey overlaps with the requested segment
-                Q(start_stop__sequence__lte=end_stop.sequence) & 
-                Q(end_stop__sequence__gte=start_stop.sequence)
-            )
-        else:
-            # Without segment info, show all booked tickets for this bus
-            booked_tickets = MultiStopTicket.objects.filter(bus=bus, status='BOOKED')
-    else:
-        # Regular buses
-        booked_tickets = Ticket.objects.filter(bus=bus, status='BOOKED')
-    
-    # Extract booked seat numbers
-    booked_seats = []
-    for ticket in booked_tickets:
-        # Assuming seat_numbers is a comma-separated string
-        seats = [seat.strip() for seat in ticket.seat_numbers.split(',')]
-        booked_seats.extend(seats)
-    
-    # Generate all seat numbers (assuming 40 seats per bus in a 10x4 layout)
-    total_seats = bus.total_seats
-    all_seats = []
-    
-    for i in range(1, total_seats + 1):
-        seat_num = str(i)
-        all_seats.append({
-            'number': seat_num,
-            'is_booked': seat_num in booked_seats
-        })
+    seat_map_url = reverse('booking:seat_map_data', args=[bus.id])
+    seat_events_url = reverse('booking:seat_events', args=[bus.id])
+    if segment:
+        seat_map_url += f'?segment={start_stop.id}-{end_stop.id}'
+        seat_events_url += f'?segment={start_stop.id}-{end_stop.id}'
     
     context = {
         'bus': bus,
@@ -337,13 +388,49 @@ def view_seats(request, bus_id):
         'segment': segment,
         'start_stop': start_stop,
         'end_stop': end_stop,
-        'seats': all_seats,
-        'booked_seats': booked_seats,
+        'seats': [str(number) for number in range(1, bus.total_seats + 1)],
+        'fare_per_seat': live_fare(bus, segment=segment),
+        'seat_map_url': seat_map_url,
+        'seat_events_url': seat_events_url,
+        'hold_minutes': int(hold_ttl().total_seconds() // 60),
         'wallet_balance': request.user.wallet.balance,
     }
     return render(request, 'booking/view_seats.html', context)
 
 
+@login_required
+@require_http_methods(["POST"])
+def hold_seats(request, bus_id):
+    """
+    Start checkout: hold the seats chosen on the seat map for the user, then
+    continue to the booking form. Held seats show as taken to other customers
+    until the booking is made or the hold expires.
+    """
+    bus, is_multi_stop = _get_seat_map_bus(bus_id)
+    segment, start_stop, end_stop = None, None, None
+    if is_multi_stop:
+        segment, start_stop, end_stop = _get_seat_map_segment(request, bus)
+    
+    segment_query = f'segment={start_stop.id}-{end_stop.id}' if segment else ''
+    seat_numbers = request.POST.get('seat_numbers', '')
+    try:
+        seats = parse_seat_numbers(seat_numbers)
+        # A multi-stop journey without a segment is held once the booking form picks one
+        if segment or not is_multi_stop:
+            expires_at = place_hold(request.user, bus, seats, start_stop, end_stop)
+            messages.info(request, _(f"Seat(s) {', '.join(str(seat) for seat in seats)} are held for you until "
+                                     f"{timezone.localtime(expires_at):%H:%M}. Complete your booking before then."))
+    except (ValueError, SeatUnavailable) as e:
+        messages.error(request, str(e))
+        url = reverse('booking:view_seats', args=[bus.id])
+        return redirect(f'{url}?{segment_query}' if segment_query else url)
+    
+    url = reverse('booking:book_ticket', args=[bus.id])
+    query = f"seat_numbers={','.join(str(seat) for seat in seats)}"
+    return redirect(f'{url}?{query}&{segment_query}' if segment_query else f'{url}?{query}')
+
+
+@ratelimit('booking:book_ticket')
 @login_required
 @require_http_methods(["GET", "POST"])
 def book_ticket(request, bus_id):
@@ -371,22 +458,7 @@ def book_ticket(request, bus_id):
     end_stop = None
     
     if is_multi_stop and 'segment' in request.GET:
-        try:
-            segment_params = request.GET.get('segment', '').split('-')
-            if len(segment_params) == 2:
-                start_stop_id, end_stop_id = segment_params
-                start_stop = RouteStop.objects.get(id=start_stop_id, route=bus.route)
-                end_stop = RouteStop.objects.get(id=end_stop_id, route=bus.route)
-                
-                # Try to get the segment
-                segment = RouteSegment.objects.filter(
-                    route=bus.route,
-                    start_stop=start_stop,
-                    end_stop=end_stop
-                ).first()
-        except (ValueError, RouteStop.DoesNotExist, RouteSegment.DoesNotExist):
-            # If any error occurs, proceed without segment info
-            pass
+        segment, start_stop, end_stop = _get_seat_map_segment(request, bus)
     
     if request.method == 'POST':
         booking_form = TicketBookingForm(request.POST, bus=bus)
@@ -407,12 +479,8 @@ def book_ticket(request, bus_id):
             # Get selected seat class and calculate fare
             seat_class = booking_form.cleaned_data.get('seat_class')
             
-            # Get fare based on seat class and segment
-            if is_multi_stop and segment:
-                fare_per_seat = bus.calculate_segment_fare(segment, seat_class)
-            else:
-                # Regular bus fare
-                fare_per_seat = bus.get_fare_for_class(seat_class)
+            # Live fare for the seat class (and segment), from dynamic pricing
+            fare_per_seat = live_fare(bus, seat_class, segment if is_multi_stop else None)
             
             # Validate seat numbers
             selected_seats = booking_form.cleaned_data.get('seat_numbers', '').split(',')
@@ -423,13 +491,13 @@ def book_ticket(request, bus_id):
                 messages.error(request, _("Please select at least one seat."))
                 return redirect('booking:book_ticket', bus_id=bus.id)
                 
-            # Check segment availability for multi-stop buses
-            if is_multi_stop and segment:
-                # Check segment availability
-                available_seats = bus.get_segment_availability(segment)
-                if seat_count > available_seats:
-                    messages.error(request, _("Not enough seats available for this segment."))
-                    return redirect('booking:book_ticket', bus_id=bus.id)
+            # Check the selected seats against the occupancy bitmap
+            # (for multi-stop buses, only the legs of the chosen segment)
+            try:
+                check_seats(bus, parse_seat_numbers(selected_seats), start_stop, end_stop, user=request.user)
+            except (ValueError, SeatUnavailable) as e:
+                messages.error(request, str(e))
+                return redirect('booking:book_ticket', bus_id=bus.id)
             
             total_fare = fare_per_seat * seat_count
             
@@ -459,7 +527,7 @@ def book_ticket(request, bus_id):
                 booking_data = {
                     'bus_id': bus.id,
                     'is_multi_stop': is_multi_stop,
-                    'segment_id': segment.id if segment else None,
+                    'segment_id': segment.segment_id if segment else None,
                     'start_stop_id': start_stop.id if start_stop else None,
                     'end_stop_id': end_stop.id if end_stop else None,
                     'seat_class': seat_class,
@@ -471,77 +539,23 @@ def book_ticket(request, bus_id):
                 
                 # BYPASSING OTP - Direct booking processing
                 try:
-                    with transaction.atomic():
-                        # Create passengers first
-                        passengers = []
-                        for passenger_data in booking_data['passenger_data']:
-                            passenger = Passenger.objects.create(**passenger_data)
-                            passengers.append(passenger)
-                        
-                        # Create the appropriate ticket type based on bus type
-                        if is_multi_stop:
-                            # For multi-stop buses, we must have segment data
-                            if not (segment and start_stop and end_stop):
-                                raise Exception(_("Segment information is missing for multi-stop booking."))
-                            
-                            # Create multi-stop ticket
-                            ticket = MultiStopTicket.objects.create(
-                                user=request.user,
-                                bus=bus,
-                                start_stop=start_stop,
-                                end_stop=end_stop,
-                                total_fare=Decimal(booking_data['total_fare']),
-                                seat_numbers=booking_data['seat_numbers'],
-                                seat_class=booking_data.get('seat_class', 'GENERAL'),
-                                status='BOOKED'
-                            )
-                        else:
-                            # Create regular ticket
-                            ticket_data = {
-                                'user': request.user,
-                                'bus': bus,
-                                'total_fare': Decimal(booking_data['total_fare']),
-                                'seat_numbers': booking_data['seat_numbers'],
-                                'seat_class': booking_data.get('seat_class', 'GENERAL'),
-                                'status': 'BOOKED'
-                            }
-                            
-                            # Add segment data if available
-                            if segment and start_stop and end_stop:
-                                ticket_data.update({
-                                    'start_stop': start_stop,
-                                    'end_stop': end_stop
-                                })
-                            
-                            ticket = Ticket.objects.create(**ticket_data)
-                        
-                        # Add passengers to ticket
-                        for passenger in passengers:
-                            ticket.passengers.add(passenger)
-                        
-                        # Book with wallet (deduct money)
-                        if is_multi_stop:
-                            if not ticket.book_with_wallet():
-                                # If booking with wallet fails, rollback
-                                raise Exception(_("Failed to process payment."))
-                        else:
-                            if not ticket.book_with_wallet():
-                                # If booking with wallet fails, rollback
-                                raise Exception(_("Failed to process payment."))
-                        
-                        # Update available seats
-                        seat_count = len(booking_data['passenger_data'])
-                        # Note: We're reducing the bus's available seats count 
-                        # even though for multi-stop buses this isn't the full picture
-                        bus.available_seats -= seat_count
-                        bus.save()
-                        
-                        # Clear session data
-                        if 'booking_data' in request.session:
-                            del request.session['booking_data']
-                        
-                        messages.success(request, _(f"Ticket booked successfully! Ticket ID: #{ticket.id}"))
-                        return redirect('booking:booking_success', ticket_id=ticket.id)
+                    ticket = create_booking(
+                        user=request.user,
+                        bus=bus,
+                        seat_numbers=booking_data['seat_numbers'],
+                        total_fare=Decimal(booking_data['total_fare']),
+                        passenger_data=booking_data['passenger_data'],
+                        seat_class=booking_data.get('seat_class', 'GENERAL'),
+                        start_stop=start_stop,
+                        end_stop=end_stop,
+                    )
+                    
+                    # Clear session data
+                    if 'booking_data' in request.session:
+                        del request.session['booking_data']
+                    
+                    messages.success(request, _(f"Ticket booked successfully! Ticket ID: #{ticket.id}"))
+                    return redirect('booking:booking_success', ticket_id=ticket.id)
                 except Exception as e:
                     messages.error(request, str(e))
                     return redirect('booking:book_ticket', bus_id=bus.id)
@@ -553,12 +567,17 @@ def book_ticket(request, bus_id):
                 messages.error(request, str(e))
                 return redirect('booking:book_ticket', bus_id=bus.id)
     else:
-        booking_form = TicketBookingForm(bus=bus)
+        # Seats chosen (and held) on the seat map arrive in the query string
+        booking_form = TicketBookingForm(bus=bus, initial={'seat_numbers': request.GET.get('seat_numbers', '')})
+    
+    # Live fare per seat for each class (of the segment on multi-stop buses)
+    class_fares = live_class_fares(bus, segment if is_multi_stop else None)
+    fare_estimate = class_fares.get('GENERAL') or live_fare(bus, segment=segment if is_multi_stop else None)
     
-    # Calculate fare estimate
-    fare_estimate = bus.fare
-    if is_multi_stop and segment:
-        fare_estimate = bus.calculate_segment_fare(segment, 'GENERAL')
+    # Live seat changes, so the user learns a seat was taken before submitting
+    seat_events_url = reverse('booking:seat_events', args=[bus.id])
+    if start_stop and end_stop:
+        seat_events_url += f'?segment={start_stop.id}-{end_stop.id}'
     
     context = {
         'bus': bus,
@@ -566,9 +585,11 @@ def book_ticket(request, bus_id):
         'segment': segment,
         'start_stop': start_stop,
         'end_stop': end_stop,
+        'seat_events_url': seat_events_url,
         'booking_form': booking_form,
         'wallet_balance': request.user.wallet.balance,
         'total_fare_estimate': fare_estimate,
+        'class_fares': {seat_class: str(fare) for seat_class, fare in class_fares.items()},
     }
     return render(request, 'booking/ticket_booking.html', context)
 
@@ -599,10 +620,10 @@ def verify_booking_otp(request):
     start_stop = None
     end_stop = None
     
-    if booking_data.get('segment_id'):
-        segment = get_object_or_404(RouteSegment, id=booking_data['segment_id'])
-        start_stop = get_object_or_404(RouteStop, id=booking_data['start_stop_id'])
-        end_stop = get_object_or_404(RouteStop, id=booking_data['end_stop_id'])
+    if is_multi_stop and booking_data.get('start_stop_id') and booking_data.get('end_stop_id'):
+        start_stop = get_object_or_404(RouteStop, id=booking_data['start_stop_id'], route_id=bus.route_id)
+        end_stop = get_object_or_404(RouteStop, id=booking_data['end_stop_id'], route_id=bus.route_id)
+        segment = get_segment_fare(bus.route_id, start_stop, end_stop)
     
     # Process form submission
     if request.method == 'POST':
@@ -616,77 +637,23 @@ def verify_booking_otp(request):
         if form.is_valid():
             # OTP is valid, process the ticket booking
             try:
-                with transaction.atomic():
-                    # Create passengers first
-                    passengers = []
-                    for passenger_data in booking_data['passenger_data']:
-                        passenger = Passenger.objects.create(**passenger_data)
-                        passengers.append(passenger)
-                    
-                    # Create the appropriate ticket type based on bus type
-                    if is_multi_stop:
-                        # For multi-stop buses, we must have segment data
-                        if not (segment and start_stop and end_stop):
-                            raise Exception(_("Segment information is missing for multi-stop booking."))
-                        
-                        # Create multi-stop ticket
-                        ticket = MultiStopTicket.objects.create(
-                            user=request.user,
-                            bus=bus,
-                            start_stop=start_stop,
-                            end_stop=end_stop,
-                            total_fare=Decimal(booking_data['total_fare']),
-                            seat_numbers=booking_data['seat_numbers'],
-                            seat_class=booking_data.get('seat_class', 'GENERAL'),
-                            status='BOOKED'
-                        )
-                    else:
-                        # Create regular ticket
-                        ticket_data = {
-                            'user': request.user,
-                            'bus': bus,
-                            'total_fare': Decimal(booking_data['total_fare']),
-                            'seat_numbers': booking_data['seat_numbers'],
-                            'seat_class': booking_data.get('seat_class', 'GENERAL'),
-                            'status': 'BOOKED'
-                        }
-                        
-                        # Add segment data if available
-                        if segment and start_stop and end_stop:
-                            ticket_data.update({
-                                'start_stop': start_stop,
-                                'end_stop': end_stop
-                            })
-                        
-                        ticket = Ticket.objects.create(**ticket_data)
-                    
-                    # Add passengers to ticket
-                    for passenger in passengers:
-                        ticket.passengers.add(passenger)
-                    
-                    # Book with wallet (deduct money)
-                    if is_multi_stop:
-                        if not ticket.book_with_wallet():
-                            # If booking with wallet fails, rollback
-                            raise Exception(_("Failed to process payment."))
-                    else:
-                        if not ticket.book_with_wallet():
-                            # If booking with wallet fails, rollback
-                            raise Exception(_("Failed to process payment."))
-                    
-                    # Update available seats
-                    seat_count = len(booking_data['passenger_data'])
-                    # Note: We're reducing the bus's available seats count 
-                    # even though for multi-stop buses this isn't the full picture
-                    bus.available_seats -= seat_count
-                    bus.save()
-                    
-                    # Clear session data
-                    if 'booking_data' in request.session:
-                        del request.session['booking_data']
-                    
-                    messages.success(request, _(f"Ticket booked successfully! Ticket ID: #{ticket.id}"))
-                    return redirect('booking:booking_success', ticket_id=ticket.id)
+                ticket = create_booking(
+                    user=request.user,
+                    bus=bus,
+                    seat_numbers=booking_data['seat_numbers'],
+                    total_fare=Decimal(booking_data['total_fare']),
+                    passenger_data=booking_data['passenger_data'],
+                    seat_class=booking_data.get('seat_class', 'GENERAL'),
+                    start_stop=start_stop,
+                    end_stop=end_stop,
+                )
+                
+                # Clear session data
+                if 'booking_data' in request.session:
+                    del request.session['booking_data']
+                
+                messages.success(request, _(f"Ticket booked successfully! Ticket ID: #{ticket.id}"))
+                return redirect('booking:booking_success', ticket_id=ticket.id)
             except Exception as e:
                 messages.error(request, str(e))
                 return redirect('booking:verify_booking_otp')
@@ -725,6 +692,7 @@ def verify_booking_otp(request):
     return render(request, 'booking/verify_booking_otp.html', context)
 
 
+@ratelimit('booking:resend_booking_otp')
 @login_required
 @require_http_methods(["GET", "POST"])
 def resend_booking_otp(request):
@@ -903,50 +871,25 @@ def user_journeys(request):
     View to display upcoming and past journeys for the user.
     Includes both regular and multi-stop tickets.
     """
-    now = timezone.now()
-    
-    # Create empty lists to store combined tickets
-    upcoming_tickets = []
-    past_tickets = []
-    
-    # Get regular tickets for the user
-    regular_tickets = Ticket.objects.filter(user=request.user).select_related('bus')
-    
-    # Split regular tickets into upcoming and past journeys
-    for ticket in regular_tickets:
-        ticket.is_multi_stop = False  # Flag to identify ticket type in template
-        if ticket.status == 'BOOKED' and ticket.bus.departure_time > now:
-            upcoming_tickets.append(ticket)
-        else:
-            past_tickets.append(ticket)
-    
-    # Get multi-stop tickets for the user
-    multi_stop_tickets = MultiStopTicket.objects.filter(user=request.user).select_related('bus')
-    
-    # Split multi-stop tickets into upcoming and past journeys
-    for ticket in multi_stop_tickets:
-        ticket.is_multi_stop = True  # Flag to identify ticket type in template
-        if ticket.status == 'BOOKED' and ticket.departure_time > now:
-            upcoming_tickets.append(ticket)
-        else:
-            past_tickets.append(ticket)
-    
-    # Sort the combined lists
-    upcoming_tickets.sort(key=lambda ticket: ticket.bus.departure_time if not getattr(ticket, 'is_multi_stop', False) 
-                          else ticket.departure_time)
-    past_tickets.sort(key=lambda ticket: ticket.bus.departure_time if not getattr(ticket, 'is_multi_stop', False) 
-                      else ticket.departure_time, reverse=True)
-    
-    # Apply filters if provided
+    # Apply filters if provided; 'after' pages through the selected list
     filter_type = request.GET.get('filter', 'all')
-    if filter_type == 'upcoming':
-        past_tickets = []
-    elif filter_type == 'past':
-        upcoming_tickets = []
+    after = request.GET.get('after')
+    
+    upcoming_tickets, upcoming_next = [], None
+    past_tickets, past_next = [], None
+    if filter_type != 'past':
+        upcoming_tickets, upcoming_next = journey_page(
+            request.user, upcoming=True, cursor=after if filter_type == 'upcoming' else None)
+    if filter_type != 'upcoming':
+        past_tickets, past_next = journey_page(
+            request.user, upcoming=False, cursor=after if filter_type == 'past' else None)
     
     context = {
         'upcoming_tickets': upcoming_tickets,
         'past_tickets': past_tickets,
+        'upcoming_next': upcoming_next,
+        'past_next': past_next,
+        'is_paged': bool(after),
         'filter_type': filter_type,
     }
     return render(request, 'booking/user_journeys.html', context)
@@ -1090,28 +1033,14 @@ def admin_bus_cancel(request, bus_id):
         messages.error(request, _("This bus is already cancelled."))
         return redirect('booking:admin_bus_list')
     
-    # Get all active tickets for this bus
-    active_tickets = Ticket.objects.filter(bus=bus, status='BOOKED')
-    refund_count = 0
-    
-    try:
-        with transaction.atomic():
-            # Cancel the bus first
-            bus.is_active = False
-            bus.save()
-            
-            # Process refunds for all active tickets
-            for ticket in active_tickets:
-                if ticket.cancel(admin_cancelled=True):
-                    refund_count += 1
-            
-            messages.success(
-                request,
-                _(f"Bus {bus.bus_number} cancelled successfully. {refund_count} tickets refunded.")
-            )
-    except Exception as e:
-        messages.error(request, str(e))
+    # Deactivate the bus now; the cancellation worker refunds the tickets in batches
+    job = start_bus_cancellation(bus, requested_by=request.user)
     
+    messages.success(
+        request,
+        _(f"Bus {bus.bus_number} cancelled. Refunding {job.total_tickets} tickets in the background "
+          f"(cancellation job #{job.id}).")
+    )
     return redirect('booking:admin_bus_list')
 
 